@@ -1,35 +1,61 @@
 # -*- coding: utf-8 -*-
 
 import xml.etree.ElementTree as ET
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse
 from urllib import unquote
-import icalendar
+import itertools
 import posixpath
+import logging
+import time
 import os
 
-from util import DEBUG
 import util
 import config
 import backends
+import metrics
+import timerange
+import watcher
 import xmlutils
 import ical
+import log
+
+logger = logging.getLogger(__name__)
+
+# Items read at once to answer a REPORT
+REPORT_BATCH_SIZE = 100
 
 class Application(object):
     """ Main application interface """
 
     def __init__(self, confpath):
         config.load(confpath)
+        log.configure()
         backends.load()
+        watcher.start()
 
     def __call__(self, environ, start_response):
         """ WSGI caller """
 
-        DEBUG('{0} {1}\n{2}'.format(environ['REQUEST_METHOD'], environ['PATH_INFO'], environ))
+        logger.debug('%s %s\n%s', environ['REQUEST_METHOD'], environ['PATH_INFO'], environ)
 
+        started = time.time()
         status, headers, content = self.manage(environ)
 
-        headers['Content-Length'] = sum([len(c) for c in content])
+        if isinstance(content, list):
+            headers['Content-Length'] = sum([len(c) for c in content])
+
+        # Streamed responses are only done once sent
+        content = metrics.response(
+            content,
+            environ['REQUEST_METHOD'],
+            started,
+            headers.get('Content-Length')
+        )
 
-        start_response(status, list(headers.items()))
+        start_response(util.http_status(status), [
+            (key, str(value)) for key, value in headers.items()
+        ])
 
         return content
 
@@ -39,20 +65,42 @@ class Application(object):
         request = environ['REQUEST_METHOD'].lower()
 
         request_body = self.wsgi_get_content(environ)
-        DEBUG('Request Body:\n{0}'.format(request_body))
+        metrics.count('cal9_request_bytes_total', int(environ.get('CONTENT_LENGTH') or 0))
+
+        # Log both bodies of a sampled request, the others not at all
+        bodies = log.bodies(logger)
+
+        if bodies:
+            logger.debug('Request body:\n%s', log.truncate(request_body))
 
         path = self.wsgi_sanitize_path(environ['PATH_INFO'])
-        DEBUG('Sanitized path: {0}'.format(path))
+        logger.debug('Sanitized path: %s', path)
+
+        if request == 'get' and path == (config.config.metrics or {}).get('path'):
+            return 200, {'Content-Type': metrics.CONTENT_TYPE}, [metrics.render()]
 
         try:
             function = getattr(self, request)
         except AttributeError:
             raise NotImplementedError, '{0} {1}'.format(request.upper(), path)
 
-        collections = ical.Collection.from_path(path, depth=environ.get('HTTP_DEPTH', '0'))
+        with metrics.breakdown() as timings:
+            collections = ical.Collection.from_path(path, depth=environ.get('HTTP_DEPTH', '0'))
 
-        response = function(path, collections, request_body, environ)
-        DEBUG('Response body:\n{0}'.format(response))
+            response = function(path, collections, request_body, environ)
+
+        if bodies:
+            status, headers, content = response
+
+            # Streamed bodies would have to be produced twice
+            if isinstance(content, list):
+                logger.debug('Response %s %s, body:\n%s', status, headers, log.truncate(content))
+            else:
+                logger.debug('Response %s %s, body streamed', status, headers)
+
+        if config.config.debug:
+            # Streamed bodies are produced once headers are sent, after this
+            response[1]['Server-Timing'] = metrics.server_timing(timings)
 
         return response
 
@@ -62,11 +110,11 @@ class Application(object):
         charsets = []
 
         # Retrieve content
-        content_length = int(environ['CONTENT_LENGTH'] or 0)
+        content_length = int(environ.get('CONTENT_LENGTH') or 0)
         content = environ['wsgi.input'].read(content_length)
 
         # Retrieve encoding
-        content_type = environ['CONTENT_TYPE']
+        content_type = environ.get('CONTENT_TYPE')
 
         if content_type and 'charset=' in content_type:
             charsets.append(content_type.split('charset=')[1].strip())
@@ -104,10 +152,45 @@ class Application(object):
         if (len(path_parts) - len(collection_parts)):
             name = os.path.splitext(path_parts[-1])[0]
 
-            DEBUG('name from path: {0}'.format(name))
+            logger.debug('Name from path: %s', name)
 
             return name
 
+    def wsgi_not_modified(self, environ, etag, last_modified):
+        """
+            Check the conditional headers of a GET or HEAD request [RFC 7232],
+            return True if the client's copy of the resource is up to date.
+        """
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+
+        if if_none_match:
+            # Weak comparison, If-Modified-Since is then ignored
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+            return '*' in tags or etag in tags
+
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+
+        if if_modified_since:
+            since = parsedate_tz(if_modified_since)
+            modified = parsedate_tz(last_modified)
+
+            if since and modified:
+                return mktime_tz(modified) <= mktime_tz(since)
+
+        return False
+
+    def wsgi_file(self, environ, f):
+        """
+            Wrap the file ``f`` to send it as the response body, letting the
+            server use sendfile if it can.
+        """
+
+        file_wrapper = environ.get('wsgi.file_wrapper', util.FileWrapper)
+        return file_wrapper(f, xmlutils.CHUNK_SIZE)
+
     ## Request handlers
 
     def options(self, path, collections, request_body, environ):
@@ -174,11 +257,94 @@ class Application(object):
 
         # Write answer
 
-        multistatus = ET.Element(xmlutils.tag('D', 'multistatus'))
+        responses = (
+            xmlutils.propfind_response(path, collection, props)
+            for collection in collections
+        )
 
-        for collection in collections:
-            response = xmlutils.propfind_response(path, collection, props)
-            multistatus.append(response)
+        return 207, headers, xmlutils.render_multistatus(responses)
+
+    def proppatch(self, path, collections, request_body, environ):
+        """
+            Manage PROPPATCH request.
+
+            According to [RFC 4918], it should have the following request body :
+
+                <D:propertyupdate>
+                    <D:set>
+                        <D:prop>
+                            ...
+                        </D:prop>
+                    </D:set>
+                    <D:remove>
+                        <D:prop>
+                            ...
+                        </D:prop>
+                    </D:remove>
+                    ...
+                </D:propertyupdate>
+
+            The instructions are applied in order, and all at once or not at
+            all. It should return the following content :
+
+                207 Multi-Status
+
+                <D:multistatus>
+                    <D:response>
+                        <D:href>calendar uri</D:href>
+                        <D:propstat>
+                            <D:prop>
+                                ...
+                            </D:prop>
+                            <D:status>...</D:status>
+                        </D:propstat>
+                    </D:response>
+                </D:multistatus>
+        """
+
+        headers = {
+            'DAV': '1, 2, access-control, calendar-access',
+            'Content-Type': 'text/xml',
+        }
+
+        collection = collections[0]
+
+        # Read request
+
+        dom = ET.fromstring(request_body)
+        updates = []
+
+        for instruction in dom:
+            remove = instruction.tag == xmlutils.tag('D', 'remove')
+
+            for dprop in instruction.findall(xmlutils.tag('D', 'prop')):
+                for prop in dprop:
+                    updates.append((prop.tag, None if remove else prop.text or ''))
+
+        protected = [xmltag for xmltag, value in updates if xmltag in xmlutils.PROTECTED_PROPS]
+
+        if protected:
+            # Other properties are left untouched too
+            statuses = [
+                (xmltag, 403 if xmltag in protected else 424)
+                for xmltag, value in updates
+            ]
+
+        else:
+            # Update the properties at once
+            with collection.props as props:
+                for xmltag, value in updates:
+                    if value is None:
+                        props.pop(xmlutils.tag_clark(xmltag), None)
+                    else:
+                        props[xmlutils.tag_clark(xmltag)] = value
+
+            statuses = [(xmltag, 200) for xmltag, value in updates]
+
+        # Write answer
+
+        multistatus = ET.Element(xmlutils.tag('D', 'multistatus'))
+        multistatus.append(xmlutils.proppatch_response(path, statuses))
 
         return 207, headers, [xmlutils.render(multistatus)]
 
@@ -191,13 +357,19 @@ class Application(object):
         """
 
         status, headers, body = self.get(path, collections, request_body, environ)
+
+        # The stored calendar may have been opened to be sent
+        if hasattr(body, 'close'):
+            body.close()
+
         return status, headers, []
 
     def get(self, path, collections, request_body, environ):
         """
             Manage GET request.
 
-            It should return the Etag and the resource content.
+            It should return the Etag and the resource content, or
+            304 Not Modified if the client's copy is up to date.
         """
 
         headers = {}
@@ -205,27 +377,50 @@ class Application(object):
         collection = collections[0]
         item_name = self.wsgi_name_from_path(path, collection)
 
+        # Answer conditional requests before reading the calendar
+
+        last_modified = collection.last_modified
+
+        if item_name:
+            etag = collection.item_etag(item_name)
+        else:
+            etag = collection.etag
+
+        if etag and self.wsgi_not_modified(environ, etag, last_modified):
+            headers['Last-Modified'] = last_modified
+            headers['ETag'] = etag
+
+            return 304, headers, []
+
         if item_name:
             # Retrieve collection item
             item = collection.get_item(item_name)
 
             if item:
-                items = collection.timezones
-                items.append(item)
-                body = items.to_ical()
+                # Only the timezones the item refers to are sent with it
+                blocks = collection.timezone_blocks(ical.tzids(item.ical.subcomponents))
+                blocks.extend(ical.serialize(component) for component in item.ical.subcomponents)
+
+                body = [ical.calendar_text(blocks)]
                 etag = item.etag
             else:
                 return 410, headers, []
         else:
-            # Get whole collection
-            body = collection.text
-            etag = collection.etag
+            # Get whole collection, sent as stored when possible
+            raw = collection.get_raw()
+
+            if raw:
+                stored, size = raw
+                body = self.wsgi_file(environ, stored)
+                headers['Content-Length'] = size
+            else:
+                body = [collection.text]
 
         headers['Content-Type'] = collection.mimetype
-        headers['Last-Modified'] = collection.last_modified
+        headers['Last-Modified'] = last_modified
         headers['ETag'] = etag
 
-        return 200, headers, [body]
+        return 200, headers, body
 
     def report(self, path, collections, request_body, environ):
         """
@@ -266,67 +461,221 @@ class Application(object):
         # Parse request body
         dom = ET.fromstring(request_body)
 
+        if dom.tag == xmlutils.tag('C', 'free-busy-query'):
+            return self.report_free_busy(collection, dom)
+
         dprop = dom.find(xmlutils.tag('D', 'prop'))
         properties = [prop.tag for prop in dprop]
 
-        if collection:
-            if dom.tag == xmlutils.tag('C', 'calendar-multiget'):
-                hrefs = set(href.text for href in dom.findall(xmlutils.tag('D', 'href')))
+        if dom.tag == xmlutils.tag('D', 'sync-collection'):
+            return self.report_sync_collection(path, collection, dom, properties)
+
+        try:
+            recurrence = xmlutils.recurrence_limit(dom)
+
+            if collection:
+                if dom.tag == xmlutils.tag('C', 'calendar-multiget'):
+                    hrefs = set(href.text for href in dom.findall(xmlutils.tag('D', 'href')))
 
+                elif dom.tag == xmlutils.tag('C', 'calendar-query'):
+                    names = self.report_query(collection, dom)
+
+                    if names is None:
+                        hrefs = (path,)
+                    else:
+                        hrefs = ['/'.join([path.rstrip('/'), name]) + '.ics' for name in sorted(names)]
+
+                else:
+                    hrefs = (path,)
             else:
-                hrefs = (path,)
-        else:
-            hrefs = ()
+                hrefs = ()
+
+        except ValueError as e:
+            logger.debug('Invalid time-range: %s', e)
+            return 400, {}, []
 
         # Write response body
-        multistatus = ET.Element(xmlutils.tag('D', 'multistatus'))
+        responses = self.report_responses(
+            collection,
+            hrefs,
+            properties,
+            recurrence
+        )
+
+        return 207, headers, xmlutils.render_multistatus(responses)
+
+    def report_responses(self, collection, hrefs, properties, recurrence=None):
+        """
+            Generate the REPORT response element of each item in ``hrefs``,
+            only reading the items if their calendar data is asked for, with
+            their recurrences presented as ``recurrence`` tells.
+        """
+
+        targets = []
 
         for href in hrefs:
             name = self.wsgi_name_from_path(href, collection)
 
             if name:
                 # The reference is an item
-
-                path = '/'.join(href.split('/')[:-1]) + '/'
-                items = (item for item in collection.items if item.name == name)
+                path = '/'.join(href.split('/')[:-1])
+                names = (name,)
 
             else:
                 # The reference is a collection
-                path = href
-                items = collection.components
+                path = href.rstrip('/')
+                names = sorted(collection.names)
 
-            # Create a response element for all items
-            for item in items:
-                response = ET.Element(xmlutils.tag('D', 'response'))
-                multistatus.append(response)
+            targets.extend(('/'.join([path, name]) + '.ics', name) for name in names)
 
-                xmlhref = ET.Element(xmlutils.tag('D', 'href'))
-                xmlhref.text = '/'.join([path.rstrip('/'), item.name]) + '.ics'
-                response.append(xmlhref)
+        calendar_data = xmlutils.tag('C', 'calendar-data') in properties
 
-                propstat = ET.Element(xmlutils.tag('D', 'propstat'))
-                response.append(propstat)
+        # Resolve the references by batches, keeping few items in memory
+        for start in xrange(0, len(targets), REPORT_BATCH_SIZE):
+            batch = targets[start:start + REPORT_BATCH_SIZE]
+            names = [name for href, name in batch]
 
-                prop = ET.Element(xmlutils.tag('D', 'prop'))
-                propstat.append(prop)
+            if calendar_data:
+                items = collection.get_items(names)
+                etags = dict((name, item.etag) for name, item in items.items())
+            else:
+                etags = collection.item_etags(names)
 
-                for tag in properties:
-                    element = ET.Element(tag)
+            for href, name in batch:
+                # Items which do not exist are left out
+                if name not in etags:
+                    continue
 
-                    if tag == xmlutils.tag('D', 'getetag'):
-                        element.text = item.etag
+                data = None
 
-                    elif tag == xmlutils.tag('C', 'calendar-data'):
-                        if isinstance(item, ical.Component):
-                            element.text = item.to_ical()
+                if calendar_data and isinstance(items[name], ical.Component):
+                    item = items[name]
 
-                    prop.append(element)
+                    if recurrence is None:
+                        data = item.to_ical()
+                    elif recurrence[0] == 'expand':
+                        data = ical.expand(item, *recurrence[1:])
+                    else:
+                        data = ical.limit_recurrence_set(item, *recurrence[1:])
 
-                status = ET.Element(xmlutils.tag('D', 'status'))
-                status.text = util.http_response(200)
-                propstat.append(status)
+                yield xmlutils.report_response(href, properties, etags[name], data)
 
-        return 207, headers, [xmlutils.render(multistatus)]
+    def report_query(self, collection, dom):
+        """
+            Return the names of the items matching the filter of a
+            calendar-query REPORT [RFC 4791 7.8], or None if every item does.
+        """
+
+        filters = xmlutils.comp_filters(dom)
+
+        if filters is None:
+            return None
+
+        names = None
+
+        for tag, start, end, defined in filters:
+            matching = collection.query(tag, start, end)
+
+            if not defined:
+                matching = set(collection.names) - matching
+
+            names = matching if names is None else names & matching
+
+        return names
+
+    def report_free_busy(self, collection, dom):
+        """
+            Manage free-busy-query REPORT [RFC 4791 7.10].
+
+            The request body gives the time-range to look at :
+
+                <C:free-busy-query>
+                    <C:time-range start="..." end="..."/>
+                </C:free-busy-query>
+
+            It should return the busy time of the collection's events during
+            that time-range, as a VFREEBUSY component.
+        """
+
+        time_range = dom.find(xmlutils.tag('C', 'time-range'))
+
+        if time_range is None or not collection:
+            return 400, {}, []
+
+        try:
+            start = timerange.parse_utc(time_range.get('start'))
+            end = timerange.parse_utc(time_range.get('end'))
+
+        except ValueError as e:
+            logger.debug('Invalid time-range: %s', e)
+            return 400, {}, []
+
+        if not (start and end):
+            return 400, {}, []
+
+        headers = {
+            'Content-Type': 'text/calendar',
+        }
+
+        return 200, headers, [ical.free_busy(collection.busy(start, end), start, end)]
+
+    def report_sync_collection(self, path, collection, dom, properties):
+        """
+            Manage sync-collection REPORT.
+
+            According to [RFC 6578], the request body contains the token
+            returned by the previous synchronization, empty for the first one :
+
+                <D:sync-collection>
+                    <D:sync-token>...</D:sync-token>
+                    <D:sync-level>1</D:sync-level>
+                    <D:prop>
+                        ...
+                    </D:prop>
+                </D:sync-collection>
+
+            It should return the items changed since then, the items removed
+            with a 404 status, and the new token :
+
+                <D:multistatus>
+                    <D:response>
+                        ...
+                    </D:response>
+                    ...
+                    <D:sync-token>...</D:sync-token>
+                </D:multistatus>
+        """
+
+        headers = {
+            'Content-Type': 'text/xml',
+        }
+
+        token = dom.findtext(xmlutils.tag('D', 'sync-token'))
+
+        try:
+            changed, removed = collection.changes_since(token)
+
+        except ValueError as e:
+            logger.debug('Invalid sync token: %s', e)
+            return 403, headers, [xmlutils.render(xmlutils.error('valid-sync-token'))]
+
+        hrefs = ['/'.join([path.rstrip('/'), name]) + '.ics' for name in changed]
+
+        removed_responses = (
+            xmlutils.removed_response('/'.join([path.rstrip('/'), name]) + '.ics')
+            for name in removed
+        )
+
+        sync_token = ET.Element(xmlutils.tag('D', 'sync-token'))
+        sync_token.text = collection.sync_token
+
+        responses = itertools.chain(
+            self.report_responses(collection, hrefs, properties),
+            removed_responses,
+            [sync_token]
+        )
+
+        return 207, headers, xmlutils.render_multistatus(responses)
 
 
     def put(self, path, collections, request_body, environ):
@@ -338,25 +687,39 @@ class Application(object):
 
         headers = {}
 
-        ical = icalendar.Calendar.from_ical(request_body)
+        calendar = ical.parse(request_body)
 
         collection = collections[0]
         item_name = self.wsgi_name_from_path(path, collection)
 
-        item = collection.get_item(item_name)
+        if_match = environ.get('HTTP_IF_MATCH')
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
 
-        if (not item and not environ.get('HTTP_IF_MATCH')) or (item and environ.get('HTTP_IF_MATCH', item.etag) == item.etag):
+        # Other writers can't change the item between the check of the
+        # preconditions and the write
+        with collection.lock(exclusive=True):
+            collection.refresh()
+            item = collection.get_item(item_name)
 
-            if item_name in (item.name for item in collection.items):
-                # Replace item
-                collection.replace(item_name, ical)
+            if item:
+                allowed = (
+                    if_match in (None, item.etag)
+                    and if_none_match not in ('*', item.etag)
+                )
             else:
-                collection.append(item_name, ical)
+                allowed = not if_match
 
-            headers['ETag'] = collection.get_item(item_name).etag
-            status = 201
-        else:
-            status = 412
+            if allowed:
+                if item:
+                    # Replace item
+                    collection.replace(item_name, calendar)
+                else:
+                    collection.append(item_name, calendar)
+
+                headers['ETag'] = collection.item_etag(item_name)
+                status = 201
+            else:
+                status = 412
 
         return status, headers, []
 
@@ -429,13 +792,16 @@ class Application(object):
                 url_parts = urlparse(environ['HTTP_DESTINATION'])
 
                 # Check if we are on the same host
-                if url_parts.netlock == environ['HTTP_HOST']:
+                if url_parts.netloc == environ['HTTP_HOST']:
 
                     # Copy the item
-                    to_path, to_name = url_parts.path.rstrip('/').rsplit('/', 1)
+                    to_path = self.wsgi_sanitize_path(url_parts.path)
 
                     to_collection = ical.Collection.from_path(to_path, depth="0")[0]
-                    to_collection.append(to_name, item.ical)
+                    to_name = self.wsgi_name_from_path(to_path, to_collection)
+
+                    # Stored under its new name, which changes its components
+                    to_collection.append(to_name, item.copy().ical)
 
                     return 201, {}, []
 
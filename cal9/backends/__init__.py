@@ -1,9 +1,12 @@
 from cal9 import config
-from cal9.util import DEBUG
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 def load():
     backend_type = config.config.backend
-    DEBUG("Loading backend '{0}'".format(backend_type))
+    logger.debug("Loading backend '%s'", backend_type)
 
     module = __import__('cal9.backends', fromlist=[backend_type])
     return getattr(module, backend_type)
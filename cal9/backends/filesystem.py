@@ -2,18 +2,162 @@
 
 from cal9 import config
 from cal9 import ical
-from cal9.util import DEBUG
+from cal9 import metrics
+from cal9 import watcher
+from cal9.util import LRUCache
 
+from collections import OrderedDict
 from contextlib import contextmanager
 
 import simplejson as json
 import icalendar
+import tempfile
+import fcntl
+import mmap
 import time
 import os
 
 FOLDER = config.config.calendars.folder
 
-class Collection(ical.Collection):
+# Suffixes of the files stored next to a calendar
+SIDECARS = ('.props', '.meta', '.lock', '.journal', '.offsets')
+
+# Properties naming a top-level component, by precedence
+NAMING = ('X-CAL9-NAME', 'TZID', 'UID')
+
+# Parsed calendars shared by all requests, weighted by their size on disk
+CACHE = LRUCache((config.config.cache or {}).get('size', 64 * 1024 * 1024))
+metrics.CACHES['calendars'] = CACHE
+
+def file_state(stat):
+    """ Identify the state of a file from its ``stat`` result """
+
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+def parse(path):
+    """
+        Parse the iCalendar file at ``path``, reusing the result of a
+        previous parse while the file is unchanged.
+    """
+
+    current = file_state(watcher.stat(path))
+    cached = CACHE.get(path)
+
+    if cached and cached[0] == current:
+        return cached[1]
+
+    with open(path) as f:
+        calendar = ical.parse(f.read())
+
+    # The calendar's index is built on first use
+    CACHE.set(path, [current, calendar, None], weight=current[1])
+
+    return calendar
+
+def property_value(line):
+    """ Return the value of the property on the unfolded ``line`` """
+
+    quoted = False
+
+    for position, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+
+        elif char == ':' and not quoted:
+            return str(icalendar.vText.from_ical(line[position + 1:].rstrip('\r\n')))
+
+def scan(content):
+    """
+        Return the tag and the byte ranges of the components of each item in
+        the iCalendar ``content``, by name, reading it line by line instead of
+        parsing it.
+    """
+
+    items = {}
+    depth = 0
+    position = 0
+
+    for line in iter(content.readline, ''):
+        start, position = position, position + len(line)
+
+        if line[:6].upper() == 'BEGIN:':
+            depth += 1
+
+            if depth == 2:
+                first, tag, lines, current = start, line[6:].strip().upper(), {}, None
+
+        elif line[:4].upper() == 'END:':
+            depth -= 1
+
+            if depth == 1:
+                name = None
+
+                for key in NAMING:
+                    name = key in lines and property_value(lines[key])
+
+                    if name:
+                        break
+
+                # Components without a name can't be asked for
+                if name:
+                    items.setdefault(name, [tag, []])[1].append([first, position])
+
+        elif depth == 2:
+            if line[:1] in ' \t':
+                # Folded line of the previous property
+                if current is not None:
+                    lines[current] += line[1:].rstrip('\r\n')
+
+                continue
+
+            current = None
+
+            for key in NAMING:
+                if line[:len(key) + 1].upper() in (key + ':', key + ';'):
+                    current = key
+                    lines[key] = line.rstrip('\r\n')
+
+    return items
+
+@contextmanager
+def atomic_write(path):
+    """
+        Open a temporary file to be renamed to ``path`` once written, so
+        that readers never see a partially written file.
+    """
+
+    directory = os.path.dirname(path)
+    watcher.makedirs(directory)
+
+    try:
+        mode = os.stat(path).st_mode & 0777
+    except OSError:
+        mode = 0644
+
+    fd, temp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+
+    try:
+        os.fchmod(fd, mode)
+
+        with os.fdopen(fd, 'w') as f:
+            yield f
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp, path)
+        watcher.invalidate(path)
+
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+        raise
+
+class Collection(ical.BaseCollection):
+    # Mode of the lock held by this object, None if it holds none
+    _locked = None
+
     @property
     def _path(self):
         """ Path on the computer """
@@ -28,49 +172,145 @@ class Collection(ical.Collection):
         """ Properties path on the computer """
         return '{0}.props'.format(self._path)
 
-    def _makedirs(self):
-        if not os.path.exists(os.path.dirname(self._path)):
-            os.makedirs(os.path.dirname(self._path))
+    @property
+    def _meta_path(self):
+        """ Metadata path on the computer """
+        return '{0}.meta'.format(self._path)
+
+    @property
+    def _lock_path(self):
+        """ Lock path on the computer """
+        return '{0}.lock'.format(self._path)
+
+    @property
+    def _offsets_path(self):
+        """ Path on the computer of the byte ranges of the items """
+        return '{0}.offsets'.format(self._path)
 
     @property
     def last_modified(self):
         # Create calendar if needed
-        if not os.path.exists(self._path):
+        if not watcher.exists(self._path):
             self.save()
 
-        modification_time = time.gmtime(os.path.getmtime(self._path))
+        modification_time = time.gmtime(watcher.getmtime(self._path))
         return time.strftime("%a, %d %b %Y %H:%M:%S +0000", modification_time)
 
+    @property
+    def properties(self):
+        try:
+            current = file_state(watcher.stat(self._props_path))
+        except OSError:
+            return {}
+
+        cached = CACHE.get(self._props_path)
+
+        if cached and cached[0] == current:
+            return cached[1]
+
+        with open(self._props_path, 'r') as f:
+            properties = json.load(f)
+
+        CACHE.set(self._props_path, [current, properties], weight=current[1])
+        return properties
+
     @property
     @contextmanager
     def props(self):
-        properties = {}
+        with self.lock(exclusive=True):
+            original = self.properties
+            properties = dict(original)
+
+            yield properties
+
+            # Save properties, if changed
+
+            if properties != original:
+                CACHE.pop(self._props_path)
+
+                with atomic_write(self._props_path) as f:
+                    json.dump(properties, f)
+                    f.flush()
+
+                    current = file_state(os.fstat(f.fileno()))
+
+                CACHE.set(self._props_path, [current, properties], weight=current[1])
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        # The lock is held for the whole outermost block
+        if self._locked is not None and (self._locked or not exclusive):
+            yield
+            return
+
+        watcher.makedirs(os.path.dirname(self._lock_path))
+
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._locked = exclusive
+
+            # Writers must see the changes not notified yet
+            if exclusive:
+                watcher.forget(self._path)
+
+            try:
+                yield
+
+            finally:
+                self._locked = None
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @property
+    def signature(self):
+        try:
+            return list(file_state(watcher.stat(self._path)))
+
+        except OSError:
+            return None
+
+    def load_meta(self):
+        try:
+            current = file_state(watcher.stat(self._meta_path))
+        except OSError:
+            return None
+
+        cached = CACHE.get(self._meta_path)
+
+        if cached and cached[0] == current:
+            return cached[1]
 
-        # Read properties
+        try:
+            with open(self._meta_path) as f:
+                meta = json.load(f)
 
-        if os.path.exists(self._props_path):
-            with open(self._props_path, 'r') as f:
-                properties.update(json.load(f))
+        except (IOError, ValueError):
+            return None
 
-        yield properties
+        CACHE.set(self._meta_path, [current, meta], weight=current[1])
+        return meta
 
-        # Save properties
+    def store_meta(self, meta):
+        CACHE.pop(self._meta_path)
 
-        self._makedirs()
-        with open(self._props_path, 'w') as f:
-            json.dump(properties, f)
+        with self.lock(exclusive=True):
+            with atomic_write(self._meta_path) as f:
+                json.dump(meta, f)
+                f.flush()
+
+                current = file_state(os.fstat(f.fileno()))
+
+        CACHE.set(self._meta_path, [current, meta], weight=current[1])
 
     def get(self):
         ical = None
 
         # If path exists
-        if os.path.exists(self._path):
+        if watcher.exists(self._path):
             # Parse iCalendar object
             try:
-                with open(self._path) as f:
-                    ical = icalendar.Calendar.from_ical(f.read())
+                ical = parse(self._path)
 
-            except IOError:
+            except (IOError, OSError):
                 ical = None
 
         if not ical:
@@ -78,21 +318,221 @@ class Collection(ical.Collection):
 
         return ical
 
-    def write(self):
-        self._makedirs()
+    def get_raw(self):
+        try:
+            f = open(self._path, 'rb')
+        except IOError:
+            return None
+
+        size = os.fstat(f.fileno()).st_size
+
+        # Nothing written yet, an empty calendar must be generated
+        if not size:
+            f.close()
+            return None
+
+        return f, size
+
+    def get_index(self):
+        cached = CACHE.get(self._path)
+
+        # Share the index with the other users of the cached calendar
+        if cached and cached[1] is self.ical:
+            if cached[2] is None:
+                cached[2] = ical.Index(self.ical)
+
+            return cached[2]
+
+        return ical.Index(self.ical)
+
+    def parsed(self):
+        """ Tell whether the stored calendar is already parsed """
 
+        if self._ical is not None:
+            return True
+
+        try:
+            current = file_state(watcher.stat(self._path))
+        except OSError:
+            return False
+
+        cached = CACHE.get(self._path)
+        return bool(cached) and cached[0] == current
+
+    def offsets(self, f):
+        """
+            Return the tag and byte ranges of each item of the stored calendar
+            open as ``f``, by name. They are kept next to the calendar, and
+            found again by reading it whenever it changed.
+        """
+
+        current = list(file_state(os.fstat(f.fileno())))
+        cached = CACHE.get(self._offsets_path)
+
+        if cached and cached[0] == current:
+            return cached[1]
+
+        try:
+            with open(self._offsets_path) as stored:
+                text = stored.read()
+                offsets = json.loads(text)
+
+        except (IOError, ValueError):
+            offsets = None
+
+        if not offsets or offsets['signature'] != current:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                offsets = {'signature': current, 'items': scan(content)}
+            finally:
+                content.close()
+
+            text = json.dumps(offsets)
+
+            # Readers hold the shared lock, each would write the same ranges
+            with atomic_write(self._offsets_path) as stored:
+                stored.write(text)
+
+        CACHE.set(self._offsets_path, [current, offsets['items']], weight=len(text))
+        return offsets['items']
+
+    def read_slices(self, names=None, tag=None):
+        """
+            Return the tag and text of the items named ``names``, or tagged
+            ``tag``, by name, in the order of the stored calendar. Return None
+            if the calendar can't be read by slices.
+        """
+
+        with self.lock():
+            try:
+                f = open(self._path, 'rb')
+            except IOError:
+                return None
+
+            with f:
+                if not os.fstat(f.fileno()).st_size:
+                    return None
+
+                offsets = self.offsets(f)
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                if names is None:
+                    names = [name for name, (found, _) in offsets.items() if found == tag]
+
+                # Keep the order of the calendar
+                names = sorted(
+                    (name for name in names if name in offsets),
+                    key=lambda name: offsets[name][1][0][0]
+                )
+
+                slices = OrderedDict()
+
+                for name in names:
+                    found, ranges = offsets[name]
+                    slices[name] = found, ''.join(content[start:end] for start, end in ranges)
+
+            finally:
+                content.close()
+
+        return slices
+
+    def read_items(self, names=None, tag=None):
+        """
+            Return the items named ``names``, or tagged ``tag``, parsing only
+            their slices of the stored calendar. Return None if the calendar
+            can't be read by slices.
+        """
+
+        slices = self.read_slices(names, tag)
+
+        if slices is None:
+            return None
+
+        items = ical.ItemList()
+
+        for name, (found, text) in slices.items():
+            calendar = ical.parse('BEGIN:VCALENDAR\r\n{0}END:VCALENDAR\r\n'.format(text))
+            items.append(ical.item_type(found)(calendar, name))
+
+        # The metadata may have to be rebuilt, which takes the exclusive lock
+        for item in items:
+            item._etag = self.item_etag(item.name)
+
+        return items
+
+    def filter(self, wanted):
+        # Read the items of a single type by slices, unless already parsed
+        if wanted.tag and not self.parsed():
+            items = self.read_items(tag=wanted.tag)
+
+            if items is not None:
+                return items
+
+        return super(Collection, self).filter(wanted)
+
+    def get_item(self, name):
+        # Read the item alone, unless the calendar is already parsed
+        if not self.parsed():
+            items = self.read_items([name])
+
+            if items is not None:
+                return items[0] if items else None
+
+        return super(Collection, self).get_item(name)
+
+    def get_items(self, names):
+        # Map the calendar once for all the items
+        if not self.parsed():
+            items = self.read_items(names)
+
+            if items is not None:
+                return dict((item.name, item) for item in items)
+
+        return super(Collection, self).get_items(names)
+
+    def timezone_blocks(self, tzids=None):
+        # Share the timezones as stored, without parsing them
+        if not self.parsed():
+            slices = self.read_slices(tzids, ical.Timezone.tag)
+
+            if slices is not None:
+                # In the order of their TZID, as from the index
+                return [
+                    ical.share_timezone(name, text)
+                    for name, (found, text) in sorted(slices.items())
+                    if found == ical.Timezone.tag
+                ]
+
+        return super(Collection, self).timezone_blocks(tzids)
+
+    def write(self):
         content = self.text
 
-        with open(self._path, 'w') as f:
-            f.write(content)
+        with self.lock(exclusive=True):
+            with atomic_write(self._path) as f:
+                f.write(content)
+                f.flush()
+
+                current = file_state(os.fstat(f.fileno()))
+
+        # The internal calendar is what was just written, keep it for the
+        # next requests instead of parsing it again. Writers change copies
+        # of the cached calendars, readers can keep using them meanwhile.
+        CACHE.set(self._path, [current, self.ical, self.index], weight=current[1])
 
     def delete(self):
-        os.remove(self._path)
+        CACHE.pop(self._path)
+
+        with self.lock(exclusive=True):
+            os.remove(self._path)
+            watcher.invalidate(self._path)
 
     @classmethod
     def is_calendar(cls, path):
         abs_path = os.path.join(FOLDER, path.replace('/', os.sep))
-        return os.path.isdir(abs_path)
+        return watcher.isdir(abs_path)
 
     @classmethod
     def is_item(cls, path):
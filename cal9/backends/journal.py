@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+from cal9 import config
+from cal9 import ical
+from cal9 import metrics
+from cal9 import watcher
+from cal9.backends import filesystem
+from cal9.ical import Index, Timezone, component_name, parse, serialize
+from collections import OrderedDict
+
+import simplejson as json
+import threading
+import icalendar
+import logging
+import atexit
+import time
+import os
+
+FOLDER = filesystem.FOLDER
+
+logger = logging.getLogger(__name__)
+
+# Journals are compacted once they reach either limit
+JOURNAL_SIZE = (config.config.journal or {}).get('size', 1024 * 1024)
+JOURNAL_AGE = (config.config.journal or {}).get('age', 60)
+
+class Compactor(threading.Thread):
+    """ Fold the journals written by this process into their calendars """
+
+    def __init__(self):
+        super(Compactor, self).__init__(name='cal9-compactor')
+        self.daemon = True
+
+        self._paths = set()
+        self._condition = threading.Condition()
+        self._running = True
+
+    def schedule(self, path, now=False):
+        """ Check the journal of the collection at ``path`` from now on """
+
+        with self._condition:
+            self._paths.add(path)
+
+            if now:
+                self._condition.notify()
+
+    def stop(self):
+        """ Stop checking journals, they are replayed by the next reader """
+
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        self.join()
+
+    def run(self):
+        while self._running:
+            with self._condition:
+                self._condition.wait(JOURNAL_AGE)
+                paths = list(self._paths) if self._running else []
+
+            for path in paths:
+                collection = Collection(path)
+
+                try:
+                    if collection.compact(force=False):
+                        with self._condition:
+                            self._paths.discard(path)
+
+                except Exception:
+                    logger.exception("Failed to compact '%s'", path)
+
+# The compactor of each process, workers being forked
+_compactor = (None, None)
+_compactor_lock = threading.Lock()
+
+def compactor():
+    """ Return the compactor of the current process, started if needed """
+
+    global _compactor
+
+    with _compactor_lock:
+        pid, thread = _compactor
+
+        if pid != os.getpid():
+            thread = Compactor()
+            thread.start()
+
+            # Let it finish before the interpreter is torn down
+            atexit.register(thread.stop)
+
+            _compactor = (os.getpid(), thread)
+
+        return thread
+
+class Collection(filesystem.Collection):
+    """
+        Store a calendar as a snapshot file and a journal of the changes
+        made since, so that a change only appends a record to the journal.
+        Journals are folded into their snapshot in the background.
+    """
+
+    @property
+    def _journal_path(self):
+        """ Journal path on the computer """
+        return '{0}.journal'.format(self._path)
+
+    def _journal_state(self):
+        """ Identify the state of the journal, None if there is none """
+
+        try:
+            stat = watcher.stat(self._journal_path)
+        except OSError:
+            return None
+
+        return [stat.st_ino, stat.st_size]
+
+    def _log(self, name, ical):
+        """ Record that the item ``name`` is now ``ical``, or removed if None """
+
+        # The calendar must exist to be found
+        if not watcher.exists(self._path):
+            self.save()
+
+        record = {
+            'time': time.time(),
+            'name': name,
+            'ical': None if ical is None else serialize(ical),
+        }
+
+        with metrics.timed('write'):
+            with open(self._journal_path, 'a') as f:
+                f.write(json.dumps(record))
+                f.write('\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+                size = f.tell()
+
+        watcher.invalidate(self._journal_path)
+
+        compactor().schedule(self.path, now=size >= JOURNAL_SIZE)
+
+    def _replay(self, index, offset):
+        """
+            Apply the records of the journal found after ``offset`` to the
+            calendar of ``index``, and return the offset of the next record.
+        """
+
+        # Only the last record of each item matters
+        records = OrderedDict()
+
+        with open(self._journal_path) as f:
+            f.seek(offset)
+
+            for line in f:
+                # The last record may still be being written
+                if not line.endswith('\n'):
+                    break
+
+                offset += len(line)
+                record = json.loads(line)
+
+                records.pop(record['name'], None)
+                records[record['name']] = record['ical']
+
+        # Rebuild the index once for all the changed items
+        index.remove(*records.keys())
+
+        for text in records.values():
+            if text is None:
+                continue
+
+            for component in parse(text).subcomponents:
+                # Timezones are shared by all items
+                if component.name == Timezone.tag:
+                    if component_name(component) in index:
+                        continue
+
+                index.add(component)
+
+        return offset
+
+    @property
+    def last_modified(self):
+        # Create calendar if needed
+        if not watcher.exists(self._path):
+            self.save()
+
+        mtime = watcher.getmtime(self._path)
+
+        if watcher.exists(self._journal_path):
+            mtime = max(mtime, watcher.getmtime(self._journal_path))
+
+        modification_time = time.gmtime(mtime)
+        return time.strftime("%a, %d %b %Y %H:%M:%S +0000", modification_time)
+
+    @property
+    def signature(self):
+        snapshot = super(Collection, self).signature
+        journal = self._journal_state()
+
+        if snapshot is None and journal is None:
+            return None
+
+        return [snapshot, journal]
+
+    def get(self):
+        with self.lock():
+            snapshot = super(Collection, self).get()
+            journal = self._journal_state()
+
+            if journal is None:
+                return snapshot
+
+            current = [super(Collection, self).signature, journal[0]]
+            cached = filesystem.CACHE.get(self._journal_path)
+
+            if cached and cached[0][:2] == current and cached[0][2] <= journal[1]:
+                offset, ical, index = cached[0][2], cached[1], cached[2]
+
+                if offset == journal[1]:
+                    return ical
+
+                # Only replay the records written since, on a copy of the
+                # calendar other readers may be using
+                index = index.copy()
+                ical = index.ical
+
+            else:
+                # The snapshot is shared, replay on a copy of it
+                ical = icalendar.Calendar()
+                ical.update(snapshot)
+                ical.subcomponents = list(snapshot.subcomponents)
+
+                offset, index = 0, Index(ical)
+
+            offset = self._replay(index, offset)
+
+        filesystem.CACHE.set(
+            self._journal_path,
+            [current + [offset], ical, index],
+            weight=journal[1]
+        )
+
+        return ical
+
+    def get_raw(self):
+        with self.lock():
+            # The snapshot alone is out of date
+            if watcher.exists(self._journal_path):
+                return None
+
+            return super(Collection, self).get_raw()
+
+    def read_slices(self, names=None, tag=None):
+        with self.lock():
+            # The snapshot alone is out of date
+            if watcher.exists(self._journal_path):
+                return None
+
+            return super(Collection, self).read_slices(names, tag)
+
+    def get_index(self):
+        cached = filesystem.CACHE.get(self._journal_path)
+
+        # Share the index the journal was replayed with
+        if cached and cached[1] is self.ical:
+            return cached[2]
+
+        return super(Collection, self).get_index()
+
+    def write(self):
+        """ Write the internal calendar as the new snapshot, and drop the journal """
+
+        with self.lock(exclusive=True):
+            super(Collection, self).write()
+
+            filesystem.CACHE.pop(self._journal_path)
+
+            if watcher.exists(self._journal_path):
+                os.remove(self._journal_path)
+                watcher.invalidate(self._journal_path)
+
+    def compact(self, force=True):
+        """
+            Fold the journal into the snapshot, if ``force`` is True or if it
+            reached the size or age limit. Return True if there is no journal
+            left.
+        """
+
+        with self.lock(exclusive=True):
+            self.refresh()
+
+            journal = self._journal_state()
+
+            if journal is None:
+                return True
+
+            if not force and journal[1] < JOURNAL_SIZE:
+                with open(self._journal_path) as f:
+                    first = f.readline()
+
+                if first.endswith('\n') and time.time() - json.loads(first)['time'] < JOURNAL_AGE:
+                    return False
+
+            # The items do not change, only where they are stored
+            meta = dict(self.meta)
+            self.write()
+
+            meta['signature'] = self.signature
+            self.store_meta(meta)
+
+            return True
+
+    def delete(self):
+        filesystem.CACHE.pop(self._journal_path)
+
+        with self.lock(exclusive=True):
+            if watcher.exists(self._journal_path):
+                os.remove(self._journal_path)
+                watcher.invalidate(self._journal_path)
+
+            super(Collection, self).delete()
+
+    def append(self, name, ical):
+        """ Append item to the collection, recording it in the journal """
+
+        with self.recording() as changes:
+            changes[name] = []
+
+            for component in ical.subcomponents:
+                if component.name != Timezone.tag:
+                    # The item must be found by the name it was stored with
+                    component['X-CAL9-NAME'] = icalendar.vText(name)
+                    changes[name].append(component)
+
+            self._log(name, ical)
+
+        self._ical = None
+
+    def remove(self, name):
+        """ Remove item from collection, recording it in the journal """
+
+        with self.recording() as changes:
+            self._log(name, None)
+            changes[name] = None
+
+        self._ical = None
+
+    def replace(self, name, ical):
+        """ Replace item in collection, recording it in the journal """
+
+        self.append(name, ical)
+
+ical.Collection = Collection
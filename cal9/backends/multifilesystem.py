@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+from cal9 import ical
+from cal9 import watcher
+from cal9.backends import filesystem
+from cal9.ical import PRODID, VERSION, Timezone, Component
+from cal9.ical import Index, component_name, serialize
+from contextlib import contextmanager
+from urllib import quote, unquote
+
+import icalendar
+import logging
+import shutil
+import time
+import uuid
+import os
+
+FOLDER = filesystem.FOLDER
+
+logger = logging.getLogger(__name__)
+
+class Collection(filesystem.Collection):
+    """
+        Store a calendar as a folder containing one ``.ics`` file per item,
+        so that adding, replacing or removing an item only touches one file.
+    """
+
+    # Signature of the collection while it is locked for writing
+    _signature = None
+
+    @property
+    def _stamp_path(self):
+        """ Path of the stamp replaced each time the collection changes """
+        return os.path.join(self._path, '.stamp')
+
+    def _item_path(self, name):
+        """ Path on the computer of the item named ``name`` """
+
+        filename = quote(name, safe='@+=')
+
+        # Never let a name designate the folder itself or its parent
+        if filename.startswith('.'):
+            filename = '%2E{0}'.format(filename[1:])
+
+        return os.path.join(self._path, '{0}.ics'.format(filename))
+
+    def _item_names(self):
+        """ Names of the items stored in the collection """
+
+        if not watcher.isdir(self._path):
+            return []
+
+        return [
+            unquote(os.path.splitext(filename)[0])
+            for filename in sorted(watcher.listdir(self._path))
+            if filename.endswith('.ics')
+        ]
+
+    def _write_item(self, name, ical):
+        """ Write the iCalendar object ``ical`` as the item named ``name`` """
+
+        ical.set('prodid', PRODID)
+        ical.set('version', VERSION)
+
+        path = self._item_path(name)
+        filesystem.CACHE.pop(path)
+
+        with filesystem.atomic_write(path) as f:
+            f.write(serialize(ical))
+
+    def _makedirs(self):
+        watcher.makedirs(self._path)
+
+    @property
+    def last_modified(self):
+        # Create calendar if needed
+        self._makedirs()
+
+        modification_time = time.gmtime(self.signature[0])
+        return time.strftime("%a, %d %b %Y %H:%M:%S +0000", modification_time)
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        outermost = self._locked is None
+
+        with super(Collection, self).lock(exclusive):
+            try:
+                yield
+
+            finally:
+                # Other processes may change the collection once unlocked
+                if outermost:
+                    self._signature = None
+
+    def _stamp(self):
+        """ Replace the stamp of the collection, which changes its signature """
+
+        with filesystem.atomic_write(self._stamp_path) as f:
+            f.write(uuid.uuid4().hex)
+
+        # Found again on next use, with the files written along
+        self._signature = None
+
+    @property
+    def signature(self):
+        if self._signature is not None:
+            return self._signature
+
+        try:
+            with open(self._stamp_path) as f:
+                stamp = f.read()
+
+        except IOError:
+            stamp = None
+
+        mtime = self._mtime(full=stamp is None)
+        signature = None if mtime is None else [mtime, stamp]
+
+        # Only this object may change the collection until it is unlocked
+        if self._locked:
+            self._signature = signature
+
+        return signature
+
+    def _mtime(self, full=False):
+        """
+            Return the modification time of the collection, None if it does
+            not exist. Items modified in place, by other tools, do not change
+            the time of the folder : the times of all the items are looked at
+            if ``full`` is True, or if the watcher knows them without asking
+            the filesystem.
+        """
+
+        if not watcher.isdir(self._path):
+            return None
+
+        if full or watcher.watched(self._path):
+            return watcher.latest(self._path)
+
+        return watcher.getmtime(self._path)
+
+    def get(self):
+        current = self.signature
+        cached = filesystem.CACHE.get(self._path)
+
+        if cached and cached[0] == current:
+            return cached[1]
+
+        ical = icalendar.Calendar()
+        ical.set('prodid', PRODID)
+        ical.set('version', VERSION)
+
+        tzids = set()
+        size = 0
+
+        for name in self._item_names():
+            item_ical = self._read_item(name)
+
+            if item_ical is None:
+                continue
+
+            size += self._item_size(name)
+
+            for component in item_ical.subcomponents:
+                # Items share their timezones, keep only one definition
+                if component.name == Timezone.tag:
+                    if component.get('TZID') in tzids:
+                        continue
+
+                    tzids.add(component.get('TZID'))
+
+                ical.add_component(component)
+
+        if current:
+            # The calendar's index is built on first use, weighted as its files
+            filesystem.CACHE.set(self._path, [current, ical, None, size], weight=size)
+
+        return ical
+
+    def get_raw(self):
+        # Items are stored apart, the calendar must be assembled
+        return None
+
+    def _item_size(self, name):
+        """ Size of the file of the item named ``name``, 0 if there is none """
+
+        try:
+            return watcher.stat(self._item_path(name)).st_size
+        except OSError:
+            return 0
+
+    def _cache_change(self, before, name, components, delta):
+        """
+            Apply the change of the item ``name``, whose file grew by
+            ``delta`` bytes, to the cached calendar if it was up to date
+            before the change, instead of assembling it again on next use.
+        """
+
+        cached = filesystem.CACHE.get(self._path)
+
+        if not cached or cached[0] != before:
+            filesystem.CACHE.pop(self._path)
+            return
+
+        # Readers may be using the cached calendar, change a copy of it
+        index = (cached[2] or Index(cached[1])).copy()
+        index.remove(name)
+
+        for component in components:
+            # Items share their timezones, keep only one definition
+            if component.name == Timezone.tag:
+                if component_name(component) in index:
+                    continue
+
+            index.add(component)
+
+        size = cached[3] + delta
+        filesystem.CACHE.set(self._path, [self.signature, index.ical, index, size], weight=size)
+
+    def _read_item(self, name):
+        """ Parse the item named ``name``, None if it does not exist """
+
+        try:
+            return filesystem.parse(self._item_path(name))
+
+        except (IOError, OSError):
+            return None
+
+    def write(self):
+        """ Rewrite every item of the internal calendar into its own file """
+
+        items = {}
+
+        for item in self.items:
+            # Timezones are written along with the items referring to them
+            if not isinstance(item, Timezone):
+                items.setdefault(item.name, []).append(item)
+
+        for name, parts in items.items():
+            content = icalendar.Calendar()
+
+            # Each item only comes with the timezones it refers to
+            tzids = ical.tzids(
+                component for item in parts for component in item.ical.subcomponents
+            )
+
+            for tzid in sorted(tzids):
+                for component in self.index.components(tzid):
+                    if component.name == Timezone.tag:
+                        content.add_component(component)
+
+            for item in parts:
+                for component in item.ical.subcomponents:
+                    if not component.get('X-CAL9-NAME'):
+                        component['X-CAL9-NAME'] = icalendar.vText(name)
+
+                    content.add_component(component)
+
+            self._write_item(name, content)
+
+        # Remove the items which are not in the calendar anymore
+        for name in self._item_names():
+            if name not in items:
+                filesystem.CACHE.pop(self._item_path(name))
+                os.remove(self._item_path(name))
+                watcher.invalidate(self._item_path(name))
+
+        self._stamp()
+
+    def delete(self):
+        filesystem.CACHE.pop(self._path)
+
+        with self.lock(exclusive=True):
+            for name in self._item_names():
+                filesystem.CACHE.pop(self._item_path(name))
+
+            shutil.rmtree(self._path)
+            watcher.forget(self._path)
+
+    def append(self, name, ical):
+        """ Append item to the collection, writing only its own file """
+
+        with self.recording() as changes:
+            changes[name] = []
+
+            for component in ical.subcomponents:
+                # The file name is the item's name, keep them in sync
+                if component.name != Timezone.tag:
+                    component['X-CAL9-NAME'] = icalendar.vText(name)
+                    changes[name].append(component)
+
+            before = self.signature
+            delta = -self._item_size(name)
+
+            self._write_item(name, ical)
+            delta += self._item_size(name)
+
+            self._stamp()
+            self._cache_change(before, name, ical.subcomponents, delta)
+
+        self._ical = None
+
+    def extend(self, items):
+        """ Append or replace many items, writing only their own files """
+
+        with self.recording() as changes:
+            for name, item_ical in items.items():
+                changes[name] = []
+
+                for component in item_ical.subcomponents:
+                    # The file name is the item's name, keep them in sync
+                    if component.name != Timezone.tag:
+                        component['X-CAL9-NAME'] = icalendar.vText(name)
+                        changes[name].append(component)
+
+                self._write_item(name, item_ical)
+
+            self._stamp()
+
+            # Assembled again on next use
+            filesystem.CACHE.pop(self._path)
+
+        self._ical = None
+
+    def remove(self, name):
+        """ Remove item from collection, deleting only its own file """
+
+        path = self._item_path(name)
+        filesystem.CACHE.pop(path)
+
+        with self.recording() as changes:
+            before = self.signature
+            delta = -self._item_size(name)
+
+            try:
+                os.remove(path)
+                watcher.invalidate(path)
+            except OSError:
+                logger.debug("Item '%s' not found in '%s'", name, self.path)
+
+            self._stamp()
+            self._cache_change(before, name, [], delta)
+            changes[name] = None
+
+        self._ical = None
+
+    def replace(self, name, ical):
+        """ Replace item in collection, overwriting only its own file """
+
+        self.append(name, ical)
+
+    def read_slices(self, names=None, tag=None):
+        # Items are stored in their own files, not as slices of a calendar
+        return None
+
+    def get_item(self, name):
+        """ Get item named ``name`` without reading the other items """
+
+        item_ical = self._read_item(name)
+
+        if item_ical is None:
+            return None
+
+        # Timezones are served along with the item by the caller
+        content = icalendar.Calendar()
+        item_type = None
+
+        for component in item_ical.subcomponents:
+            if component.name != Timezone.tag:
+                content.add_component(component)
+
+                if issubclass(ical.item_type(component.name), Component):
+                    item_type = item_type or ical.item_type(component.name)
+
+        if item_type:
+            item = item_type(content, name)
+            item._etag = self.item_etag(name)
+
+            return item
+
+ical.Collection = Collection
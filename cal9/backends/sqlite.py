@@ -0,0 +1,664 @@
+# -*- coding: utf-8 -*-
+
+from cal9 import config
+from cal9 import ical
+from cal9 import metrics
+from cal9 import timerange
+from cal9.ical import ItemList, Index, Timezone, SYNC_TOKEN_PREFIX
+from cal9.ical import digest, component_name, parse, serialize
+
+from contextlib import contextmanager
+
+import simplejson as json
+import threading
+import icalendar
+import logging
+import sqlite3
+import time
+import uuid
+import os
+
+DATABASE = config.config.calendars.database
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS collections (
+        path TEXT PRIMARY KEY,
+        id TEXT NOT NULL,
+        generation INTEGER NOT NULL,
+        horizon INTEGER NOT NULL,
+        modified REAL NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS items (
+        collection TEXT NOT NULL,
+        name TEXT NOT NULL,
+        uid TEXT,
+        tag TEXT NOT NULL,
+        etag TEXT NOT NULL,
+        dtstart TEXT,
+        dtend TEXT,
+        modseq INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (collection, name)
+    );
+
+    CREATE INDEX IF NOT EXISTS items_uid ON items (collection, uid);
+    CREATE INDEX IF NOT EXISTS items_range ON items (collection, tag, dtstart, dtend);
+    CREATE INDEX IF NOT EXISTS items_modseq ON items (collection, modseq);
+
+    CREATE TABLE IF NOT EXISTS tombstones (
+        collection TEXT NOT NULL,
+        name TEXT NOT NULL,
+        modseq INTEGER NOT NULL,
+        PRIMARY KEY (collection, name)
+    );
+
+    CREATE INDEX IF NOT EXISTS tombstones_modseq ON tombstones (collection, modseq);
+
+    CREATE TABLE IF NOT EXISTS props (
+        collection TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (collection, name)
+    );
+"""
+
+# Tables the schema creates, all missing from a new database
+TABLES = ('collections', 'items', 'tombstones', 'props')
+
+# One connection per thread, and per process since workers are forked
+_local = threading.local()
+
+# Process in which the schema was checked
+_schema = None
+_schema_lock = threading.Lock()
+
+def create_schema(connection):
+    """
+        Create the schema if the database is new, once per process. The
+        first connections of other processes wait for it to be complete
+        instead of changing it under each other.
+    """
+
+    global _schema
+
+    with _schema_lock:
+        if _schema == os.getpid():
+            return
+
+        # Kept by the database: readers are not blocked by writers, even in other processes
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            found = connection.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN ({0})".format(
+                    ', '.join('?' * len(TABLES))
+                ),
+                TABLES
+            ).fetchone()[0]
+
+            # ``executescript`` would commit first, run each statement alone
+            if found < len(TABLES):
+                for statement in SCHEMA.split(';'):
+                    if statement.strip():
+                        connection.execute(statement)
+
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+        else:
+            connection.execute('COMMIT')
+
+        _schema = os.getpid()
+
+def connect():
+    """ Return the connection of the current thread to the database """
+
+    pid, connection = getattr(_local, 'connection', (None, None))
+
+    if pid != os.getpid():
+        logger.debug("Opening database '%s'", DATABASE)
+
+        directory = os.path.dirname(DATABASE)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Transactions are handled explicitly, see ``transaction()``
+        connection = sqlite3.connect(DATABASE, timeout=30, isolation_level=None)
+
+        connection.execute('PRAGMA synchronous=NORMAL')
+        create_schema(connection)
+
+        _local.connection = (os.getpid(), connection)
+
+    return connection
+
+@contextmanager
+def transaction():
+    """
+        Run the managed block in a write transaction, or in the one the
+        current thread is already in.
+    """
+
+    connection = connect()
+
+    # Nested, as under ``Collection.lock``
+    if getattr(_local, 'transaction', False):
+        yield connection
+        return
+
+    with metrics.timed('write'):
+        # Take the write lock now, not on first write, to never fail upgrading
+        connection.execute('BEGIN IMMEDIATE')
+        _local.transaction = True
+
+        try:
+            yield connection
+
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+        else:
+            connection.execute('COMMIT')
+
+        finally:
+            _local.transaction = False
+
+def timestamp(value):
+    """ Store a bound of a time-range, None standing for an open bound """
+
+    if value in (timerange.MIN, timerange.MAX):
+        return None
+
+    return value.isoformat()
+
+def bounds(components):
+    """
+        Return the (start, end) range covering every occurrence of
+        ``components``, or None if they match no time-range.
+    """
+
+    starts, ends = [], []
+
+    for component in components:
+        try:
+            ranges = timerange.expand(component)
+
+        except (ValueError, TypeError, AttributeError):
+            # Let clients sort out the components we can't understand
+            return timerange.MIN, timerange.MAX
+
+        if isinstance(ranges, timerange.Recurrence):
+            ranges = [(timerange.component_range(component)[0], timerange.MAX)]
+
+        for start, end in ranges or []:
+            starts.append(start)
+            ends.append(end)
+
+    if starts:
+        return min(starts), max(ends)
+
+class Collection(ical.BaseCollection):
+    """
+        Store calendars in a SQLite database, one row per item. Lookups,
+        time-range queries and changes are answered by indexed queries
+        instead of parsing whole calendars.
+    """
+
+    @property
+    def _key(self):
+        """ Key of the collection in the database """
+
+        return self.path.strip('/')
+
+    def _row(self):
+        """ Row of the collection, created if needed """
+
+        connection = connect()
+        query = 'SELECT id, generation, horizon, modified FROM collections WHERE path = ?'
+
+        row = connection.execute(query, (self._key,)).fetchone()
+
+        if row is None:
+            connection.execute(
+                'INSERT OR IGNORE INTO collections VALUES (?, ?, 0, 0, ?)',
+                (self._key, str(uuid.uuid4()), time.time())
+            )
+
+            row = connection.execute(query, (self._key,)).fetchone()
+
+        return row
+
+    def _bump(self, connection):
+        """ Start a new generation of the collection, and return it """
+
+        self._row()
+
+        connection.execute(
+            'UPDATE collections SET generation = generation + 1, modified = ? WHERE path = ?',
+            (time.time(), self._key)
+        )
+
+        return connection.execute(
+            'SELECT generation FROM collections WHERE path = ?',
+            (self._key,)
+        ).fetchone()[0]
+
+    def _store(self, connection, name, components, generation):
+        """ Store ``components`` as the item named ``name`` """
+
+        content = icalendar.Calendar()
+
+        for component in components:
+            content.add_component(component)
+
+        if components[0].name == Timezone.tag:
+            range_ = None
+        else:
+            range_ = bounds(components)
+
+        start, end = range_ or (None, None)
+        uid = components[0].get('UID')
+
+        connection.execute(
+            'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                self._key,
+                name,
+                uid and unicode(uid),
+                components[0].name,
+                digest(components),
+                start and timestamp(start),
+                end and timestamp(end),
+                generation,
+                serialize(content).decode('utf-8'),
+            )
+        )
+
+        connection.execute(
+            'DELETE FROM tombstones WHERE collection = ? AND name = ?',
+            (self._key, name)
+        )
+
+    def _discard(self, connection, name, generation):
+        """ Remove the item named ``name``, leaving a tombstone """
+
+        cursor = connection.execute(
+            'DELETE FROM items WHERE collection = ? AND name = ?',
+            (self._key, name)
+        )
+
+        if not cursor.rowcount:
+            logger.debug("Item '%s' not found in '%s'", name, self.path)
+            return
+
+        connection.execute(
+            'INSERT OR REPLACE INTO tombstones VALUES (?, ?, ?)',
+            (self._key, name, generation)
+        )
+
+        self._prune_tombstones(connection)
+
+    def _prune_tombstones(self, connection):
+        """ Forget the oldest removals once there are too many of them """
+
+        limit = (config.config.sync or {}).get('tombstones', 1000)
+
+        oldest = connection.execute(
+            'SELECT name, modseq FROM tombstones WHERE collection = ? ORDER BY modseq DESC LIMIT -1 OFFSET ?',
+            (self._key, limit)
+        ).fetchall()
+
+        if oldest:
+            connection.executemany(
+                'DELETE FROM tombstones WHERE collection = ? AND name = ?',
+                [(self._key, name) for name, modseq in oldest]
+            )
+
+            # Changes since before these removals can't be told anymore
+            connection.execute(
+                'UPDATE collections SET horizon = MAX(horizon, ?) WHERE path = ?',
+                (max(modseq for name, modseq in oldest), self._key)
+            )
+
+    def _rows(self, columns, where='', args=(), order='rowid'):
+        """ Select ``columns`` of the items of the collection """
+
+        return connect().execute(
+            'SELECT {0} FROM items WHERE collection = ? {1} ORDER BY {2}'.format(columns, where, order),
+            (self._key,) + tuple(args)
+        )
+
+    ## Collection properties
+
+    @property
+    def etag(self):
+        row = self._row()
+        return '"{0}-{1}"'.format(row[0], row[1])
+
+    @property
+    def names(self):
+        return [name for name, in self._rows('name', 'AND tag != ?', [Timezone.tag])]
+
+    @property
+    def sync_token(self):
+        row = self._row()
+        return '{0}{1}:{2}'.format(SYNC_TOKEN_PREFIX, row[0], row[1])
+
+    @property
+    def last_modified(self):
+        # Create calendar if needed
+        modification_time = time.gmtime(self._row()[3])
+        return time.strftime("%a, %d %b %Y %H:%M:%S +0000", modification_time)
+
+    @property
+    def properties(self):
+        return dict(
+            (name, json.loads(value))
+            for name, value in connect().execute(
+                'SELECT name, value FROM props WHERE collection = ?',
+                (self._key,)
+            )
+        )
+
+    @property
+    @contextmanager
+    def props(self):
+        with transaction() as connection:
+            original = self.properties
+            properties = dict(original)
+
+            yield properties
+
+            # Save properties, if changed
+
+            for name in set(original) - set(properties):
+                connection.execute(
+                    'DELETE FROM props WHERE collection = ? AND name = ?',
+                    (self._key, name)
+                )
+
+            connection.executemany('INSERT OR REPLACE INTO props VALUES (?, ?, ?)', [
+                (self._key, name, json.dumps(value))
+                for name, value in properties.items()
+                if original.get(name) != value
+            ])
+
+    ## Collection method
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        # Readers see the last committed state, writers hold the database's
+        # write lock, which changes made meanwhile share
+        if not exclusive:
+            yield
+            return
+
+        with transaction():
+            yield
+
+    def get(self):
+        ical = icalendar.Calendar()
+
+        # Timezones first, for the items to refer to them
+        for content, in self._rows('content', order="tag = 'VTIMEZONE' DESC, rowid"):
+            for component in parse(content).subcomponents:
+                ical.add_component(component)
+
+        return ical
+
+    def write(self):
+        """ Store the internal calendar, item by item """
+
+        index = Index(self.ical)
+
+        with transaction() as connection:
+            generation = self._bump(connection)
+
+            stored = dict(self._rows('name, etag'))
+
+            for name in index.names():
+                components = index.components(name)
+
+                if stored.get(name) != digest(components):
+                    self._store(connection, name, components, generation)
+
+            for name in stored:
+                if name not in index:
+                    self._discard(connection, name, generation)
+
+    def delete(self):
+        with transaction() as connection:
+            for table in ('items', 'tombstones', 'props'):
+                connection.execute(
+                    'DELETE FROM {0} WHERE collection = ?'.format(table),
+                    (self._key,)
+                )
+
+            connection.execute('DELETE FROM collections WHERE path = ?', (self._key,))
+
+    def _append(self, connection, name, ical, generation):
+        """ Store the item ``name`` and the timezones it comes with """
+
+        components = []
+
+        for component in ical.subcomponents:
+            if component.name == Timezone.tag:
+                # Timezones are shared by all items
+                tzid = component_name(component)
+
+                if not self._rows('1', 'AND name = ?', [tzid]).fetchone():
+                    self._store(connection, tzid, [component], generation)
+
+            else:
+                # The item must be found by the name it was stored with
+                component['X-CAL9-NAME'] = icalendar.vText(name)
+                components.append(component)
+
+        if components:
+            self._store(connection, name, components, generation)
+
+    def append(self, name, ical):
+        """ Append item to the collection, storing only its own row """
+
+        with transaction() as connection:
+            self._append(connection, name, ical, self._bump(connection))
+
+        self._ical = None
+
+    def extend(self, items):
+        """ Append or replace many items in a single transaction """
+
+        with transaction() as connection:
+            generation = self._bump(connection)
+
+            for name, item_ical in items.items():
+                self._append(connection, name, item_ical, generation)
+
+        self._ical = None
+
+    def remove(self, name):
+        """ Remove item from collection, deleting only its own row """
+
+        with transaction() as connection:
+            self._discard(connection, name, self._bump(connection))
+
+        self._ical = None
+
+    def replace(self, name, ical):
+        """ Replace item in collection, overwriting only its own row """
+
+        self.append(name, ical)
+
+    def changes_since(self, token):
+        collection_id, generation, horizon, modified = self._row()
+
+        if not token:
+            return sorted(self.names), []
+
+        prefix = '{0}{1}:'.format(SYNC_TOKEN_PREFIX, collection_id)
+
+        if not token.startswith(prefix):
+            raise ValueError('Unknown sync token: {0}'.format(token))
+
+        since = int(token[len(prefix):])
+
+        if not horizon <= since <= generation:
+            raise ValueError('Expired sync token: {0}'.format(token))
+
+        changed = self._rows('name', 'AND tag != ? AND modseq > ?', [Timezone.tag, since])
+
+        removed = connect().execute(
+            'SELECT name FROM tombstones WHERE collection = ? AND modseq > ?',
+            (self._key, since)
+        )
+
+        return sorted(name for name, in changed), sorted(name for name, in removed)
+
+    def item_etag(self, name):
+        row = self._rows('etag', 'AND name = ? AND tag != ?', [name, Timezone.tag]).fetchone()
+        return row and row[0]
+
+    def item_etags(self, names):
+        names = list(names)
+        where = 'AND name IN ({0}) AND tag != ?'.format(', '.join('?' * len(names)))
+
+        return dict(self._rows('name, etag', where, names + [Timezone.tag]))
+
+    def _overlapping(self, columns, tag, start=None, end=None):
+        """ Rows of the items whose bounds overlap the time-range, open bounds being NULL """
+
+        where, args = 'AND tag = ?', [tag]
+
+        if end is not None:
+            where += ' AND (dtstart IS NULL OR dtstart <= ?)'
+            args.append(timestamp(end))
+
+        if start is not None:
+            where += ' AND (dtend IS NULL OR dtend >= ?)'
+            args.append(timestamp(start))
+
+        return self._rows(columns, where, args)
+
+    def query(self, tag, start=None, end=None):
+        if start is None and end is None:
+            return set(name for name, in self._rows('name', 'AND tag = ?', [tag]))
+
+        # Bounds span all the occurrences, check them one by one
+        index = timerange.TimeRangeIndex()
+
+        for name, content in self._overlapping('name, content', tag, start, end):
+            for component in parse(content).subcomponents:
+                if component.name == tag:
+                    index.add(name, component)
+
+        return index.query(start, end)
+
+    def busy(self, start, end):
+        """ Merge the busy time of the events whose bounds overlap [start, end) """
+
+        index = timerange.BusyIndex()
+
+        for name, content in self._overlapping('name, content', ical.Event.tag, start, end):
+            index.set(name, parse(content).subcomponents)
+
+        return index.query(start, end)
+
+    def get_item(self, name):
+        """ Get item named ``name`` without reading the other items """
+
+        row = self._rows('tag, etag, content', 'AND name = ? AND tag != ?', [name, Timezone.tag]).fetchone()
+
+        if row:
+            tag, etag, content = row
+
+            item = ical.item_type(tag)(content, name)
+            item._etag = etag
+
+            return item
+
+    def get_items(self, names):
+        """ Get the items named ``names`` in a single query """
+
+        names = list(names)
+        where = 'AND name IN ({0}) AND tag != ?'.format(', '.join('?' * len(names)))
+        items = {}
+
+        for name, tag, etag, content in self._rows('name, tag, etag, content', where, names + [Timezone.tag]):
+            items[name] = ical.item_type(tag)(content, name)
+            items[name]._etag = etag
+
+        return items
+
+    def timezone_blocks(self, tzids=None):
+        """ Get the timezones from their own rows, parsing only the unregistered ones """
+
+        where, args = 'AND tag = ?', [Timezone.tag]
+
+        if tzids is not None:
+            tzids = list(tzids)
+            where += ' AND name IN ({0})'.format(', '.join('?' * len(tzids)))
+            args += tzids
+
+        blocks = []
+
+        for name, etag, content in self._rows('name, etag, content', where, args, order='name'):
+            # Rows are tagged by their ETag, the SHA-1 of their text
+            block = ical.TIMEZONES.get((name, etag.strip('"')))
+
+            if block is None:
+                block = ical.share_timezone(name, serialize(parse(content).subcomponents[0]))
+
+            blocks.append(block)
+
+        return blocks
+
+    ## Filtering components
+
+    def filter(self, wanted):
+        """ Filter items, ``wanted`` is a class derivated from Item """
+
+        items = ItemList()
+
+        if wanted.tag:
+            rows = self._rows('name, tag, etag, content', 'AND tag = ?', [wanted.tag])
+        else:
+            rows = self._rows('name, tag, etag, content')
+
+        for name, tag, etag, content in rows:
+            item = ical.item_type(tag)(content, name)
+
+            # Timezones have no ETag, as in the other backends
+            if tag != Timezone.tag:
+                item._etag = etag
+
+            items.append(item)
+
+        return items
+
+    @classmethod
+    def is_calendar(cls, path):
+        prefix = '{0}/'.format(path.strip('/'))
+
+        row = connect().execute(
+            'SELECT 1 FROM collections WHERE substr(path, 1, ?) = ? LIMIT 1',
+            (len(prefix), prefix)
+        ).fetchone()
+
+        return row is not None
+
+    @classmethod
+    def is_item(cls, path):
+        row = connect().execute(
+            'SELECT 1 FROM collections WHERE path = ?',
+            (path.strip('/'),)
+        ).fetchone()
+
+        return row is not None
+
+ical.Collection = Collection
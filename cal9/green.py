@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Serve 9cal with gevent, Python 2 having no asyncio to build an ASGI
+    front end upon. Each connection is a greenlet, so idle and slow clients
+    cost no thread, while the request handlers of ``cal9.app`` run in a
+    bounded pool of threads.
+
+    Usage :
+
+        python -m cal9.green /path/to/config.json
+
+    The ``server`` section of the configuration sets the ``host`` and
+    ``port`` to listen on, the number of ``threads`` handling requests and
+    the maximum number of open ``connections``.
+
+    Nothing is monkey-patched: the backends keep using real threads, locks
+    and blocking I/O, which only ever run in the thread pool.
+"""
+
+from cal9 import app
+from cal9 import config
+
+from gevent.threadpool import ThreadPool
+from gevent.pywsgi import WSGIServer
+from gevent.pool import Pool
+from StringIO import StringIO
+
+import sys
+
+class Application(app.Application):
+    """ Application handling requests in a pool of threads """
+
+    def __init__(self, confpath):
+        super(Application, self).__init__(confpath)
+
+        self.pool = ThreadPool((config.config.server or {}).get('threads', 16))
+
+    def manage(self, environ):
+        # Read the request body in the connection's greenlet, a slow client
+        # must not hold a thread
+        content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        environ['wsgi.input'] = StringIO(environ['wsgi.input'].read(content_length))
+
+        manage = super(Application, self).manage
+        status, headers, content = self.pool.apply(manage, (environ,))
+
+        if not isinstance(content, list):
+            content = self.iterate(content)
+
+        return status, headers, content
+
+    def iterate(self, content):
+        """ Produce the chunks of a streamed body in the thread pool """
+
+        chunks = iter(content)
+
+        try:
+            while True:
+                chunk = self.pool.apply(next, (chunks, None))
+
+                if chunk is None:
+                    break
+
+                yield chunk
+
+        finally:
+            if hasattr(content, 'close'):
+                content.close()
+
+def main(argv):
+    if len(argv) < 2:
+        print >>sys.stderr, __doc__
+        return 1
+
+    application = Application(argv[1])
+    server = config.config.server or {}
+
+    listener = (server.get('host', 'localhost'), server.get('port', 8000))
+    connections = Pool(server.get('connections', 10000))
+
+    WSGIServer(listener, application, spawn=connections).serve_forever()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,11 +1,33 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from contextlib import contextmanager
+from datetime import datetime
 import icalendar
+import pytz
+import hashlib
+import uuid
+
+from util import LRUCache
+import timerange
+import metrics
+import config
 
 PRODID = "-//9cal//9h37 CalDAV server//"
 VERSION = "2.0"
 
+SYNC_TOKEN_PREFIX = 'urn:x-cal9:sync:'
+
+# Properties defining the occurrences of a recurring component
+RECURRENCE_PROPERTIES = ('RRULE', 'RDATE', 'EXRULE', 'EXDATE')
+
+# Date properties moved along with an occurrence
+OCCURRENCE_DATES = ('DTSTART', 'DTEND', 'DUE', 'RECURRENCE-ID')
+
+# Serialized timezones shared by all calendars, by TZID and SHA-1 of their text
+TIMEZONES = LRUCache(1024 * 1024)
+metrics.CACHES['timezones'] = TIMEZONES
+
 class Item(object):
     """ Abstract class which define an iCal object """
 
@@ -13,50 +35,83 @@ class Item(object):
     mimetype = None
 
     def __init__(self, text, name=None):
-        self.ical = icalendar.Calendar.from_ical(text)
+        """ ``text`` is the item as text, or as an already parsed calendar """
+
+        if isinstance(text, icalendar.Calendar):
+            self.ical = text
+        else:
+            self.ical = parse(text)
+
         self._name = name
+        self._etag = None
 
-        if not self._name:
-            # Try to find the element's name
+        # Find the element's name, and the component defining it, in a
+        # single walk
 
-            for c in self.ical.walk():
-                if c.get('X-CAL9-NAME'):
-                    self._name = str(c.get('X-CAL9-NAME'))
-                    break
+        found = self._name
+        settled = bool(found)
+        named = None
 
-                elif c.get('TZID'):
-                    self._name = str(c.get('TZID'))
-                    break
+        for c in self.ical.walk():
+            if c.get('X-CAL9-NAME'):
+                named = c
+                found = found if settled else str(c.get('X-CAL9-NAME'))
+                break
+
+            elif settled:
+                continue
 
-                elif c.get('UID'):
-                    self._name = str(c.get('UID'))
-                    # Do not break, X-CAL9-NAME can still appear
+            elif c.get('TZID'):
+                found = str(c.get('TZID'))
+                settled = True
 
-        if not self._name:
-            # The name is still not found, define one
-            import uuid
+            elif c.get('UID'):
+                found = str(c.get('UID'))
+                # Do not stop, X-CAL9-NAME can still appear
 
-            self._name = str(uuid.uuid4())
+        # Define a name if none was found
+        self._name = found or str(uuid.uuid4())
 
         # Now redefine the X-CAL9-NAME property
 
-        for c in self.ical.walk():
-            if c.get('X-CAL9-NAME'):
-                c['X-CAL9-NAME'] = icalendar.vText(self._name)
-                break
-        else:
+        if named is None:
             self.ical['X-CAL9-NAME'] = icalendar.vText(self._name)
 
+        elif named.get('X-CAL9-NAME') != self._name:
+            named['X-CAL9-NAME'] = icalendar.vText(self._name)
+
     @property
     def etag(self):
-        return '"{0}"'.format(hash(self.ical.to_ical()))
+        """ ETag stored by the collection, or computed from the content """
+
+        if self._etag is None:
+            self._etag = digest(self.ical.subcomponents)
+
+        return self._etag
 
     @property
     def name(self):
         return self._name
 
+    def copy(self):
+        """
+            Return a copy of the item whose components can be changed, the
+            components of this one being shared with the collection's calendar
+        """
+
+        calendar = icalendar.Calendar()
+        calendar.update(self.ical)
+
+        for component in self.ical.subcomponents:
+            calendar.add_component(copy_component(component))
+
+        item = self.__class__(calendar, self._name)
+        item._etag = self._etag
+
+        return item
+
     def to_ical(self):
-        return self.ical.to_ical()
+        return serialize(self.ical)
 
 class Component(Item):
     pass
@@ -77,6 +132,405 @@ class Timezone(Item):
     tag = 'VTIMEZONE'
 
 
+def parse(text):
+    """ Parse the iCalendar ``text``, accounting for it in the metrics """
+
+    with metrics.timed('parse'):
+        ical = icalendar.Calendar.from_ical(text)
+
+    metrics.count('cal9_parsed_bytes_total', len(text))
+    return ical
+
+def serialize(component):
+    """ Serialize ``component``, accounting for it in the metrics """
+
+    with metrics.timed('serialize'):
+        text = component.to_ical()
+
+    metrics.count('cal9_serialized_bytes_total', len(text))
+    return text
+
+def calendar_text(blocks):
+    """ Wrap the serialized components ``blocks`` into a calendar """
+
+    return 'BEGIN:VCALENDAR\r\nVERSION:{0}\r\nPRODID:{1}\r\n{2}END:VCALENDAR\r\n'.format(
+        VERSION, PRODID, ''.join(blocks)
+    )
+
+def share_timezone(tzid, text):
+    """
+        Return the registered copy of ``text``, the serialized VTIMEZONE of
+        ``tzid``, registering it if it is the first.
+    """
+
+    key = tzid, hashlib.sha1(text).hexdigest()
+    shared = TIMEZONES.get(key)
+
+    if shared is None:
+        TIMEZONES.set(key, text, weight=len(text))
+        shared = text
+
+    return shared
+
+def digest(components):
+    """ Return an ETag derived from the content of ``components`` """
+
+    content = ''.join(serialize(component) for component in components)
+    return '"{0}"'.format(hashlib.sha1(content).hexdigest())
+
+def copy_meta(meta):
+    """ Copy the metadata ``meta`` of a collection, to change it """
+
+    meta = dict(meta)
+
+    for key in ('etags', 'changes', 'tombstones'):
+        meta[key] = dict(meta[key])
+
+    return meta
+
+def copy_component(component):
+    """ Copy ``component``, sharing the values of its properties and its subcomponents """
+
+    copy = component.__class__()
+    copy.update(component)
+    copy.subcomponents = list(component.subcomponents)
+
+    return copy
+
+def component_name(component):
+    """ Return the name of a calendar's top-level ``component`` """
+
+    for key in ('X-CAL9-NAME', 'TZID', 'UID'):
+        if component.get(key):
+            return str(component.get(key))
+
+# Subclass of Item matching each component's tag
+ITEM_TYPES = dict(
+    (t.tag, t) for t in Component.__subclasses__() + Item.__subclasses__()
+    if t.tag
+)
+
+def item_type(tag):
+    """ Return the subclass of Item matching the component's ``tag`` """
+
+    return ITEM_TYPES.get(tag, Item)
+
+def tzids(components):
+    """ Return the TZIDs the properties of ``components`` refer to """
+
+    found = set()
+
+    for component in components:
+        for subcomponent in component.walk():
+            for value in subcomponent.values():
+                # Properties given several times are listed
+                for prop in (value if isinstance(value, list) else [value]):
+                    params = getattr(prop, 'params', None)
+
+                    if params and params.get('TZID'):
+                        found.add(str(params['TZID']))
+
+    return found
+
+def utc_value(value, date_only=False):
+    """ Property value of the naive UTC datetime ``value``, as a date if ``date_only`` """
+
+    if date_only:
+        return icalendar.vDate(value.date())
+
+    return icalendar.vDatetime(value.replace(tzinfo=pytz.utc))
+
+def occurrence(component, start=None):
+    """
+        Copy ``component`` without its recurrence rules and with its dates in
+        UTC, as its occurrence starting at ``start`` if given.
+    """
+
+    copy = component.__class__()
+    copy.subcomponents = list(component.subcomponents)
+
+    for key, value in component.items():
+        if key not in RECURRENCE_PROPERTIES:
+            copy[key] = value
+
+    dtstart = component.get('DTSTART')
+    delta = start - timerange.utc(dtstart.dt) if start is not None else None
+
+    for key in OCCURRENCE_DATES:
+        if key in component:
+            value = component[key].dt
+            moved = timerange.utc(value) + delta if delta is not None else timerange.utc(value)
+
+            copy[key] = utc_value(moved, not isinstance(value, datetime))
+
+    if start is not None:
+        copy['RECURRENCE-ID'] = utc_value(start, not isinstance(dtstart.dt, datetime))
+
+    return copy
+
+def free_busy(busy, start, end):
+    """
+        Serialize the busy periods of [start, end), ``busy`` mapping free/busy
+        types to periods, as a VFREEBUSY component [RFC 4791 7.10].
+    """
+
+    calendar = icalendar.Calendar()
+    calendar.set('prodid', PRODID)
+    calendar.set('version', VERSION)
+
+    component = icalendar.FreeBusy()
+    component['DTSTAMP'] = utc_value(datetime.utcnow().replace(microsecond=0))
+    component['DTSTART'] = utc_value(start)
+    component['DTEND'] = utc_value(end)
+
+    for fbtype in sorted(busy):
+        for period_start, period_end in busy[fbtype]:
+            period = icalendar.vPeriod((
+                period_start.replace(tzinfo=pytz.utc),
+                period_end.replace(tzinfo=pytz.utc)
+            ))
+            period.params['FBTYPE'] = fbtype
+
+            # Periods in UTC need no timezone
+            period.params.pop('TZID', None)
+
+            component.add('FREEBUSY', period, encode=0)
+
+    calendar.add_component(component)
+
+    return serialize(calendar)
+
+def affects(component, start, end):
+    """ Check if the overridden occurrence ``component`` is in [start, end) """
+
+    bounds = timerange.component_range(component)
+    recurrence_id = timerange.utc(component['RECURRENCE-ID'].dt)
+
+    return (
+        start <= recurrence_id < end
+        or bounds is not None and timerange.overlaps(bounds[0], bounds[1], start, end)
+    )
+
+def expand(item, start, end):
+    """
+        Serialize ``item`` with its recurring components replaced by their
+        occurrences overlapping [start, end), and its dates in UTC
+        [RFC 4791 9.6.5]. Occurrences are cached by the item's ETag.
+    """
+
+    calendar = icalendar.Calendar()
+    calendar.update(item.ical)
+
+    components = [c for c in item.ical.subcomponents if c.name != Timezone.tag]
+
+    overridden = set(
+        (str(c.get('UID')), timerange.utc(c['RECURRENCE-ID'].dt))
+        for c in components if 'RECURRENCE-ID' in c
+    )
+
+    for position, component in enumerate(components):
+        try:
+            if 'RECURRENCE-ID' in component:
+                instances = [occurrence(component)] if affects(component, start, end) else []
+
+            elif component.get('RRULE') or component.get('RDATE'):
+                uid = str(component.get('UID'))
+                ranges = timerange.occurrences((item.etag, position), component, start, end)
+
+                instances = [
+                    occurrence(component, occurrence_start)
+                    for occurrence_start, occurrence_end in ranges
+                    if (uid, occurrence_start) not in overridden
+                ]
+
+            else:
+                instances = [occurrence(component)]
+
+        except (ValueError, TypeError, AttributeError):
+            # Let clients sort out the components we can't understand
+            instances = [component]
+
+        for instance in instances:
+            calendar.add_component(instance)
+
+    return serialize(calendar)
+
+def limit_recurrence_set(item, start, end):
+    """
+        Serialize ``item`` without the overridden occurrences outside of
+        [start, end) [RFC 4791 9.6.6].
+    """
+
+    calendar = icalendar.Calendar()
+    calendar.update(item.ical)
+
+    for component in item.ical.subcomponents:
+        try:
+            if 'RECURRENCE-ID' in component and not affects(component, start, end):
+                continue
+
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+        calendar.add_component(component)
+
+    return serialize(calendar)
+
+
+class Index(object):
+    """
+        Map each item's name to the positions of its components among the
+        top-level components of a calendar.
+    """
+
+    def __init__(self, ical):
+        self.ical = ical
+        self._time_ranges = {}
+        self._timezones = {}
+        self._busy = None
+        self.rebuild()
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def copy(self):
+        """
+            Return the index of a copy of the calendar, for a writer to change
+            while readers keep using this one. Components are shared, they
+            are replaced rather than changed.
+        """
+
+        calendar = icalendar.Calendar()
+        calendar.update(self.ical)
+        calendar.subcomponents = list(self.ical.subcomponents)
+
+        index = Index.__new__(Index)
+        index.ical = calendar
+        index._names = dict((name, list(positions)) for name, positions in self._names.items())
+        index._time_ranges = dict((tag, ranges.copy()) for tag, ranges in self._time_ranges.items())
+        index._timezones = dict(self._timezones)
+        index._busy = self._busy and self._busy.copy()
+
+        return index
+
+    def rebuild(self):
+        """ Index all the calendar's components """
+
+        self._names = {}
+
+        for position, component in enumerate(self.ical.subcomponents):
+            name = component_name(component)
+
+            if name:
+                self._names.setdefault(name, []).append(position)
+
+    def names(self):
+        """ Names of all the indexed items """
+
+        return self._names.keys()
+
+    def positions(self, name):
+        """ Positions of the components of the item named ``name`` """
+
+        return self._names.get(name, [])
+
+    def components(self, name):
+        """ Components of the item named ``name`` """
+
+        return [self.ical.subcomponents[i] for i in self.positions(name)]
+
+    def tagged(self, tag):
+        """ Names of the items having a ``tag`` component """
+
+        return set(
+            name for name, positions in self._names.items()
+            if any(self.ical.subcomponents[i].name == tag for i in positions)
+        )
+
+    def time_ranges(self, tag):
+        """ Index of the time ranges covered by the ``tag`` components """
+
+        if tag not in self._time_ranges:
+            index = timerange.TimeRangeIndex()
+
+            for component in self.ical.subcomponents:
+                name = component_name(component)
+
+                if name and component.name == tag:
+                    index.add(name, component)
+
+            self._time_ranges[tag] = index
+
+        return self._time_ranges[tag]
+
+    def timezone(self, tzid):
+        """ Serialized VTIMEZONE of ``tzid``, None if the calendar has none """
+
+        if tzid not in self._timezones:
+            components = [c for c in self.components(tzid) if c.name == Timezone.tag]
+
+            self._timezones[tzid] = components and share_timezone(tzid, serialize(components[0])) or None
+
+        return self._timezones[tzid]
+
+    def busy(self):
+        """ Index of the busy time of the calendar's events """
+
+        if self._busy is None:
+            busy = timerange.BusyIndex()
+
+            for name in self._names:
+                busy.set(name, self.components(name))
+
+            self._busy = busy
+
+        return self._busy
+
+    def add(self, component):
+        """ Add ``component`` at the end of the calendar """
+
+        self.ical.add_component(component)
+
+        name = component_name(component)
+
+        if name:
+            position = len(self.ical.subcomponents) - 1
+            self._names.setdefault(name, []).append(position)
+            self._timezones.pop(name, None)
+
+            if component.name in self._time_ranges:
+                self._time_ranges[component.name].add(name, component)
+
+            if self._busy is not None:
+                self._busy.set(name, self.components(name))
+
+    def remove(self, *names):
+        """ Remove the components of the items named ``names`` """
+
+        positions = []
+
+        for name in names:
+            for position in self._names.pop(name, []):
+                tag = self.ical.subcomponents[position].name
+
+                if tag in self._time_ranges:
+                    self._time_ranges[tag].remove(name)
+
+                positions.append(position)
+
+            if self._busy is not None:
+                self._busy.remove(name)
+
+            self._timezones.pop(name, None)
+
+        for position in sorted(positions, reverse=True):
+            del self.ical.subcomponents[position]
+
+        if positions:
+            # Following components moved back
+            self.rebuild()
+
+
 class ItemList(list):
     """ Define a list of Item """
 
@@ -94,7 +548,7 @@ class ItemList(list):
             for component in item.ical.subcomponents:
                 ical.add_component(component)
 
-        return ical.to_ical()
+        return serialize(ical)
 
 class Collection(object):
     """ Abstract class which define access API to calendars """
@@ -102,6 +556,9 @@ class Collection(object):
     def __init__(self, path):
         self.path = path
         self._ical = None
+        self._index = None
+        self._meta = None
+        self._items = None
 
     ## Collection properties
 
@@ -110,10 +567,54 @@ class Collection(object):
         """ Wrapper to internal iCalendar object """
 
         if self._ical is None:
-            self._ical = self.get()
+            with metrics.timed('get'):
+                self._ical = self.get()
 
         return self._ical
 
+    @property
+    def index(self):
+        """ Index of the items of the internal iCalendar object """
+
+        if self._index is None or self._index.ical is not self.ical:
+            self._index = self.get_index()
+
+        return self._index
+
+    @property
+    def meta(self):
+        """
+            Metadata of the collection, kept up to date with the stored
+            calendar :
+
+                - ``id``: unique identifier of the collection
+                - ``generation``: incremented each time the collection changes
+                - ``etags``: ETag of each item, by name
+                - ``changes``: generation of the last change of each item
+                - ``tombstones``: generation of the removal of each item
+                - ``horizon``: oldest generation changes are known since
+                - ``signature``: state of the storage the metadata describes
+        """
+
+        if self._meta is None:
+            # Writers store the calendar then its metadata, check them in
+            # between two writes
+            with self.lock():
+                meta = self.load_meta()
+                stale = meta is None or meta.get('signature') != self.signature
+
+            if stale:
+                with self.lock(exclusive=True):
+                    meta = self.load_meta()
+
+                    if meta is None or meta.get('signature') != self.signature:
+                        # The calendar was changed behind our back
+                        meta = self.rebuild_meta(meta)
+
+            self._meta = meta
+
+        return self._meta
+
     @property
     def mimetype(self):
         return "text/calendar"
@@ -124,45 +625,267 @@ class Collection(object):
 
     @property
     def etag(self):
-        return '"{0}"'.format(hash(self.ical.to_ical()))
+        """ The collection's CTag """
+
+        return '"{0}-{1}"'.format(self.meta['id'], self.meta['generation'])
+
+    @property
+    def names(self):
+        """ Names of the items of the collection """
+
+        return self.meta['etags'].keys()
+
+    @property
+    def sync_token(self):
+        """ Token identifying the current state of the collection [RFC 6578] """
+
+        return '{0}{1}:{2}'.format(
+                SYNC_TOKEN_PREFIX,
+                self.meta['id'],
+                self.meta['generation']
+        )
 
     @property
     def name(self):
         """ Return calendar's name """
 
-        with self.props as props:
-            return props.get('D:displayname', self.path.split('/')[-1])
+        return self.properties.get('D:displayname', self.path.split('/')[-1])
 
     @property
     def text(self):
         """ The collection as plain text """
         self.ical.set('prodid', PRODID)
         self.ical.set('version', VERSION)
-        return self.ical.to_ical()
+        return serialize(self.ical)
 
     @property
     def last_modified(self):
         """ Last modification on calendar """
         raise NotImplementedError
 
+    @property
+    def properties(self):
+        """ Collection properties, which must not be modified """
+        raise NotImplementedError
+
     @property
     @contextmanager
     def props(self):
-        """ Return collection properties """
+        """ Update collection properties, stored if they were changed """
+        raise NotImplementedError
+
+    @property
+    def signature(self):
+        """ Identify the current state of the storage """
         raise NotImplementedError
 
     ## Collection method
 
+    @contextmanager
+    def lock(self, exclusive=False):
+        """
+            Lock the collection against the writers of other processes, and
+            against its readers too if ``exclusive`` is True. Backends shared
+            by several processes must implement it.
+        """
+
+        yield
+
+    def refresh(self):
+        """ Forget what was read of the collection, to read its current state """
+
+        self._ical = None
+        self._index = None
+        self._meta = None
+
     def get(self):
         """ Get calendar from the storage backend """
         raise NotImplementedError
 
-    def save(self):
-        """ Save changes to the collection and update the internal calendar """
+    def get_raw(self):
+        """
+            Open the stored calendar, if it can be served as stored, and
+            return the file and its size. None makes the caller serialize
+            the internal calendar instead.
+        """
+
+        return None
+
+    def get_index(self):
+        """ Get the index of the internal calendar, backends may cache it """
+
+        return Index(self.ical)
+
+    def load_meta(self):
+        """ Get collection metadata from the storage backend, None if missing """
+        raise NotImplementedError
+
+    def store_meta(self, meta):
+        """ Write collection metadata to the storage backend """
+        raise NotImplementedError
+
+    def rebuild_meta(self, previous=None):
+        """ Compute the metadata of the stored calendar from scratch """
+
+        previous = previous or {}
+        generation = previous.get('generation', -1) + 1
+
+        meta = {
+            'id': previous.get('id') or str(uuid.uuid4()),
+            'generation': generation,
+            'etags': {},
+            'changes': {},
+            'tombstones': dict(previous.get('tombstones', {})),
+            'horizon': previous.get('horizon', generation),
+            'signature': self.signature,
+        }
+
+        for name in self.index.names():
+            components = self.index.components(name)
+
+            if components[0].name != Timezone.tag:
+                meta['etags'][name] = digest(components)
+
+        # Which items changed is unknown, consider they all did
+        for name in meta['etags']:
+            meta['changes'][name] = generation
+            meta['tombstones'].pop(name, None)
+
+        for name in previous.get('etags', {}):
+            if name not in meta['etags']:
+                meta['tombstones'][name] = generation
+
+        self.prune_tombstones(meta)
+        self.store_meta(meta)
+        return meta
+
+    def prune_tombstones(self, meta):
+        """ Forget the oldest removals once there are too many of them """
+
+        limit = (config.config.sync or {}).get('tombstones', 1000)
+        tombstones = meta['tombstones']
+
+        if len(tombstones) > limit:
+            oldest = sorted(tombstones, key=tombstones.get)
+
+            for name in oldest[:len(tombstones) - limit]:
+                # Changes since before this removal can't be told anymore
+                meta['horizon'] = max(meta['horizon'], tombstones.pop(name))
+
+    def changes_since(self, token):
+        """
+            Return the names of the items changed and the names of the items
+            removed since the state identified by the sync ``token``. Every
+            item is considered changed if ``token`` is empty.
+
+            Raise ValueError if the changes since ``token`` are not known.
+        """
+
+        meta = self.meta
+
+        if not token:
+            return sorted(meta['etags']), []
+
+        prefix = '{0}{1}:'.format(SYNC_TOKEN_PREFIX, meta['id'])
+
+        if not token.startswith(prefix):
+            raise ValueError('Unknown sync token: {0}'.format(token))
+
+        generation = int(token[len(prefix):])
+
+        if not meta['horizon'] <= generation <= meta['generation']:
+            raise ValueError('Expired sync token: {0}'.format(token))
+
+        changed = [
+            name for name, last in meta['changes'].items()
+            if last > generation
+        ]
+
+        removed = [
+            name for name, last in meta['tombstones'].items()
+            if last > generation
+        ]
+
+        return sorted(changed), sorted(removed)
+
+    @contextmanager
+    def recording(self):
+        """
+            Record the changes made to the stored items. The managed dict maps
+            the name of each changed item to its new components, or to None
+            if the item was removed.
+        """
+
+        with self.lock(exclusive=True):
+            # Another process may have written the collection since it was
+            # read, apply the changes to its current state
+            self.refresh()
+
+            # Check the metadata against the storage before changing it, on
+            # a copy, as readers may be using the cached one
+            meta = copy_meta(self.meta)
+            changes = {}
+
+            yield changes
+
+            meta['generation'] += 1
+
+            for name, components in changes.items():
+                if components:
+                    meta['etags'][name] = digest(components)
+                    meta['changes'][name] = meta['generation']
+                    meta['tombstones'].pop(name, None)
+
+                elif meta['etags'].pop(name, None):
+                    meta['changes'].pop(name, None)
+                    meta['tombstones'][name] = meta['generation']
+
+            meta['signature'] = self.signature
+
+            self.prune_tombstones(meta)
+            self.store_meta(meta)
+            self._meta = meta
 
-        self.write()
-        self._ical = self.get()
+            # The calendar may have been changed in place
+            self._items = None
 
+    def item_etag(self, name):
+        """ ETag of the item named ``name``, None if there is no such item """
+
+        return self.meta['etags'].get(name)
+
+    def item_etags(self, names):
+        """ ETags of the items named ``names``, by name, for those which exist """
+
+        etags = self.meta['etags']
+        return dict((name, etags[name]) for name in names if name in etags)
+
+    def query(self, tag, start=None, end=None):
+        """
+            Return the names of the items having a ``tag`` component which
+            overlaps the [start, end) time-range, a missing bound meaning an
+            open range. Without bounds, every item having a ``tag`` component
+            is returned.
+        """
+
+        if start is None and end is None:
+            return self.index.tagged(tag)
+
+        return self.index.time_ranges(tag).query(start, end)
+
+    def busy(self, start, end):
+        """
+            Return the disjoint periods of [start, end) during which the
+            events of the collection take time, by free/busy type.
+        """
+
+        return self.index.busy().query(start, end)
+
+    def save(self):
+        """ Save changes to the collection, the internal calendar is up to date """
+
+        with metrics.timed('write'):
+            self.write()
 
     def write(self):
         """ Write changes to the collection """
@@ -173,31 +896,79 @@ class Collection(object):
 
         raise NotImplementedError
 
+    def detach(self):
+        """
+            Use a copy of the internal calendar and of its index, which may
+            be shared with the readers of other threads, before changing them.
+        """
+
+        self._index = self.index.copy()
+        self._ical = self._index.ical
+
     def append(self, name, ical):
         """ Append item to the collection """
 
-        for component in ical.subcomponents:
-            self.ical.add_component(component)
+        with self.recording() as changes:
+            self.detach()
+
+            for component in ical.subcomponents:
+                if component.name == Timezone.tag:
+                    # Timezones are shared by all items
+                    if component_name(component) in self.index:
+                        continue
+
+                else:
+                    # The item must be found by the name it was stored with
+                    component['X-CAL9-NAME'] = icalendar.vText(name)
+
+                self.index.add(component)
 
-        self.save()
+            self.save()
+            changes[name] = self.index.components(name)
 
     def remove(self, name):
         """ Remove item from collection """
 
-        for component in self.ical.subcomponents:
-            item = Item(component.to_ical())
+        with self.recording() as changes:
+            self.detach()
+            self.index.remove(name)
+            self.save()
+            changes[name] = None
 
-            if item.name == name:
-                i = self.ical.subcomponents.index(component)
-                del self.ical.subcomponents[i]
+    def replace(self, name, ical):
+        """ Replace item in collection, in a single change """
 
-        self.save()
+        self.extend({name: ical})
 
-    def replace(self, name, ical):
-        """ Replace item in collection """
+    def extend(self, items):
+        """
+            Append or replace many items in a single change, ``items`` mapping
+            their names to iCalendar objects as given to ``append``.
+        """
+
+        with self.recording() as changes:
+            self.detach()
+
+            # Rebuild the index once for all the replaced items
+            self.index.remove(*items.keys())
+
+            for name, ical in items.items():
+                changes[name] = []
+
+                for component in ical.subcomponents:
+                    if component.name == Timezone.tag:
+                        # Timezones are shared by all items
+                        if component_name(component) in self.index:
+                            continue
 
-        self.remove(name)
-        self.append(name, ical)
+                    else:
+                        # The item must be found by the name it was stored with
+                        component['X-CAL9-NAME'] = icalendar.vText(name)
+                        changes[name].append(component)
+
+                    self.index.add(component)
+
+            self.save()
 
     @classmethod
     def is_calendar(cls, path):
@@ -245,62 +1016,50 @@ class Collection(object):
 
     ## Filtering components
 
-    def filter(self, item_type):
-        """ Filter items, ``item_type`` is a class derivated from Item """
-        items = ItemList()
+    def categorize(self):
+        """
+            Return the components of the internal calendar grouped by item,
+            in order and in a single pass, and the items wrapped so far.
+        """
 
-        for component in self.ical.walk():
-            # If tag is not None, filter
-            if item_type.tag:
-                # Check component's type
-                if component.name == item_type.tag:
-                    # Encapsulate the component in a calendar
-                    ical = icalendar.Calendar()
-                    ical.add_component(component)
+        if self._items is None or self._items[0] is not self.ical:
+            groups = OrderedDict()
 
-                    # Generate an object from it, and append it to the list
-                    items.append(item_type(ical.to_ical()))
-            else:
-                # Encapsulate the component in a calendar
-                ical = icalendar.Calendar()
-                ical.add_component(component)
+            for position, component in enumerate(self.ical.subcomponents):
+                name = component_name(component)
 
-                # Generate an object from it, and append it to the list
+                # Components without a name are items on their own
+                group = groups.setdefault(name or position, (name, []))
+                group[1].append(component)
 
-                component_found = False
+            self._items = (self.ical, groups, {})
 
-                # Get the correct item type, by checking the tag defined for each
-                # subclass of Item.
-                for t in Item.__subclasses__():
+        return self._items[1], self._items[2]
 
-                    # If the subclass is Component, check for its subclasses
-                    if t is Component:
+    def filter(self, wanted):
+        """ Filter items, ``wanted`` is a class derivated from Item """
 
-                        for ct in Component.__subclasses__():
+        groups, wrapped = self.categorize()
+        items = ItemList()
 
-                            # If the component's type match
-                            if component.name == ct.tag:
-                                # Append object to the list
-                                items.append(ct(ical.to_ical()))
+        for key, (name, components) in groups.items():
+            if wanted.tag and components[0].name != wanted.tag:
+                continue
 
-                                component_found = True
-                                break
+            # Only wrap the items asked for, once
+            if key not in wrapped:
+                ical = icalendar.Calendar()
+
+                for component in components:
+                    ical.add_component(component)
 
-                    # If the component was found in subclass of Component
-                    if component_found:
-                        # the item was added
-                        break
+                item = item_type(components[0].name)(ical, name)
 
-                    # If the component's type match
-                    if component.name == t.tag:
-                        # Append object to the list
-                        items.append(t(ical.to_ical()))
-                        break
+                # Use the stored ETags instead of computing them again
+                item._etag = self.meta['etags'].get(item.name)
+                wrapped[key] = item
 
-                else:
-                    # We didn't find the component's type
-                    # Fallback on Item
-                    items.append(Item(ical.to_ical()))
+            items.append(wrapped[key])
 
         return items
 
@@ -340,9 +1099,49 @@ class Collection(object):
 
         return self.filter(Timezone)
 
+    def timezone_blocks(self, tzids=None):
+        """
+            Return the serialized VTIMEZONE components of ``tzids``, or of
+            all the collection's timezones, shared through ``TIMEZONES``.
+        """
+
+        if tzids is None:
+            tzids = self.index.tagged(Timezone.tag)
+
+        blocks = [self.index.timezone(tzid) for tzid in sorted(tzids)]
+
+        return [block for block in blocks if block]
+
     def get_item(self, name):
         """ Get item named ``name`` """
 
-        for item in self.items:
-            if item.name == name:
-                return item
+        components = self.index.components(name)
+
+        if components:
+            ical = icalendar.Calendar()
+
+            for component in components:
+                ical.add_component(component)
+
+            # Components are shared with the calendar, see ``Item.copy``
+            item = item_type(components[0].name)(ical, name)
+            item._etag = self.item_etag(name)
+
+            return item
+
+    def get_items(self, names):
+        """ Get the items named ``names`` at once, by name, for those which exist """
+
+        items = {}
+
+        for name in names:
+            item = self.get_item(name)
+
+            if item:
+                items[name] = item
+
+        return items
+
+# Backends replace ``Collection`` with their own class when imported,
+# those not built on another backend derive from this one
+BaseCollection = Collection
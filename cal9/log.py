@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Logging through the standard ``logging`` module, each module of 9cal
+    using its own logger under ``cal9``. Messages are formatted only when
+    their logger is enabled for their level.
+
+    The ``logging`` section of the configuration sets the ``level`` of all
+    loggers, ``debug`` when 9cal is in debug mode and ``warning``
+    otherwise, the ``levels`` of some of them by name, and how request and
+    response bodies are logged: the ``sample`` of requests whose bodies are
+    logged, and the ``size`` they are truncated at.
+"""
+
+from cal9 import config
+
+import logging
+import random
+import sys
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Ratio of requests whose bodies are logged, and the size they are cut at
+BODY_SAMPLE = 1.0
+BODY_SIZE = 4096
+
+def level(name):
+    """ Return the ``logging`` level called ``name`` """
+
+    return getattr(logging, name.upper())
+
+def configure():
+    """ Set the levels of the loggers as configured """
+
+    global BODY_SAMPLE, BODY_SIZE
+
+    settings = config.config.logging or {}
+    root = logging.getLogger('cal9')
+
+    root.setLevel(level(settings.get('level', 'debug' if config.config.debug else 'warning')))
+
+    for name, value in (settings.get('levels') or {}).items():
+        logging.getLogger(name).setLevel(level(value))
+
+    # Leave the output to the hosting application, if it configured one
+    if not root.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        root.addHandler(handler)
+
+    body = settings.get('body') or {}
+    BODY_SAMPLE = body.get('sample', 1.0)
+    BODY_SIZE = body.get('size', 4096)
+
+def bodies(logger):
+    """ Tell whether the bodies of the current request are to be logged """
+
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < BODY_SAMPLE
+
+def truncate(body):
+    """ Cut ``body``, a text or a list of chunks, to the configured size for logging """
+
+    chunks = body if isinstance(body, list) else [body]
+    text = u''.join(
+        chunk if isinstance(chunk, unicode) else chunk.decode('utf-8', 'replace')
+        for chunk in chunks
+    )
+
+    if len(text) <= BODY_SIZE:
+        return text
+
+    return u'{0}... ({1} characters)'.format(text[:BODY_SIZE], len(text))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Latency histograms and counters of the process, rendered in the
+    Prometheus text format [https://prometheus.io/docs/instrumenting/exposition_formats/].
+
+    Operations are timed with ``timed``, which also adds their duration to
+    the breakdown of the request being handled by the current thread, if
+    any. Caches registered in ``CACHES`` report their hits and misses.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from bisect import bisect_left
+
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+DESCRIPTIONS = {
+    'cal9_request_seconds': 'Time spent handling requests, by method',
+    'cal9_operation_seconds': 'Time spent in storage, iCalendar and XML operations',
+    'cal9_request_bytes_total': 'Bytes of request bodies read',
+    'cal9_response_bytes_total': 'Bytes of response bodies written',
+    'cal9_parsed_bytes_total': 'Bytes of iCalendar data parsed',
+    'cal9_serialized_bytes_total': 'Bytes of iCalendar data serialized',
+    'cal9_cache_hits_total': 'Lookups which found their entry, by cache',
+    'cal9_cache_misses_total': 'Lookups which did not find their entry, by cache',
+    'cal9_cache_entries': 'Entries held, by cache',
+    'cal9_cache_weight': 'Total weight of the entries held, by cache',
+    'cal9_watcher_invalidations_total': 'Changes of the calendar files notified by the watcher',
+}
+
+# Caches to report, by name, having ``hits``, ``misses`` and ``weight``
+CACHES = {}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_local = threading.local()
+
+class Histogram(object):
+    """ Distribution of values among ``BUCKETS`` """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, value, **labels):
+    """ Add ``value`` to the histogram ``name`` """
+
+    key = _key(name, labels)
+
+    with _lock:
+        histogram = _histograms.get(key)
+
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+
+        histogram.observe(value)
+
+def count(name, value=1, **labels):
+    """ Add ``value`` to the counter ``name`` """
+
+    key = _key(name, labels)
+
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+@contextmanager
+def timed(operation):
+    """
+        Time the enclosed block as ``operation``. Blocks nested in one of the
+        same operation, such as a backend calling its parent class, are
+        only counted once.
+    """
+
+    active = getattr(_local, 'active', None)
+
+    if active is None:
+        active = _local.active = set()
+
+    if operation in active:
+        yield
+        return
+
+    active.add(operation)
+    started = time.time()
+
+    try:
+        yield
+
+    finally:
+        elapsed = time.time() - started
+        active.discard(operation)
+
+        observe('cal9_operation_seconds', elapsed, operation=operation)
+
+        timings = getattr(_local, 'timings', None)
+
+        if timings is not None:
+            timings[operation] = timings.get(operation, 0) + elapsed
+
+@contextmanager
+def breakdown():
+    """
+        Yield the time spent in each operation by the current thread during
+        the block, completed by the ``total`` once done.
+    """
+
+    timings = _local.timings = OrderedDict()
+    started = time.time()
+
+    try:
+        yield timings
+
+    finally:
+        _local.timings = None
+        timings['total'] = time.time() - started
+
+class Streamed(object):
+    """ Response body accounted for as its chunks are sent """
+
+    def __init__(self, content, method, started):
+        self.content = content
+        self.method = method
+        self.started = started
+
+    def __iter__(self):
+        for chunk in self.content:
+            count('cal9_response_bytes_total', len(chunk))
+            yield chunk
+
+    def close(self):
+        if hasattr(self.content, 'close'):
+            self.content.close()
+
+        observe('cal9_request_seconds', time.time() - self.started, method=self.method)
+
+def response(content, method, started, size=None):
+    """
+        Account for the request ``method`` started at ``started``, once its
+        body ``content`` is sent. Without its ``size``, the body is counted
+        as it is sent, return the body to send.
+    """
+
+    if size is None:
+        return Streamed(content, method, started)
+
+    count('cal9_response_bytes_total', size)
+    observe('cal9_request_seconds', time.time() - started, method=method)
+
+    return content
+
+def server_timing(timings):
+    """ Format ``timings`` as a Server-Timing header value, in milliseconds """
+
+    return ', '.join(
+        '{0};dur={1:.2f}'.format(operation, elapsed * 1000)
+        for operation, elapsed in timings.items()
+    )
+
+## Exposition
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+
+    if not pairs:
+        return ''
+
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in pairs
+    ))
+
+def _family(lines, name, kind, seen):
+    if name not in seen:
+        seen.add(name)
+        lines.append('# HELP {0} {1}'.format(name, DESCRIPTIONS.get(name, name)))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+def render():
+    """ Render every metric in the Prometheus text format """
+
+    with _lock:
+        histograms = [
+            (key, list(h.counts), h.sum, h.count)
+            for key, h in _histograms.items()
+        ]
+        counters = _counters.items()
+
+    for name, cache in CACHES.items():
+        counters.append((('cal9_cache_hits_total', (('cache', name),)), cache.hits))
+        counters.append((('cal9_cache_misses_total', (('cache', name),)), cache.misses))
+        counters.append((('cal9_cache_entries', (('cache', name),)), len(cache)))
+        counters.append((('cal9_cache_weight', (('cache', name),)), cache.weight))
+
+    lines = []
+    seen = set()
+
+    for (name, labels), counts, total, number in sorted(histograms):
+        _family(lines, name, 'histogram', seen)
+
+        cumulated = 0
+
+        for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+            cumulated += bucket
+            lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, le=bound), cumulated))
+
+        lines.append('{0}_sum{1} {2!r}'.format(name, _labels(labels), total))
+        lines.append('{0}_count{1} {2}'.format(name, _labels(labels), number))
+
+    for (name, labels), value in sorted(counters):
+        kind = 'counter' if name.endswith('_total') else 'gauge'
+        _family(lines, name, kind, seen)
+
+        lines.append('{0}{1} {2}'.format(name, _labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Time ranges covered by calendar components, and an index answering
+    CalDAV time-range queries [RFC 4791 9.9] without walking the calendar.
+
+    All dates are handled as naive UTC datetimes, floating times being
+    considered as UTC.
+
+    The occurrences of recurring components expanded for clients are kept
+    in ``OCCURRENCES``, by window of time, to be reused by later queries.
+"""
+
+from datetime import datetime, date, timedelta
+from bisect import bisect_left, bisect_right, insort
+
+from dateutil import rrule
+import icalendar
+
+from util import LRUCache
+import metrics
+
+MIN = datetime.min
+MAX = datetime.max
+
+DAY = timedelta(days=1)
+
+# Bounded rules with more occurrences are evaluated on demand instead
+MAX_OCCURRENCES = 1000
+
+# Free/busy type of events by status, None for events taking no time [RFC 4791 7.10]
+BUSY_TYPES = {
+    'CONFIRMED': 'BUSY',
+    'TENTATIVE': 'BUSY-TENTATIVE',
+    'CANCELLED': None,
+}
+
+# Expanded recurrences shared by all requests, weighted by their occurrences
+OCCURRENCES = LRUCache(100000)
+metrics.CACHES['occurrences'] = OCCURRENCES
+
+def utc(value):
+    """ Convert a date or a datetime to a naive UTC datetime """
+
+    if not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        return value.replace(tzinfo=None) - value.utcoffset()
+
+    return value.replace(tzinfo=None)
+
+def parse_utc(text):
+    """
+        Parse a UTC date-time such as ``20060104T000000Z``, None if empty.
+        Raise ValueError if ``text`` is not such a date-time.
+    """
+
+    if text:
+        return datetime.strptime(text, '%Y%m%dT%H%M%SZ')
+
+def localize(value, tzinfo):
+    """ Attach ``tzinfo`` to the naive wall time ``value`` """
+
+    if tzinfo is None:
+        return value
+
+    if hasattr(tzinfo, 'localize'):
+        # pytz timezones need to find the right offset for the date
+        return tzinfo.localize(value)
+
+    return value.replace(tzinfo=tzinfo)
+
+def overlaps(start, end, range_start, range_end):
+    """ Check if [start, end) overlaps [range_start, range_end) """
+
+    if start == end:
+        return range_start <= start < range_end
+
+    return start < range_end and end > range_start
+
+def shift(value, delta):
+    """ Add ``delta`` to ``value``, saturating at MIN and MAX """
+
+    try:
+        return value + delta
+    except OverflowError:
+        return MAX if delta > timedelta(0) else MIN
+
+def values(component, key):
+    """ Return the list of values of the property ``key`` """
+
+    value = component.get(key)
+
+    if value is None:
+        return []
+
+    if isinstance(value, list):
+        return value
+
+    return [value]
+
+def component_range(component):
+    """
+        Return the (start, end) range covered by ``component``, ignoring its
+        recurrences. (MIN, MAX) is returned for components matching any
+        time-range, and None for components matching none.
+    """
+
+    dtstart = component.get('DTSTART')
+    start = dtstart and dtstart.dt
+
+    if component.name == 'VEVENT':
+        if start is None:
+            return None
+
+        if component.get('DTEND'):
+            end = component['DTEND'].dt
+        elif component.get('DURATION'):
+            end = start + component['DURATION'].dt
+        elif not isinstance(start, datetime):
+            end = start + DAY
+        else:
+            end = start
+
+        return utc(start), utc(end)
+
+    elif component.name == 'VTODO':
+        due = component.get('DUE') and component['DUE'].dt
+
+        if start is not None and component.get('DURATION'):
+            return utc(start), utc(start + component['DURATION'].dt)
+
+        elif start is not None or due is not None:
+            start = utc(start if start is not None else due)
+            end = utc(due) if due is not None else start
+
+            return start, end
+
+        # To-do not placed in time, matches any time-range
+        return MIN, MAX
+
+    elif component.name == 'VJOURNAL':
+        if start is None:
+            return None
+
+        end = start if isinstance(start, datetime) else start + DAY
+
+        return utc(start), utc(end)
+
+class Recurrence(object):
+    """ Occurrences of a recurring component """
+
+    def __init__(self, component):
+        start, end = component_range(component)
+
+        dtstart = component['DTSTART'].dt
+
+        self.duration = end - start
+        self.tzinfo = getattr(dtstart, 'tzinfo', None)
+        self.ruleset = rrule.rruleset()
+
+        # Rules are evaluated on wall time, then localized
+        wall_start = self.wall(dtstart)
+
+        for recur in values(component, 'RRULE'):
+            recur = icalendar.vRecur(recur)
+
+            if recur.get('UNTIL'):
+                recur['UNTIL'] = [self.wall(recur['UNTIL'][0], until=True)]
+
+            self.ruleset.rrule(rrule.rrulestr(recur.to_ical(), dtstart=wall_start))
+
+        for rdate in values(component, 'RDATE'):
+            for value in rdate.dts:
+                if not isinstance(value.dt, (datetime, date)):
+                    # Periods are not supported
+                    continue
+
+                self.ruleset.rdate(self.wall(value.dt))
+
+        for exdate in values(component, 'EXDATE'):
+            for value in exdate.dts:
+                self.ruleset.exdate(self.wall(value.dt))
+
+        # The first occurrence is part of the set, even if the rule skips it
+        self.ruleset.rdate(wall_start)
+
+        self.bounded = all(
+            recur.get('COUNT') or recur.get('UNTIL')
+            for recur in values(component, 'RRULE')
+        )
+
+    def wall(self, value, until=False):
+        """ Convert ``value`` to a naive wall time in the component's timezone """
+
+        if not isinstance(value, datetime):
+            if until:
+                return datetime(value.year, value.month, value.day, 23, 59, 59)
+
+            return datetime(value.year, value.month, value.day)
+
+        if value.tzinfo is not None and self.tzinfo is not None:
+            value = value.astimezone(self.tzinfo)
+
+        elif value.tzinfo is not None:
+            value = utc(value)
+
+        return value.replace(tzinfo=None)
+
+    def occurrence(self, wall_start):
+        """ Return the UTC range of the occurrence starting at ``wall_start`` """
+
+        start = utc(localize(wall_start, self.tzinfo))
+        return start, start + self.duration
+
+    def ranges(self, limit=None):
+        """ Iterate over the ranges of at most ``limit`` occurrences """
+
+        for i, wall_start in enumerate(self.ruleset):
+            if limit is not None and i >= limit:
+                break
+
+            yield self.occurrence(wall_start)
+
+    def between(self, start, end):
+        """ Iterate over the ranges of the occurrences overlapping [start, end) """
+
+        # Wall times are at most one day away from UTC
+        after = shift(shift(start, -self.duration), -DAY)
+        before = shift(end, DAY)
+
+        for wall_start in self.ruleset.xafter(after, inc=True):
+            if wall_start >= before:
+                break
+
+            occurrence = self.occurrence(wall_start)
+
+            if overlaps(occurrence[0], occurrence[1], start, end):
+                yield occurrence
+
+    def overlaps(self, start, end):
+        """ Check if an occurrence overlaps [start, end) """
+
+        for occurrence in self.between(start, end):
+            return True
+
+        return False
+
+def expand(component):
+    """
+        Return the ranges covered by the occurrences of ``component``, or its
+        Recurrence if they are too many to be listed, or None if it matches
+        no time-range.
+    """
+
+    bounds = component_range(component)
+
+    if bounds is None or bounds == (MIN, MAX):
+        return bounds and [bounds]
+
+    if not (component.get('RRULE') or component.get('RDATE')):
+        return [bounds]
+
+    recurrence = Recurrence(component)
+
+    if recurrence.bounded:
+        ranges = list(recurrence.ranges(MAX_OCCURRENCES + 1))
+
+        if len(ranges) <= MAX_OCCURRENCES:
+            return ranges
+
+    return recurrence
+
+class Window(object):
+    """
+        Occurrences of a Recurrence found over a window of time, which grows
+        as overlapping windows are asked for.
+    """
+
+    def __init__(self, recurrence):
+        self.recurrence = recurrence
+
+        # Replaced at once, for threads sharing the window
+        self.found = None
+
+    def __len__(self):
+        return len(self.found[2]) if self.found else 0
+
+    def between(self, start, end):
+        """ Return the ranges of the occurrences overlapping [start, end) """
+
+        found = self.found
+
+        if found is None or start > found[1] or end < found[0]:
+            # Do not evaluate the rule over the gap between distant windows
+            found = start, end, list(self.recurrence.between(start, end))
+
+        elif start < found[0] or end > found[1]:
+            # Only evaluate the rule outside of the known window
+            ranges = set(found[2])
+
+            if start < found[0]:
+                ranges.update(self.recurrence.between(start, found[0]))
+
+            if end > found[1]:
+                ranges.update(self.recurrence.between(found[1], end))
+
+            found = min(start, found[0]), max(end, found[1]), sorted(ranges)
+
+        self.found = found
+
+        return [
+            (range_start, range_end)
+            for range_start, range_end in found[2]
+            if overlaps(range_start, range_end, start, end)
+        ]
+
+def occurrences(key, component, start, end):
+    """
+        Return the ranges of the occurrences of the recurring ``component``
+        overlapping [start, end), cached under ``key``, which identifies the
+        content of ``component``.
+    """
+
+    window = OCCURRENCES.get(key)
+
+    if window is None:
+        window = Window(Recurrence(component))
+
+    ranges = window.between(start, end)
+    OCCURRENCES.set(key, window, weight=len(window) + 1)
+
+    return ranges
+
+class TimeRangeIndex(object):
+    """
+        Index the time ranges covered by components, by the name of the item
+        they belong to. Recurrences are expanded into their occurrences,
+        except for rules without end which are evaluated at query time.
+    """
+
+    def __init__(self):
+        self._ranges = []
+        self._names = {}
+        self._recurrences = {}
+        self._always = set()
+        self._max_duration = timedelta(0)
+
+    def copy(self):
+        """ Return an index of the same ranges, which can be changed apart """
+
+        index = TimeRangeIndex()
+        index._ranges = list(self._ranges)
+        index._names = dict((name, list(entries)) for name, entries in self._names.items())
+        index._recurrences = dict((name, list(ranges)) for name, ranges in self._recurrences.items())
+        index._always = set(self._always)
+        index._max_duration = self._max_duration
+
+        return index
+
+    def add(self, name, component):
+        """ Index ``component``, part of the item named ``name`` """
+
+        try:
+            ranges = expand(component)
+
+        except (ValueError, TypeError, AttributeError):
+            # Let clients sort out the components we can't understand
+            ranges = [(MIN, MAX)]
+
+        if isinstance(ranges, Recurrence):
+            self._recurrences.setdefault(name, []).append(ranges)
+            return
+
+        for start, end in ranges or []:
+            if (start, end) == (MIN, MAX):
+                self._always.add(name)
+                continue
+
+            self._max_duration = max(self._max_duration, end - start)
+
+            insort(self._ranges, (start, end, name))
+            self._names.setdefault(name, []).append((start, end, name))
+
+    def remove(self, name):
+        """ Remove the components of the item named ``name`` """
+
+        for entry in self._names.pop(name, []):
+            i = bisect_left(self._ranges, entry)
+
+            if i < len(self._ranges) and self._ranges[i] == entry:
+                del self._ranges[i]
+
+        self._recurrences.pop(name, None)
+        self._always.discard(name)
+
+    def query(self, start=None, end=None):
+        """ Return the names of the items overlapping [start, end) """
+
+        start = start or MIN
+        end = end or MAX
+
+        names = set(self._always)
+
+        # Only ranges starting less than the longest duration before
+        # ``start`` can overlap it
+        low = bisect_left(self._ranges, (shift(start, -self._max_duration),))
+        high = bisect_left(self._ranges, (end,))
+
+        for range_start, range_end, name in self._ranges[low:high]:
+            if overlaps(range_start, range_end, start, end):
+                names.add(name)
+
+        for name, recurrences in self._recurrences.items():
+            if name not in names:
+                if any(r.overlaps(start, end) for r in recurrences):
+                    names.add(name)
+
+        return names
+
+def busy_type(component):
+    """ Return the free/busy type of the event ``component``, None if it is free """
+
+    if str(component.get('TRANSP', 'OPAQUE')).upper() == 'TRANSPARENT':
+        return None
+
+    return BUSY_TYPES.get(str(component.get('STATUS', 'CONFIRMED')).upper(), 'BUSY')
+
+def merge(ranges):
+    """ Merge the sorted ``ranges`` into disjoint ranges """
+
+    merged = []
+
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+class BusyIndex(object):
+    """
+        Busy time of the events of a calendar, by item name and free/busy
+        type. Answered from sorted disjoint periods, merged again after
+        changes, so queries cost about as much as the periods they return.
+        Recurrences without end are evaluated at query time.
+    """
+
+    def __init__(self):
+        self._periods = {}
+        self._recurrences = {}
+        self._merged = None
+
+    def copy(self):
+        """ Return an index of the same busy time, which can be changed apart """
+
+        index = BusyIndex()
+
+        # Lists are replaced, never changed
+        index._periods = dict(self._periods)
+        index._recurrences = dict(self._recurrences)
+        index._merged = self._merged
+
+        return index
+
+    def set(self, name, components):
+        """ Index the events of ``components``, the item named ``name`` """
+
+        self.remove(name)
+
+        # Overridden occurrences are replaced by their own component
+        overridden = set()
+
+        for component in components:
+            if component.name == 'VEVENT' and component.get('RECURRENCE-ID'):
+                try:
+                    overridden.add(utc(component['RECURRENCE-ID'].dt))
+                except (ValueError, TypeError, AttributeError):
+                    pass
+
+        periods = []
+        recurrences = []
+
+        for component in components:
+            fbtype = component.name == 'VEVENT' and busy_type(component)
+
+            if not fbtype:
+                continue
+
+            try:
+                ranges = expand(component)
+
+            except (ValueError, TypeError, AttributeError):
+                # Events we can't understand are not accounted for
+                continue
+
+            if isinstance(ranges, Recurrence):
+                recurrences.append((fbtype, ranges, overridden))
+                continue
+
+            master = not component.get('RECURRENCE-ID')
+
+            for start, end in ranges or []:
+                if start < end and not (master and start in overridden):
+                    periods.append((fbtype, start, end))
+
+        if periods:
+            self._periods[name] = periods
+
+        if recurrences:
+            self._recurrences[name] = recurrences
+
+        self._merged = None
+
+    def remove(self, name):
+        """ Remove the events of the item named ``name`` """
+
+        periods = self._periods.pop(name, None)
+        recurrences = self._recurrences.pop(name, None)
+
+        if periods or recurrences:
+            self._merged = None
+
+    def merged(self):
+        """ Return the disjoint periods of each free/busy type, and their ends """
+
+        if self._merged is None:
+            ranges = {}
+
+            for periods in self._periods.values():
+                for fbtype, start, end in periods:
+                    ranges.setdefault(fbtype, []).append((start, end))
+
+            merged = {}
+
+            for fbtype, periods in ranges.items():
+                periods = merge(sorted(periods))
+                merged[fbtype] = [end for start, end in periods], periods
+
+            self._merged = merged
+
+        return self._merged
+
+    def query(self, start, end):
+        """ Return the disjoint busy periods within [start, end), by free/busy type """
+
+        busy = {}
+
+        for fbtype, (ends, periods) in self.merged().items():
+            # Disjoint periods are sorted by their ends too
+            i = bisect_right(ends, start)
+
+            while i < len(periods) and periods[i][0] < end:
+                busy.setdefault(fbtype, []).append((max(periods[i][0], start), min(periods[i][1], end)))
+                i += 1
+
+        for recurrences in self._recurrences.values():
+            for fbtype, recurrence, overridden in recurrences:
+                ranges = [
+                    (max(range_start, start), min(range_end, end))
+                    for range_start, range_end in recurrence.between(start, end)
+                    if range_start < range_end and range_start not in overridden
+                ]
+
+                if ranges:
+                    busy[fbtype] = merge(sorted(busy.get(fbtype, []) + ranges))
+
+        return busy
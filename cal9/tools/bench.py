@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Measure the request handlers against synthetic calendars, driving the
+    WSGI application in-process.
+
+    Usage :
+
+        python -m cal9.tools.bench [options]
+
+    Options :
+
+        --backend NAME       storage backend to measure (filesystem)
+        --events N,N,...     sizes of the calendars, in events (100,1000)
+        --recurring RATIO    part of the events which recur (0.2)
+        --timezones N        number of timezones the events use (2)
+        --size BYTES         approximate size of an event (400)
+        --requests N         requests per operation and size (50)
+        --cold               empty the parsed calendars cache before each request
+        --save FILE          save the results as a baseline
+        --compare FILE       compare the results with a saved baseline
+        --tolerance RATIO    median slowdown reported as a regression (0.2)
+
+    Latencies are given in milliseconds, throughput in requests per second
+    and memory in MiB. Each operation is measured in a process forked for
+    it, memory is the peak resident size of that process : the size of the
+    application when forked, plus what the operation used at most. With
+    ``--compare``, the exit status is 1 if an operation got slower than the
+    tolerance allows.
+"""
+
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+import simplejson as json
+import resource
+import platform
+import tempfile
+import shutil
+import traceback
+import random
+import time
+import sys
+import os
+
+DEFAULTS = {
+    'backend': 'filesystem',
+    'events': '100,1000',
+    'recurring': '0.2',
+    'timezones': '2',
+    'size': '400',
+    'requests': '50',
+    'tolerance': '0.2',
+}
+
+# Monday of the first week of the synthetic calendars
+START = datetime(2026, 1, 5)
+
+PROPFIND = """<?xml version="1.0" encoding="utf-8" ?>
+<D:propfind xmlns:D="DAV:" xmlns:CS="http://calendarserver.org/ns/">
+    <D:prop>
+        <D:getetag />
+        <D:resourcetype />
+        <CS:getctag />
+    </D:prop>
+</D:propfind>"""
+
+MULTIGET = """<?xml version="1.0" encoding="utf-8" ?>
+<C:calendar-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+    <D:prop>
+        <D:getetag />
+        <C:calendar-data />
+    </D:prop>
+    {0}
+</C:calendar-multiget>"""
+
+QUERY = """<?xml version="1.0" encoding="utf-8" ?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+    <D:prop>
+        <D:getetag />
+        <C:calendar-data />
+    </D:prop>
+    <C:filter>
+        <C:comp-filter name="VCALENDAR">
+            <C:comp-filter name="VEVENT">
+                <C:time-range start="{0:%Y%m%dT%H%M%SZ}" end="{1:%Y%m%dT%H%M%SZ}" />
+            </C:comp-filter>
+        </C:comp-filter>
+    </C:filter>
+</C:calendar-query>"""
+
+TIMEZONE = """BEGIN:VTIMEZONE
+TZID:Bench/Zone-{0}
+BEGIN:STANDARD
+DTSTART:19700101T000000
+TZOFFSETFROM:+{0:02d}00
+TZOFFSETTO:+{0:02d}00
+END:STANDARD
+END:VTIMEZONE
+"""
+
+def parse_args(argv):
+    """ Return the options given by ``argv``, completed by the defaults """
+
+    options = dict(DEFAULTS)
+    args = iter(argv)
+
+    for arg in args:
+        if arg == '--cold':
+            options['cold'] = True
+
+        elif arg[2:] in DEFAULTS or arg[2:] in ('save', 'compare'):
+            options[arg[2:]] = next(args)
+
+        else:
+            raise ValueError('Unknown option: {0}'.format(arg))
+
+    return options
+
+def timezone(i):
+    """ Definition of the ``i``-th synthetic timezone """
+
+    return TIMEZONE.format(i).replace('\n', '\r\n')
+
+def event(rand, i, options):
+    """ Generate the ``i``-th synthetic event, with its timezone """
+
+    timezones = int(options['timezones'])
+
+    # Spread the events over a year of working hours
+    start = START + timedelta(days=rand.randrange(365), hours=rand.randrange(8, 18))
+    lines = ['BEGIN:VEVENT', 'UID:bench-{0}'.format(i)]
+
+    if timezones:
+        tz = i % timezones
+        lines.append('DTSTART;TZID=Bench/Zone-{0}:{1:%Y%m%dT%H%M%S}'.format(tz, start))
+        lines.append('DTEND;TZID=Bench/Zone-{0}:{1:%Y%m%dT%H%M%S}'.format(tz, start + timedelta(hours=1)))
+    else:
+        lines.append('DTSTART:{0:%Y%m%dT%H%M%SZ}'.format(start))
+        lines.append('DTEND:{0:%Y%m%dT%H%M%SZ}'.format(start + timedelta(hours=1)))
+
+    if rand.random() < float(options['recurring']):
+        # Half of the recurrences never end
+        if rand.random() < 0.5:
+            lines.append('RRULE:FREQ=WEEKLY;COUNT=20')
+        else:
+            lines.append('RRULE:FREQ=WEEKLY')
+
+    lines.append('SUMMARY:Synthetic event {0}'.format(i))
+
+    # Pad the description up to the item size
+    padding = int(options['size']) - sum(len(line) + 2 for line in lines) - 30
+    lines.append('DESCRIPTION:{0}'.format('x' * max(padding, 0)))
+    lines.append('END:VEVENT')
+
+    body = '\r\n'.join(lines) + '\r\n'
+
+    if timezones:
+        body = timezone(i % timezones) + body
+
+    return 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:bench\r\n{0}END:VCALENDAR\r\n'.format(body)
+
+def populate(path, count, options):
+    """ Store a synthetic calendar of ``count`` events at ``path`` """
+
+    from cal9 import ical
+    import icalendar
+
+    rand = random.Random(count)
+    calendar = icalendar.Calendar()
+
+    for i in range(int(options['timezones'])):
+        calendar.add_component(icalendar.Calendar.from_ical(
+            'BEGIN:VCALENDAR\r\n{0}END:VCALENDAR\r\n'.format(timezone(i))
+        ).subcomponents[0])
+
+    for i in range(count):
+        for component in icalendar.Calendar.from_ical(event(rand, i, options)).subcomponents:
+            if component.name == 'VEVENT':
+                component['X-CAL9-NAME'] = icalendar.vText('bench-{0}'.format(i))
+                calendar.add_component(component)
+
+    # Store the whole calendar at once, as the migration tool does
+    collection = ical.Collection(path)
+    collection._ical = calendar
+    collection.save()
+
+class Client(object):
+    """ Send requests to the WSGI application in-process """
+
+    def __init__(self, application, cold):
+        self.application = application
+        self.cold = cold
+
+    def request(self, method, path, body='', **headers):
+        """ Return the status of the request, once its body was sent """
+
+        if self.cold:
+            filesystem = sys.modules.get('cal9.backends.filesystem')
+
+            if filesystem:
+                filesystem.CACHE.clear()
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_LENGTH': str(len(body)),
+            'CONTENT_TYPE': 'text/xml; charset=utf-8',
+            'HTTP_HOST': 'localhost',
+            'wsgi.input': StringIO(body),
+        }
+
+        for key, value in headers.items():
+            environ['HTTP_{0}'.format(key.upper())] = value
+
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+
+        content = self.application(environ, start_response)
+
+        for chunk in content:
+            pass
+
+        if hasattr(content, 'close'):
+            content.close()
+
+        return response['status']
+
+def operations(path, count, options):
+    """ Yield the name of each operation, and a function sending one request """
+
+    rand = random.Random(count)
+    created = []
+
+    def item(i):
+        return '{0}bench-{1}.ics'.format(path, i)
+
+    def multiget():
+        hrefs = ''.join(
+            '<D:href>{0}</D:href>'.format(item(rand.randrange(count)))
+            for i in range(10)
+        )
+
+        return 'REPORT', path, MULTIGET.format(hrefs), {}
+
+    def query():
+        start = START + timedelta(weeks=rand.randrange(52))
+        return 'REPORT', path, QUERY.format(start, start + timedelta(weeks=1)), {}
+
+    def put():
+        i = count + len(created)
+        created.append(item(i))
+
+        return 'PUT', item(i), event(rand, i, options), {}
+
+    def delete():
+        return 'DELETE', created.pop(), '', {}
+
+    yield 'propfind', lambda: ('PROPFIND', path, PROPFIND, {'depth': '1'})
+    yield 'multiget', multiget
+    yield 'query', query
+    yield 'get-item', lambda: ('GET', item(rand.randrange(count)), '', {})
+    yield 'get-calendar', lambda: ('GET', path, '', {})
+    yield 'put', put
+    yield 'delete', delete
+
+def percentile(values, ratio):
+    """ Return the value below which ``ratio`` of the sorted ``values`` are """
+
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+def measure(client, requests):
+    """ Send ``requests``, but the first one, and return their statistics """
+
+    # Let caches fill up, as in a running server
+    method, path, body, headers = requests[0]
+    client.request(method, path, body, **headers)
+
+    latencies = []
+    started = time.time()
+
+    for method, path, body, headers in requests[1:]:
+        before = time.time()
+        status = client.request(method, path, body, **headers)
+        latencies.append(time.time() - before)
+
+        if int(status.split()[0]) >= 400:
+            raise RuntimeError('{0} {1} failed: {2}'.format(method, path, status))
+
+    elapsed = time.time() - started
+    latencies.sort()
+
+    return {
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p90': percentile(latencies, 0.9) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'throughput': len(latencies) / elapsed,
+        'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+def forked(function, *args):
+    """
+        Call ``function`` in a child process, for its peak memory use to be
+        its own, and return its result sent back as JSON.
+    """
+
+    read, write = os.pipe()
+    pid = os.fork()
+
+    if not pid:
+        status = 1
+
+        try:
+            os.close(read)
+
+            with os.fdopen(write, 'w') as f:
+                json.dump(function(*args), f)
+
+            status = 0
+
+        except BaseException:
+            traceback.print_exc()
+
+        finally:
+            os._exit(status)
+
+    os.close(write)
+
+    with os.fdopen(read) as f:
+        text = f.read()
+
+    if os.waitpid(pid, 0)[1]:
+        raise RuntimeError('{0} failed in process {1}'.format(function.__name__, pid))
+
+    return json.loads(text)
+
+def run(options):
+    """ Run the benchmark described by ``options``, return its results """
+
+    folder = tempfile.mkdtemp(prefix='cal9-bench-')
+
+    try:
+        confpath = os.path.join(folder, 'config.json')
+
+        with open(confpath, 'w') as f:
+            json.dump({
+                'backend': options['backend'],
+                'debug': False,
+                'calendars': {
+                    'folder': os.path.join(folder, 'calendars'),
+                    'database': os.path.join(folder, 'calendars.sqlite'),
+                },
+            }, f)
+
+        from cal9.app import Application
+
+        client = Client(Application(confpath), options.get('cold', False))
+        results = {}
+
+        for count in [int(n) for n in options['events'].split(',')]:
+            path = '/bench/events-{0}/'.format(count)
+            populate(path, count, options)
+
+            results[str(count)] = {}
+
+            for name, request in operations(path, count, options):
+                # Built here, the operations of the next ones depend on them
+                requests = [request() for i in range(int(options['requests']) + 1)]
+
+                stats = forked(measure, client, requests)
+                results[str(count)][name] = stats
+
+                print '{0:>7} {1:<13} p50 {p50:8.2f}  p90 {p90:8.2f}  p99 {p99:8.2f}  {throughput:8.1f}/s  peak {memory:7.1f} MiB'.format(
+                        count, name, **stats
+                )
+
+        return results
+
+    finally:
+        shutil.rmtree(folder)
+
+def compare(results, baseline, tolerance):
+    """ Print the operations slower than ``baseline``, return their number """
+
+    regressions = 0
+
+    for count, stats in sorted(results.items()):
+        for name, current in sorted(stats.items()):
+            previous = baseline.get(count, {}).get(name)
+
+            if not previous:
+                continue
+
+            ratio = current['p50'] / previous['p50']
+
+            if ratio > 1 + tolerance:
+                regressions += 1
+                print '{0:>7} {1:<13} p50 {2:8.2f} -> {3:8.2f}  (+{4:.0%})'.format(
+                        count, name, previous['p50'], current['p50'], ratio - 1
+                )
+
+    return regressions
+
+def main(argv):
+    try:
+        options = parse_args(argv[1:])
+    except (ValueError, StopIteration):
+        print >>sys.stderr, __doc__
+        return 1
+
+    results = run(options)
+
+    if options.get('save'):
+        with open(options['save'], 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'options': options,
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+    if options.get('compare'):
+        with open(options['compare']) as f:
+            baseline = json.load(f)
+
+        if baseline['options'].get('backend') != options['backend']:
+            print >>sys.stderr, "Baseline measured the '{0}' backend".format(baseline['options'].get('backend'))
+            return 1
+
+        if compare(results, baseline['results'], float(options['tolerance'])):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Import large iCalendar files into a collection, or export a collection,
+    through the configured backend but without going through requests.
+
+    Usage :
+
+        python -m cal9.tools.bulk /path/to/config.json import /user/calendar/ FILE [--processes N]
+        python -m cal9.tools.bulk /path/to/config.json export /user/calendar/ [FILE]
+
+    ``-`` stands for the standard input or output, which exports are written
+    to by default.
+
+    Imports read the file as a stream, and parse its components in
+    ``--processes`` processes, one per CPU by default. The items are then
+    stored at once: items of the collection with the same name are replaced,
+    the others are kept. Each item comes with the timezones it refers to.
+
+    Exports copy the stored calendar when the backend allows it, and are
+    written item by item otherwise.
+"""
+
+from cal9 import config
+from cal9 import log
+from cal9 import ical
+
+from collections import OrderedDict
+
+import multiprocessing
+import icalendar
+import shutil
+import sys
+
+# Components parsed by a process at a time
+BATCH_SIZE = 200
+
+# Size of the blocks stored calendars are copied by
+CHUNK_SIZE = 64 * 1024
+
+def split(lines):
+    """ Yield the text of each top-level component of the iCalendar ``lines`` """
+
+    depth = 0
+    component = []
+
+    for line in lines:
+        if line[:6].upper() == 'BEGIN:':
+            depth += 1
+
+        if depth >= 2:
+            component.append(line)
+
+        if line[:4].upper() == 'END:':
+            depth -= 1
+
+            if depth == 1:
+                yield ''.join(component)
+                component = []
+
+def batches(iterable, size):
+    """ Yield lists of ``size`` elements of ``iterable`` """
+
+    batch = []
+
+    for element in iterable:
+        batch.append(element)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def normalize(texts):
+    """
+        Parse the components of ``texts``, return each of them with the name
+        of the item it belongs to, found and set as ``ical.Item`` does.
+    """
+
+    calendar = ical.parse('BEGIN:VCALENDAR\r\n{0}END:VCALENDAR\r\n'.format(''.join(texts)))
+    components = []
+
+    for component in calendar.subcomponents:
+        alone = icalendar.Calendar()
+        alone.add_component(component)
+
+        name = ical.Item(alone).name
+
+        if component.name != ical.Timezone.tag:
+            component['X-CAL9-NAME'] = icalendar.vText(name)
+
+        components.append((name, component))
+
+    return components
+
+def import_calendar(collection, lines, processes=None):
+    """ Store the items of the iCalendar ``lines`` in ``collection``, return their number """
+
+    items = OrderedDict()
+    timezones = {}
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        # Batches come back in order, recurrences stay before their exceptions
+        for batch in pool.imap(normalize, batches(split(lines), BATCH_SIZE)):
+            for name, component in batch:
+                if component.name == ical.Timezone.tag:
+                    timezones.setdefault(name, component)
+                else:
+                    items.setdefault(name, []).append(component)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    calendars = OrderedDict()
+
+    for name, components in items.items():
+        calendar = icalendar.Calendar()
+
+        for tzid in sorted(ical.tzids(components)):
+            if tzid in timezones:
+                calendar.add_component(timezones[tzid])
+
+        for component in components:
+            calendar.add_component(component)
+
+        calendars[name] = calendar
+
+    collection.extend(calendars)
+
+    return len(calendars)
+
+def export_calendar(collection, output):
+    """
+        Write the items of ``collection`` to ``output``, return their number,
+        or None if the stored calendar was copied as is.
+    """
+
+    raw = collection.get_raw()
+
+    if raw:
+        stored, size = raw
+
+        with stored:
+            shutil.copyfileobj(stored, output, CHUNK_SIZE)
+
+        return None
+
+    output.write('BEGIN:VCALENDAR\r\nVERSION:{0}\r\nPRODID:{1}\r\n'.format(ical.VERSION, ical.PRODID))
+
+    for block in collection.timezone_blocks():
+        output.write(block)
+
+    # Only one item is held at a time
+    names = sorted(collection.names)
+
+    for name in names:
+        item = collection.get_item(name)
+
+        for component in item.ical.subcomponents if item else []:
+            if component.name != ical.Timezone.tag:
+                output.write(ical.serialize(component))
+
+    output.write('END:VCALENDAR\r\n')
+
+    return len(names)
+
+def main(argv):
+    if len(argv) < 4 or argv[2] not in ('import', 'export'):
+        print >>sys.stderr, __doc__
+        return 1
+
+    command, path, args = argv[2], argv[3].strip('/'), argv[4:]
+
+    try:
+        processes = int(args[args.index('--processes') + 1]) if '--processes' in args else None
+    except (IndexError, ValueError):
+        print >>sys.stderr, __doc__
+        return 1
+
+    if command == 'import' and not args:
+        print >>sys.stderr, __doc__
+        return 1
+
+    config.load(argv[1])
+    log.configure()
+
+    from cal9 import backends
+    backends.load()
+
+    collection = ical.Collection(path)
+    filename = args[0] if args else '-'
+
+    if command == 'import':
+        lines = sys.stdin if filename == '-' else open(filename, 'rb')
+
+        with lines:
+            count = import_calendar(collection, lines, processes)
+
+        print >>sys.stderr, '{0}: {1} items imported'.format(path, count)
+
+    else:
+        output = sys.stdout if filename == '-' else open(filename, 'wb')
+
+        with output:
+            count = export_calendar(collection, output)
+
+        if count is None:
+            print >>sys.stderr, '{0}: copied as stored'.format(path)
+        else:
+            print >>sys.stderr, '{0}: {1} items exported'.format(path, count)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
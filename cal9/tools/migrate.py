@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Migrate calendars from the ``filesystem`` backend, which stores a whole
+    calendar in one file, to the ``multifilesystem`` backend, which stores a
+    calendar as a folder with one file per item.
+
+    Usage :
+
+        python -m cal9.tools.migrate /path/to/config.json [--keep]
+
+    The configuration must still use the ``filesystem`` backend, switch it to
+    ``multifilesystem`` once the migration is done. With ``--keep``, the
+    original files are kept next to the new folders with an ``.orig`` suffix.
+"""
+
+from cal9 import config
+from cal9 import log
+
+import sys
+import os
+
+# Left in the calendars folder once migrated, to never migrate items again
+MARKER = '.multifilesystem'
+
+def single_file_calendars(folder, sidecars):
+    """ Yield the path, relative to ``folder``, of every calendar file """
+
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            if filename.startswith('.') or filename.endswith(sidecars):
+                continue
+
+            path = os.path.relpath(os.path.join(root, filename), folder)
+            yield '/'.join(path.split(os.sep))
+
+def migrate(path, keep=False):
+    """ Migrate the calendar at ``path`` to the per-item storage layout """
+
+    from cal9.backends import filesystem, multifilesystem
+
+    source = filesystem.Collection(path)
+    target = multifilesystem.Collection('{0}.migrating'.format(path))
+
+    target._ical = source.ical
+    target.write()
+
+    backup = '{0}.orig'.format(source._path)
+    os.rename(source._path, backup)
+    os.rename(target._path, source._path)
+
+    # The metadata of the calendar is kept, with its synchronization history
+    for suffix in filesystem.SIDECARS:
+        if os.path.exists(target._path + suffix):
+            os.remove(target._path + suffix)
+
+    if not keep:
+        os.remove(backup)
+
+    return len(multifilesystem.Collection(path)._item_names())
+
+def main(argv):
+    if len(argv) < 2:
+        print >>sys.stderr, __doc__
+        return 1
+
+    config.load(argv[1])
+    log.configure()
+
+    keep = '--keep' in argv[2:]
+
+    if config.config.backend != 'filesystem':
+        print >>sys.stderr, "Configured backend is '{0}', expected 'filesystem'".format(
+                config.config.backend
+        )
+        return 1
+
+    from cal9.backends import filesystem
+
+    folder = config.config.calendars.folder
+    marker = os.path.join(folder, MARKER)
+
+    if os.path.exists(marker):
+        print >>sys.stderr, "'{0}' has already been migrated".format(folder)
+        return 1
+
+    for path in list(single_file_calendars(folder, filesystem.SIDECARS + ('.orig',))):
+        count = migrate(path, keep)
+        print '{0}: {1} items'.format(path, count)
+
+    with open(marker, 'w') as f:
+        f.write('multifilesystem\n')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+
+import threading
 import httplib
 
-def http_response(code):
-    return 'HTTP/1.1 {0} {1}'.format(code, httplib.responses[code])
+# WebDAV status codes unknown to httplib [RFC 4918 11]
+WEBDAV_RESPONSES = {
+    207: 'Multi-Status',
+    422: 'Unprocessable Entity',
+    423: 'Locked',
+    424: 'Failed Dependency',
+    507: 'Insufficient Storage',
+}
 
-def DEBUG(msg):
-    import config
-    import sys
+def http_status(code):
+    reason = httplib.responses.get(code) or WEBDAV_RESPONSES[code]
+    return '{0} {1}'.format(code, reason)
 
-    if config.config.debug:
-        for line in msg.splitlines():
-            print >>sys.stderr, "\033[01;31mDEBUG:\033[00m", line
+def http_response(code):
+    return 'HTTP/1.1 {0}'.format(http_status(code))
 
 
 class Dict(dict):
@@ -30,3 +38,86 @@ class Dict(dict):
             else:
                 self[k] = v
 
+
+
+class LRUCache(object):
+    """
+        Thread-safe mapping which drops its least recently used entries once
+        the total weight of its entries exceeds ``maxweight``. Lookups are
+        counted in ``hits`` and ``misses``.
+    """
+
+    def __init__(self, maxweight):
+        self.maxweight = maxweight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, weight = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # Move the entry to the most recently used end
+            self._entries[key] = (value, weight)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, weight=1):
+        with self._lock:
+            if key in self._entries:
+                self.weight -= self._entries.pop(key)[1]
+
+            # Do not evict everything for an entry which can't fit anyway
+            if weight > self.maxweight:
+                return
+
+            self._entries[key] = (value, weight)
+            self.weight += weight
+
+            while self.weight > self.maxweight:
+                evicted, (_, evicted_weight) = self._entries.popitem(last=False)
+                self.weight -= evicted_weight
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, weight = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            self.weight -= weight
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+
+class FileWrapper(object):
+    """
+        Iterate over a file by blocks, used when the WSGI server provides no
+        ``wsgi.file_wrapper`` [PEP 333].
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), '')
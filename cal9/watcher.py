@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Watch the calendar folder for changes, so that the files the backends
+    check before using their caches are only looked at again once they
+    changed, by another process or by this one.
+
+    The ``watch`` section of the configuration enables the watcher, and
+    tells the ``method`` used to find the changes : ``inotify`` on Linux,
+    ``poll`` to look at the known files every ``interval`` seconds, or
+    ``auto`` for inotify when available. Without the watcher, every check
+    asks the filesystem.
+
+    Each process has its own watcher: workers forked once the application
+    was loaded start theirs on first use, and forget what their parent knew.
+"""
+
+from cal9 import config
+from cal9 import metrics
+
+from stat import S_ISDIR
+
+import ctypes.util
+import threading
+import logging
+import atexit
+import ctypes
+import select
+import struct
+import errno
+import os
+
+logger = logging.getLogger(__name__)
+
+# inotify events [inotify(7)]
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+# Header of each event read from inotify: wd, mask, cookie, len
+EVENT = struct.Struct('iIII')
+
+# Settings of the watcher once started, None when files are checked on each use
+_settings = None
+
+# The watcher of each process and its thread, workers being forked
+_watcher = (None, None, None)
+_watcher_lock = threading.Lock()
+
+_lock = threading.Lock()
+_states = {}
+_listings = {}
+_latest = {}
+_generation = 0
+
+## Checks of the files
+
+def stat(path):
+    """
+        Return the ``os.stat`` result of ``path``, raise OSError if it does
+        not exist. Results are kept until the watcher tells ``path`` changed.
+    """
+
+    if not watched(path):
+        return os.stat(path)
+
+    state = _states.get(path)
+
+    if state is None:
+        generation = _generation
+
+        try:
+            state = os.stat(path)
+        except OSError as e:
+            state = e
+
+        _remember(_states, path, state, generation)
+
+    if isinstance(state, OSError):
+        raise state
+
+    return state
+
+def exists(path):
+    """ Check if ``path`` exists, as ``os.path.exists`` """
+
+    try:
+        stat(path)
+    except OSError:
+        return False
+
+    return True
+
+def getmtime(path):
+    """ Return the modification time of ``path``, as ``os.path.getmtime`` """
+
+    return stat(path).st_mtime
+
+def isdir(path):
+    """ Check if ``path`` is a directory, as ``os.path.isdir`` """
+
+    try:
+        return S_ISDIR(stat(path).st_mode)
+    except OSError:
+        return False
+
+def listdir(path):
+    """ Return the names of the entries of the directory ``path``, as ``os.listdir`` """
+
+    if not watched(path):
+        return os.listdir(path)
+
+    names = _listings.get(path)
+
+    if names is None:
+        generation = _generation
+
+        # The listing is forgotten along with the folder's state
+        stat(path)
+        names = os.listdir(path)
+
+        _remember(_listings, path, names, generation)
+
+    return list(names)
+
+def latest(path):
+    """
+        Return the latest modification time of the directory ``path`` and of
+        its entries, as files modified in place do not change the time of
+        their directory.
+    """
+
+    mtime = _latest.get(path)
+
+    if mtime is None:
+        generation = _generation
+        mtime = getmtime(path)
+
+        for name in listdir(path):
+            try:
+                mtime = max(mtime, getmtime(os.path.join(path, name)))
+            except OSError:
+                # Removed meanwhile, which changed the directory
+                pass
+
+        # Forgotten along with the listing, when an entry changes
+        if watched(path):
+            _remember(_latest, path, mtime, generation)
+
+    return mtime
+
+def makedirs(path):
+    """
+        Create the directory ``path`` and its parents if missing, and forget
+        what was known about them.
+    """
+
+    if exists(path):
+        return
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Created meanwhile, by another process or thread
+        if e.errno != errno.EEXIST:
+            raise
+
+    if watched(path):
+        folder = current().folder
+
+        while path.startswith(folder) and path != folder:
+            invalidate(path)
+            path = os.path.dirname(path)
+
+def watched(path):
+    """ Check if the changes made to ``path`` are watched """
+
+    watcher = current()
+    return watcher is not None and path.startswith(watcher.folder)
+
+def _remember(known, path, value, generation):
+    # Only keep what was found if nothing changed meanwhile
+    with _lock:
+        if generation == _generation:
+            known[path] = value
+
+def invalidate(path):
+    """ Forget what is known about ``path``, and about its folder """
+
+    global _generation
+
+    if current() is None:
+        return
+
+    with _lock:
+        _generation += 1
+
+        # Its folder changed too if it was created, removed or renamed
+        for known in (_states, _listings, _latest):
+            known.pop(path, None)
+            known.pop(os.path.dirname(path), None)
+
+    metrics.count('cal9_watcher_invalidations_total')
+
+def forget(prefix):
+    """
+        Forget what is known about the files whose path starts with
+        ``prefix``, for writers to never rely on changes not yet notified.
+    """
+
+    global _generation
+
+    if current() is None:
+        return
+
+    with _lock:
+        _generation += 1
+
+        for known in (_states, _listings, _latest):
+            for path in [path for path in known if path.startswith(prefix)]:
+                del known[path]
+
+def invalidate_all():
+    """ Forget what is known about every file """
+
+    global _generation
+
+    with _lock:
+        _generation += 1
+
+        _states.clear()
+        _listings.clear()
+        _latest.clear()
+
+    metrics.count('cal9_watcher_invalidations_total')
+
+## Watchers
+
+class Inotify(object):
+    """ Find the changes made in ``folder`` and its subfolders with inotify """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.watches = {}
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        # Written to by ``stop`` to wake the watcher up
+        self.wakeup = os.pipe()
+
+        self.watch(folder)
+
+    def watch(self, folder):
+        """ Watch ``folder`` and its subfolders """
+
+        for path, folders, files in os.walk(folder):
+            wd = self.libc.inotify_add_watch(self.fd, path, MASK)
+
+            if wd < 0:
+                logger.warning('Cannot watch %s: %s', path, os.strerror(ctypes.get_errno()))
+                continue
+
+            self.watches[wd] = path
+
+    def stop(self):
+        os.write(self.wakeup[1], '\0')
+
+    def close(self):
+        for fd in (self.fd,) + self.wakeup:
+            os.close(fd)
+
+    def run(self):
+        while True:
+            try:
+                readable, _, _ = select.select([self.fd, self.wakeup[0]], [], [])
+                data = os.read(self.fd, 64 * 1024) if self.fd in readable else ''
+
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+
+                raise
+
+            if self.wakeup[0] in readable:
+                return
+
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip('\0')
+                offset += EVENT.size + length
+
+                self.handle(wd, mask, name)
+
+    def handle(self, wd, mask, name):
+        """ Forget what is known about the file an event is about """
+
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost
+            invalidate_all()
+            return
+
+        folder = self.watches.get(wd)
+
+        if folder is None:
+            return
+
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+
+        if mask & IN_MOVE_SELF:
+            # The watched paths are not valid anymore
+            self.libc.inotify_rm_watch(self.fd, wd)
+            invalidate_all()
+            return
+
+        path = os.path.join(folder, name) if name else folder
+
+        invalidate(path)
+        invalidate(folder)
+
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.watch(path)
+
+            # Files may have been written in the new folder before it was watched
+            for subfolder, folders, files in os.walk(path):
+                for entry in folders + files:
+                    invalidate(os.path.join(subfolder, entry))
+
+class Poller(object):
+    """ Find the changes made to the known files by checking them every ``interval`` seconds """
+
+    def __init__(self, folder, interval):
+        self.folder = folder
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+
+            # Listings are forgotten along with the state of their folder
+            with _lock:
+                known = dict(_states)
+
+            for path, before in known.items():
+                try:
+                    current = os.stat(path)
+                except OSError as e:
+                    current = e
+
+                if not same(before, current):
+                    invalidate(path)
+
+def same(before, after):
+    """ Check if two ``os.stat`` results, or errors, tell the file is unchanged """
+
+    if isinstance(before, OSError) or isinstance(after, OSError):
+        return isinstance(before, OSError) and isinstance(after, OSError)
+
+    return (before.st_mtime, before.st_size, before.st_ino) == (after.st_mtime, after.st_size, after.st_ino)
+
+def start():
+    """
+        Watch the calendar folder if configured, in a background thread of
+        each process using it.
+    """
+
+    global _settings
+
+    settings = config.config.watch or {}
+
+    if _settings is None and settings.get('enabled'):
+        _settings = settings
+        current()
+
+        # Stop before the interpreter tears the modules down
+        atexit.register(stop)
+
+def current():
+    """ Return the watcher of the current process, started if needed, None if not used """
+
+    pid, watcher, thread = _watcher
+
+    if pid == os.getpid() or _settings is None:
+        return watcher
+
+    return _restart()
+
+def _restart():
+    """ Start a watcher in a new process, the one of its parent being inherited without its thread """
+
+    global _watcher, _lock
+
+    with _watcher_lock:
+        pid, watcher, thread = _watcher
+
+        if pid == os.getpid():
+            return watcher
+
+        if watcher is not None:
+            # Its events are for the parent to read
+            watcher.close()
+
+            # The parent's watcher thread may have held it when forked
+            _lock = threading.Lock()
+
+        # Changes made since the parent looked at the files were not seen
+        _states.clear()
+        _listings.clear()
+        _latest.clear()
+
+        folder = config.config.calendars.folder
+        method = _settings.get('method', 'auto')
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        watcher = None
+
+        if method in ('auto', 'inotify'):
+            try:
+                watcher = Inotify(folder)
+
+            except (OSError, AttributeError) as e:
+                # Not Linux, or no more watches available
+                if method == 'inotify':
+                    raise
+
+                logger.info('inotify unavailable, polling instead: %s', e)
+
+        if watcher is None:
+            watcher = Poller(folder, _settings.get('interval', 1.0))
+
+        thread = threading.Thread(target=watcher.run, name='cal9-watcher')
+        thread.daemon = True
+        thread.start()
+
+        _watcher = (os.getpid(), watcher, thread)
+        logger.info('Watching %s with %s', folder, type(watcher).__name__)
+
+        return watcher
+
+def stop():
+    """ Stop the watcher of the current process, and wait for its thread to end """
+
+    global _watcher
+
+    pid, watcher, thread = _watcher
+
+    if pid != os.getpid() or watcher is None:
+        return
+
+    watcher.stop()
+    thread.join()
+    watcher.close()
+
+    # Nothing is watched anymore, what is known may get stale
+    _watcher = (pid, None, None)
+    invalidate_all()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from util import http_response
+import timerange
+import metrics
 import ical
 
 import xml.etree.ElementTree as ET
@@ -46,11 +48,173 @@ def tag_clark(tagname):
 
     return tagname
 
+# Properties computed by ``propfind_response``, which PROPPATCH can't set
+PROTECTED_PROPS = (
+    tag('D', 'getetag'),
+    tag('D', 'getcontenttype'),
+    tag('D', 'resourcetype'),
+    tag('D', 'owner'),
+    tag('D', 'sync-token'),
+    tag('D', 'principal-URL'),
+    tag('D', 'principal-collection-set'),
+    tag('D', 'current-user-principal'),
+    tag('D', 'current-user-privilege-set'),
+    tag('D', 'supported-report-set'),
+    tag('C', 'calendar-user-address-set'),
+    tag('C', 'calendar-home-set'),
+    tag('C', 'calendar-timezone'),
+    tag('C', 'supported-calendar-component-set'),
+    tag('CS', 'getctag'),
+)
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8" ?>'
+
+# Streamed bodies are sent by chunks of about this size
+CHUNK_SIZE = 64 * 1024
+
 def render(xml):
     """ Render XML tree to string """
 
-    return u'<?xml version="1.0" encoding="utf-8" ?>{0}'.format(ET.tostring(xml))
+    with metrics.timed('render'):
+        return u'{0}{1}'.format(XML_DECLARATION, ET.tostring(xml))
+
+def render_multistatus(elements):
+    """
+        Render a multistatus element containing ``elements`` as an iterator
+        of chunks. Elements are serialized one at a time, so that neither the
+        whole tree nor the whole document is ever held in memory.
+    """
+
+    chunk = [XML_DECLARATION, '<multistatus xmlns="{0}">'.format(NAMESPACES['D'])]
+    size = 0
+
+    for element in elements:
+        # Each element declares the namespaces it uses
+        with metrics.timed('render'):
+            text = ET.tostring(element)
+
+        chunk.append(text)
+        size += len(text)
+
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+
+            chunk = []
+            size = 0
+
+    chunk.append('</multistatus>')
+    yield ''.join(chunk)
+
+
+def comp_filters(dom):
+    """
+        Return the component filters of a calendar-query [RFC 4791 9.7] as a
+        list of (component name, time-range start, time-range end, defined),
+        or None if the query does not filter components. Filters on nested
+        components and on properties are not supported, and match everything.
+    """
+
+    calendar = dom.find('/'.join([tag('C', 'filter'), tag('C', 'comp-filter')]))
+
+    if calendar is None or calendar.get('name', '').upper() != 'VCALENDAR':
+        return None
+
+    filters = []
+
+    for element in calendar.findall(tag('C', 'comp-filter')):
+        time_range = element.find(tag('C', 'time-range'))
+
+        if time_range is not None:
+            start = timerange.parse_utc(time_range.get('start'))
+            end = timerange.parse_utc(time_range.get('end'))
+        else:
+            start = end = None
+
+        defined = element.find(tag('C', 'is-not-defined')) is None
+
+        filters.append((element.get('name').upper(), start, end, defined))
+
+    return filters or None
+
+def recurrence_limit(dom):
+    """
+        Return how the calendar data of a REPORT is asked to present
+        recurrences [RFC 4791 9.6.5, 9.6.6], as ('expand' or
+        'limit-recurrence-set', start, end), or None to leave them as stored.
+    """
+
+    path = '/'.join([tag('D', 'prop'), tag('C', 'calendar-data')])
+
+    for name in ('expand', 'limit-recurrence-set'):
+        element = dom.find('/'.join([path, tag('C', name)]))
+
+        if element is not None:
+            start = timerange.parse_utc(element.get('start'))
+            end = timerange.parse_utc(element.get('end'))
+
+            # Both bounds are required, recurrences may be endless
+            if start and end:
+                return name, start, end
+
+    return None
+
+def report_response(href, props, etag=None, calendar_data=None):
+    """
+        Perform a REPORT on the item found at ``href``, whose ``etag`` and
+        ``calendar_data`` are only given if they are in ``props``.
+    """
+
+    response = ET.Element(tag('D', 'response'))
+
+    xmlhref = ET.Element(tag('D', 'href'))
+    xmlhref.text = href
+    response.append(xmlhref)
+
+    propstat = ET.Element(tag('D', 'propstat'))
+    response.append(propstat)
+
+    prop = ET.Element(tag('D', 'prop'))
+    propstat.append(prop)
+
+    for xmltag in props:
+        element = ET.Element(xmltag)
+
+        if xmltag == tag('D', 'getetag'):
+            element.text = etag
+
+        elif xmltag == tag('C', 'calendar-data'):
+            element.text = calendar_data
+
+        prop.append(element)
+
+    status = ET.Element(tag('D', 'status'))
+    status.text = http_response(200)
+    propstat.append(status)
 
+    return response
+
+def removed_response(href):
+    """ Response telling that the item at ``href`` does not exist anymore """
+
+    response = ET.Element(tag('D', 'response'))
+
+    xmlhref = ET.Element(tag('D', 'href'))
+    xmlhref.text = href
+    response.append(xmlhref)
+
+    status = ET.Element(tag('D', 'status'))
+    status.text = http_response(404)
+    response.append(status)
+
+    return response
+
+def error(condition):
+    """ Error body for a failed precondition or postcondition [RFC 4918] """
+
+    element = ET.Element(tag('D', 'error'))
+    element.append(ET.Element(tag('D', condition)))
+
+    return element
 
 def propfind_response(path, item, props):
     """ Perform a PROPFIND on ``item`` """
@@ -58,15 +222,19 @@ def propfind_response(path, item, props):
     is_collection = isinstance(item, ical.Collection)
 
     if is_collection:
-        with item.props as properties:
-            collection_props = properties
+        collection_props = item.properties
 
     response = ET.Element(tag('D', 'response'))
 
     href = ET.Element(tag('D', 'href'))
-    href.text = item.name
     response.append(href)
 
+    if is_collection:
+        # Its name is its display name, which clients may change
+        href.text = '/{0}/'.format(item.path.strip('/')).replace('//', '/')
+    else:
+        href.text = item.name
+
     propstat404 = ET.Element(tag('D', 'propstat'))
     propstat200 = ET.Element(tag('D', 'propstat'))
     response.append(propstat200)
@@ -145,8 +313,11 @@ def propfind_response(path, item, props):
             elif xmltag == tag('CS', 'getctag'):
                 element.text = item.etag
 
+            elif xmltag == tag('D', 'sync-token'):
+                element.text = item.sync_token
+
             elif xmltag == tag('C', 'calendar-timezone'):
-                element.text = item.timezones.to_ical()
+                element.text = ical.calendar_text(item.timezone_blocks())
 
             else:
                 tagname = tag_clark(xmltag)
@@ -185,3 +356,36 @@ def propfind_response(path, item, props):
 
     return response
 
+def proppatch_response(path, statuses):
+    """ Report the ``statuses`` of the properties set by a PROPPATCH """
+
+    response = ET.Element(tag('D', 'response'))
+
+    href = ET.Element(tag('D', 'href'))
+    href.text = path
+    response.append(href)
+
+    codes = []
+
+    for xmltag, code in statuses:
+        if code not in codes:
+            codes.append(code)
+
+    # One propstat per status
+    for code in codes:
+        propstat = ET.Element(tag('D', 'propstat'))
+        response.append(propstat)
+
+        prop = ET.Element(tag('D', 'prop'))
+        propstat.append(prop)
+
+        for xmltag, status in statuses:
+            if status == code:
+                prop.append(ET.Element(xmltag))
+
+        status = ET.Element(tag('D', 'status'))
+        status.text = http_response(code)
+        propstat.append(status)
+
+    return response
+
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Tests of 9cal, run from the root of the repository with :
+
+        python -m unittest discover -s tests -t .
+
+    The backends read the configuration when they are imported, so it is
+    loaded here once, storing the calendars in a temporary folder.
+"""
+
+from cal9 import config
+
+from StringIO import StringIO
+
+import simplejson as json
+import tempfile
+import atexit
+import shutil
+import os
+
+ROOT = tempfile.mkdtemp(prefix='cal9-tests-')
+atexit.register(shutil.rmtree, ROOT, True)
+
+CONFIG = os.path.join(ROOT, 'config.json')
+
+with open(CONFIG, 'w') as f:
+    json.dump({
+        'backend': 'filesystem',
+        'calendars': {
+            'folder': os.path.join(ROOT, 'calendars'),
+            'database': os.path.join(ROOT, 'calendars.sqlite'),
+        },
+    }, f)
+
+config.load(CONFIG)
+
+_application = None
+
+def event(uid, start='20260105T100000', tzid='Europe/Paris', extra=''):
+    """ Return an iCalendar object holding the event ``uid`` and its timezone """
+
+    from cal9 import ical
+
+    return ical.parse((
+        'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//tests//\r\n'
+        'BEGIN:VTIMEZONE\r\nTZID:{tzid}\r\n'
+        'BEGIN:STANDARD\r\nDTSTART:19701025T030000\r\nTZOFFSETFROM:+0200\r\n'
+        'TZOFFSETTO:+0100\r\nEND:STANDARD\r\nEND:VTIMEZONE\r\n'
+        'BEGIN:VEVENT\r\nUID:{uid}\r\nDTSTART;TZID={tzid}:{start}\r\n'
+        'DURATION:PT1H\r\nSUMMARY:{uid}\r\n{extra}END:VEVENT\r\n'
+        'END:VCALENDAR\r\n'
+    ).format(uid=uid, start=start, tzid=tzid, extra=extra))
+
+def request(backend, method, path, body='', **headers):
+    """
+        Send a request to the application storing calendars with the
+        ``backend`` module, return its status, headers and body.
+    """
+
+    from cal9 import ical
+    from cal9.app import Application
+
+    global _application
+
+    if _application is None:
+        _application = Application(CONFIG)
+
+    ical.Collection = backend.Collection
+
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': 'text/xml; charset=utf-8',
+        'wsgi.input': StringIO(body),
+    }
+
+    for key, value in headers.items():
+        environ['HTTP_{0}'.format(key.upper().replace('-', '_'))] = value
+
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = int(status.split()[0])
+        response['headers'] = dict(headers)
+
+    content = ''.join(_application(environ, start_response))
+
+    return response['status'], response['headers'], content
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+
+from tests import event, request
+
+from cal9 import config
+from cal9 import ical
+from cal9 import xmlutils
+from cal9.backends import filesystem, journal, multifilesystem, sqlite
+
+import xml.etree.ElementTree as ET
+import threading
+import unittest
+
+BACKENDS = filesystem, journal, multifilesystem, sqlite
+
+def path(backend, name):
+    """ Path of the collection ``name`` stored with ``backend`` """
+
+    return 'user/{0}-{1}'.format(name, backend.__name__.split('.')[-1])
+
+def hrefs(content):
+    """ Names of the items a multistatus body answers for, in order """
+
+    dom = ET.fromstring(content)
+
+    return [
+        href.text.rsplit('/', 1)[1].rsplit('.', 1)[0]
+        for href in dom.iter(xmlutils.tag('D', 'href'))
+    ]
+
+QUERY = """<?xml version="1.0" encoding="utf-8" ?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+    <D:prop>
+        <D:getetag />
+    </D:prop>
+    <C:filter>
+        <C:comp-filter name="VCALENDAR">
+            <C:comp-filter name="VEVENT">
+                <C:time-range start="{0}" end="{1}" />
+            </C:comp-filter>
+        </C:comp-filter>
+    </C:filter>
+</C:calendar-query>"""
+
+class PutTest(unittest.TestCase):
+    def put(self, backend, name, extra='', **headers):
+        body = event(name, extra=extra).to_ical()
+        return request(backend, 'PUT', '/{0}/{1}.ics'.format(path(backend, 'put'), name), body, **headers)
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'put')).delete()
+
+    def test_replace_is_one_change(self):
+        for backend in BACKENDS:
+            self.put(backend, 'e0')
+            before = backend.Collection(path(backend, 'put')).etag
+
+            self.put(backend, 'e0', 'SEQUENCE:1\r\n')
+            after = backend.Collection(path(backend, 'put')).etag
+
+            generation = lambda etag: int(etag.strip('"').rsplit('-', 1)[1])
+            self.assertEqual(generation(after), generation(before) + 1, backend.__name__)
+
+    def test_preconditions(self):
+        for backend in BACKENDS:
+            status, headers, content = self.put(backend, 'e0', **{'If-Match': '"nope"'})
+            self.assertEqual(status, 412)
+
+            status, headers, content = self.put(backend, 'e0', **{'If-None-Match': '*'})
+            self.assertEqual(status, 201)
+            etag = headers['ETag']
+
+            status, headers, content = self.put(backend, 'e0', **{'If-None-Match': '*'})
+            self.assertEqual(status, 412)
+
+            status, headers, content = self.put(backend, 'e0', 'SEQUENCE:1\r\n', **{'If-Match': etag})
+            self.assertEqual(status, 201)
+            self.assertNotEqual(headers['ETag'], etag)
+
+            status, headers, content = self.put(backend, 'e0', **{'If-Match': etag})
+            self.assertEqual(status, 412)
+
+    def test_concurrent_preconditions(self):
+        for backend in BACKENDS:
+            status, headers, content = self.put(backend, 'e0')
+            etag = headers['ETag']
+            statuses = []
+
+            def put(n):
+                status, headers, content = self.put(
+                    backend, 'e0', 'SEQUENCE:{0}\r\n'.format(n), **{'If-Match': etag}
+                )
+                statuses.append(status)
+
+            threads = [threading.Thread(target=put, args=(n,)) for n in range(1, 9)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            # Only the first one changes the item the others expect
+            self.assertEqual(sorted(statuses), [201] + [412] * 7, backend.__name__)
+
+SYNC = """<?xml version="1.0" encoding="utf-8" ?>
+<D:sync-collection xmlns:D="DAV:">
+    <D:sync-token>{0}</D:sync-token>
+    <D:sync-level>1</D:sync-level>
+    <D:prop>
+        <D:getetag />
+    </D:prop>
+</D:sync-collection>"""
+
+class SyncCollectionTest(unittest.TestCase):
+    """ sync-collection REPORTs [RFC 6578] """
+
+    def url(self, backend):
+        return '/{0}/'.format(path(backend, 'sync'))
+
+    def setUp(self):
+        for backend in BACKENDS:
+            collection = backend.Collection(path(backend, 'sync'))
+
+            for name in ('e0', 'e1', 'e2'):
+                collection.append(name, event(name))
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'sync')).delete()
+
+    def sync(self, backend, token=''):
+        """ Return the changed items, the removed items and the new token """
+
+        status, headers, content = request(backend, 'REPORT', self.url(backend), SYNC.format(token))
+        self.assertEqual(status, 207, content)
+
+        dom = ET.fromstring(content)
+        changed, removed = [], []
+
+        for response in dom.findall(xmlutils.tag('D', 'response')):
+            name = response.findtext(xmlutils.tag('D', 'href')).rsplit('/', 1)[1][:-len('.ics')]
+
+            if response.findtext(xmlutils.tag('D', 'status'), '').split()[1:2] == ['404']:
+                removed.append(name)
+            else:
+                changed.append(name)
+
+        return sorted(changed), sorted(removed), dom.findtext(xmlutils.tag('D', 'sync-token'))
+
+    def change(self, backend):
+        """ Replace e0, remove e1 and add e3 """
+
+        url = self.url(backend)
+        request(backend, 'PUT', url + 'e0.ics', event('e0', extra='SEQUENCE:1\r\n').to_ical())
+        request(backend, 'DELETE', url + 'e1.ics')
+        request(backend, 'PUT', url + 'e3.ics', event('e3').to_ical())
+
+    def test_changes(self):
+        for backend in BACKENDS:
+            changed, removed, token = self.sync(backend)
+            self.assertEqual((changed, removed), (['e0', 'e1', 'e2'], []), backend.__name__)
+
+            # Nothing changed since
+            self.assertEqual(self.sync(backend, token), ([], [], token))
+
+            self.change(backend)
+
+            changed, removed, last = self.sync(backend, token)
+            self.assertEqual((changed, removed), (['e0', 'e3'], ['e1']), backend.__name__)
+            self.assertNotEqual(last, token)
+
+            # Added again after its removal
+            request(backend, 'PUT', self.url(backend) + 'e1.ics', event('e1').to_ical())
+            self.assertEqual(self.sync(backend, last)[:2], (['e1'], []), backend.__name__)
+            self.assertEqual(self.sync(backend, token)[:2], (['e0', 'e1', 'e3'], []), backend.__name__)
+
+    def test_invalid_token(self):
+        for backend in BACKENDS:
+            for token in ('urn:x-cal9:sync:unknown:1', 'garbage'):
+                status, headers, content = request(backend, 'REPORT', self.url(backend), SYNC.format(token))
+
+                self.assertEqual(status, 403)
+                self.assertIn('valid-sync-token', content)
+
+    def test_expired_token(self):
+        settings = config.config.sync
+        config.config.sync = {'tombstones': 1}
+        self.addCleanup(setattr, config.config, 'sync', settings)
+
+        for backend in BACKENDS:
+            token = self.sync(backend)[2]
+
+            for name in ('e0', 'e1'):
+                request(backend, 'DELETE', self.url(backend) + name + '.ics')
+
+            # The removal of e0 was forgotten
+            status, headers, content = request(backend, 'REPORT', self.url(backend), SYNC.format(token))
+            self.assertEqual(status, 403, backend.__name__)
+
+            changed, removed, last = self.sync(backend)
+            self.assertEqual((changed, removed), (['e2'], []), backend.__name__)
+
+class CopyTest(unittest.TestCase):
+    """ Items copied or moved within the server """
+
+    def setUp(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'copy')).append('e0', event('e0'))
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'copy')).delete()
+
+    def send(self, backend, method, name, destination):
+        url = '/{0}/'.format(path(backend, 'copy'))
+
+        return request(
+            backend, method, url + name + '.ics',
+            host='localhost', destination='http://localhost' + url + destination + '.ics'
+        )
+
+    def test_copy(self):
+        for backend in BACKENDS:
+            status, headers, content = self.send(backend, 'COPY', 'e0', 'e1')
+            self.assertEqual(status, 201)
+
+            collection = backend.Collection(path(backend, 'copy'))
+            self.assertEqual(sorted(collection.names), ['e0', 'e1'])
+
+            # The copied components were renamed, not the original ones
+            for name in ('e0', 'e1'):
+                item = collection.get_item(name)
+                self.assertIn('X-CAL9-NAME:{0}\r\n'.format(name), item.to_ical(), backend.__name__)
+                self.assertEqual(item.etag, collection.item_etag(name))
+
+    def test_move(self):
+        for backend in BACKENDS:
+            status, headers, content = self.send(backend, 'MOVE', 'e0', 'e1')
+            self.assertEqual(status, 201)
+
+            collection = backend.Collection(path(backend, 'copy'))
+            self.assertEqual(sorted(collection.names), ['e1'])
+            self.assertIsNone(collection.get_item('e0'))
+
+class TimeRangeTest(unittest.TestCase):
+    """ calendar-query REPORTs filtered by time-range [RFC 4791 9.9] """
+
+    def setUp(self):
+        for backend in BACKENDS:
+            collection = backend.Collection(path(backend, 'time-range'))
+            collection.append('e0', event('e0', start='20260105T100000'))
+            collection.append('e1', event('e1', start='20260110T100000'))
+            collection.append('e2', event('e2', start='20251229T100000', extra='RRULE:FREQ=WEEKLY;COUNT=3\r\n'))
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'time-range')).delete()
+
+    def query(self, backend, start, end):
+        url = '/{0}/'.format(path(backend, 'time-range'))
+        return request(backend, 'REPORT', url, QUERY.format(start, end), depth='1')
+
+    def test_overlapping(self):
+        for backend in BACKENDS:
+            status, headers, content = self.query(backend, '20260105T000000Z', '20260106T000000Z')
+            self.assertEqual(status, 207)
+            self.assertEqual(hrefs(content), ['e0', 'e2'], backend.__name__)
+
+            # Only the third occurrence of e2
+            status, headers, content = self.query(backend, '20260111T000000Z', '20260113T000000Z')
+            self.assertEqual(hrefs(content), ['e2'], backend.__name__)
+
+            # e1 ends at 11:00 in Paris, 10:00 UTC
+            status, headers, content = self.query(backend, '20260110T095900Z', '20260111T000000Z')
+            self.assertEqual(hrefs(content), ['e1'], backend.__name__)
+
+            status, headers, content = self.query(backend, '20260110T100000Z', '20260111T000000Z')
+            self.assertEqual(hrefs(content), [], backend.__name__)
+
+    def test_malformed(self):
+        for backend in BACKENDS:
+            status, headers, content = self.query(backend, '20260101', '20260201T000000Z')
+            self.assertEqual(status, 400, backend.__name__)
+
+PROPPATCH = """<?xml version="1.0" encoding="utf-8" ?>
+<D:propertyupdate xmlns:D="DAV:" xmlns:ICAL="http://apple.com/ns/ical/">
+    {0}
+</D:propertyupdate>"""
+
+PROPFIND = """<?xml version="1.0" encoding="utf-8" ?>
+<D:propfind xmlns:D="DAV:" xmlns:ICAL="http://apple.com/ns/ical/">
+    <D:prop>
+        <D:displayname />
+        <ICAL:calendar-color />
+    </D:prop>
+</D:propfind>"""
+
+class ProppatchTest(unittest.TestCase):
+    """ Collection properties set by PROPPATCH [RFC 4918 9.2] """
+
+    def url(self, backend):
+        return '/{0}/'.format(path(backend, 'proppatch'))
+
+    def setUp(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'proppatch')).append('e0', event('e0'))
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'proppatch')).delete()
+
+    def proppatch(self, backend, instructions):
+        return request(backend, 'PROPPATCH', self.url(backend), PROPPATCH.format(instructions))
+
+    def propfind(self, backend):
+        """ Return the href and the properties PROPFIND finds, by tag """
+
+        status, headers, content = request(backend, 'PROPFIND', self.url(backend), PROPFIND)
+        self.assertEqual(status, 207)
+
+        response = ET.fromstring(content).find(xmlutils.tag('D', 'response'))
+        found = {}
+
+        for propstat in response.findall(xmlutils.tag('D', 'propstat')):
+            if propstat.findtext(xmlutils.tag('D', 'status')).split()[1] == '200':
+                for prop in propstat.find(xmlutils.tag('D', 'prop')):
+                    found[xmlutils.tag_clark(prop.tag)] = prop.text
+
+        return response.findtext(xmlutils.tag('D', 'href')), found
+
+    def statuses(self, content):
+        """ Status of each property of a PROPPATCH response, by tag """
+
+        statuses = {}
+
+        for propstat in ET.fromstring(content).iter(xmlutils.tag('D', 'propstat')):
+            code = int(propstat.findtext(xmlutils.tag('D', 'status')).split()[1])
+
+            for prop in propstat.find(xmlutils.tag('D', 'prop')):
+                statuses[xmlutils.tag_clark(prop.tag)] = code
+
+        return statuses
+
+    def test_set_and_remove(self):
+        for backend in BACKENDS:
+            status, headers, content = self.proppatch(backend, (
+                '<D:set><D:prop><D:displayname>Work</D:displayname>'
+                '<ICAL:calendar-color>#ff0000</ICAL:calendar-color></D:prop></D:set>'
+            ))
+
+            self.assertEqual(status, 207)
+            self.assertEqual(self.statuses(content), {'D:displayname': 200, 'ICAL:calendar-color': 200})
+
+            href, found = self.propfind(backend)
+
+            # The display name does not change where the collection is
+            self.assertEqual(href, self.url(backend))
+            self.assertEqual(found, {'D:displayname': 'Work', 'ICAL:calendar-color': '#ff0000'})
+
+            status, headers, content = self.proppatch(backend, (
+                '<D:remove><D:prop><ICAL:calendar-color /></D:prop></D:remove>'
+            ))
+
+            self.assertEqual(self.statuses(content), {'ICAL:calendar-color': 200})
+            self.assertEqual(self.propfind(backend)[1], {'D:displayname': 'Work'})
+
+    def test_protected(self):
+        for backend in BACKENDS:
+            status, headers, content = self.proppatch(backend, (
+                '<D:set><D:prop><D:displayname>Work</D:displayname>'
+                '<D:getetag>"forged"</D:getetag></D:prop></D:set>'
+            ))
+
+            # Nothing is changed
+            self.assertEqual(self.statuses(content), {'D:displayname': 424, 'D:getetag': 403})
+            self.assertNotIn('D:displayname', self.propfind(backend)[1])
+
+EXPAND = """<?xml version="1.0" encoding="utf-8" ?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+    <D:prop>
+        <C:calendar-data>
+            <C:expand start="{0}" end="{1}" />
+        </C:calendar-data>
+    </D:prop>
+</C:calendar-query>"""
+
+# Weekly at 9:00 UTC from December 29th, the second occurrence moved to 14:00
+RECURRING = (
+    'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//tests//\r\n'
+    'BEGIN:VEVENT\r\nUID:weekly\r\nDTSTART:20251229T090000Z\r\n'
+    'DURATION:PT1H\r\nRRULE:FREQ=WEEKLY;COUNT=3\r\nSUMMARY:weekly\r\nEND:VEVENT\r\n'
+    'BEGIN:VEVENT\r\nUID:weekly\r\nRECURRENCE-ID:20260105T090000Z\r\n'
+    'DTSTART:20260105T140000Z\r\nDURATION:PT1H\r\nSUMMARY:moved\r\nEND:VEVENT\r\n'
+    'END:VCALENDAR\r\n'
+)
+
+class ExpandTest(unittest.TestCase):
+    """ Calendar data with recurrences expanded [RFC 4791 9.6.5] """
+
+    def setUp(self):
+        for backend in BACKENDS:
+            collection = backend.Collection(path(backend, 'expand'))
+            collection.append('once', event('once'))
+            collection.append('weekly', ical.parse(RECURRING))
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'expand')).delete()
+
+    def expand(self, backend, start, end):
+        url = '/{0}/'.format(path(backend, 'expand'))
+        return request(backend, 'REPORT', url, EXPAND.format(start, end), depth='1')
+
+    def occurrences(self, content):
+        """ Occurrences of the items a multistatus body holds, by name """
+
+        occurrences = {}
+        dom = ET.fromstring(content)
+
+        for response in dom.findall(xmlutils.tag('D', 'response')):
+            name = response.findtext(xmlutils.tag('D', 'href')).rsplit('/', 1)[1][:-len('.ics')]
+            data = response.findtext('.//' + xmlutils.tag('C', 'calendar-data'))
+
+            occurrences[name] = [
+                component for component in ical.parse(data).subcomponents
+                if component.name != ical.Timezone.tag
+            ]
+
+        return occurrences
+
+    def test_expand(self):
+        for backend in BACKENDS:
+            status, headers, content = self.expand(backend, '20260101T000000Z', '20260201T000000Z')
+            self.assertEqual(status, 207, content)
+
+            occurrences = self.occurrences(content)
+            weekly = occurrences['weekly']
+
+            self.assertEqual(
+                sorted((c['RECURRENCE-ID'].to_ical(), c['DTSTART'].to_ical(), str(c['SUMMARY'])) for c in weekly),
+                [('20260105T090000Z', '20260105T140000Z', 'moved'), ('20260112T090000Z', '20260112T090000Z', 'weekly')],
+                backend.__name__
+            )
+
+            for component in weekly:
+                self.assertNotIn('RRULE', component)
+
+            # Dates of single events are in UTC too
+            once, = occurrences['once']
+            self.assertEqual(once['DTSTART'].to_ical(), '20260105T090000Z')
+            self.assertNotIn('RECURRENCE-ID', once)
+
+    def test_outside(self):
+        for backend in BACKENDS:
+            status, headers, content = self.expand(backend, '20260113T000000Z', '20260201T000000Z')
+            self.assertEqual(status, 207)
+            self.assertEqual(self.occurrences(content)['weekly'], [], backend.__name__)
+
+    def test_malformed(self):
+        for backend in BACKENDS:
+            status, headers, content = self.expand(backend, '20260101', '20260201T000000Z')
+            self.assertEqual(status, 400, backend.__name__)
+
+FREE_BUSY = """<?xml version="1.0" encoding="utf-8" ?>
+<C:free-busy-query xmlns:C="urn:ietf:params:xml:ns:caldav">
+    {0}
+</C:free-busy-query>"""
+
+class FreeBusyTest(unittest.TestCase):
+    """ free-busy-query REPORTs [RFC 4791 7.10] """
+
+    def setUp(self):
+        for backend in BACKENDS:
+            collection = backend.Collection(path(backend, 'free-busy'))
+            collection.append('e0', event('e0', start='20260105T100000'))
+            collection.append('e1', event('e1', start='20260105T103000'))
+            collection.append('e2', event('e2', start='20260105T140000', extra='STATUS:TENTATIVE\r\n'))
+            collection.append('e3', event('e3', start='20260105T160000', extra='TRANSP:TRANSPARENT\r\n'))
+            collection.append('e4', event('e4', start='20260105T180000', extra='STATUS:CANCELLED\r\n'))
+            collection.append('e5', event('e5', start='20251229T080000', extra='RRULE:FREQ=WEEKLY;COUNT=3\r\n'))
+
+    def tearDown(self):
+        for backend in BACKENDS:
+            backend.Collection(path(backend, 'free-busy')).delete()
+
+    def free_busy(self, backend, time_range):
+        url = '/{0}/'.format(path(backend, 'free-busy'))
+        return request(backend, 'REPORT', url, FREE_BUSY.format(time_range), depth='1')
+
+    def test_busy(self):
+        for backend in BACKENDS:
+            status, headers, content = self.free_busy(
+                backend, '<C:time-range start="20260105T000000Z" end="20260112T073000Z" />'
+            )
+            self.assertEqual(status, 200, content)
+            self.assertEqual(headers['Content-Type'], 'text/calendar')
+
+            component, = ical.parse(content).subcomponents
+            self.assertEqual(component.name, 'VFREEBUSY')
+            self.assertEqual(component['DTSTART'].to_ical(), '20260105T000000Z')
+            self.assertEqual(component['DTEND'].to_ical(), '20260112T073000Z')
+
+            periods = component.get('FREEBUSY')
+            periods = periods if isinstance(periods, list) else [periods]
+
+            # Overlapping events are merged, periods are cut at the end of the range
+            self.assertEqual(sorted((p.params['FBTYPE'], p.to_ical()) for p in periods), [
+                ('BUSY', '20260105T070000Z/20260105T080000Z'),
+                ('BUSY', '20260105T090000Z/20260105T103000Z'),
+                ('BUSY', '20260112T070000Z/20260112T073000Z'),
+                ('BUSY-TENTATIVE', '20260105T130000Z/20260105T140000Z'),
+            ], backend.__name__)
+
+    def test_free(self):
+        for backend in BACKENDS:
+            status, headers, content = self.free_busy(
+                backend, '<C:time-range start="20260106T000000Z" end="20260107T000000Z" />'
+            )
+            self.assertEqual(status, 200)
+
+            component, = ical.parse(content).subcomponents
+            self.assertNotIn('FREEBUSY', component)
+
+    def test_malformed(self):
+        for backend in BACKENDS:
+            for time_range in (
+                '',
+                '<C:time-range start="20260105T000000Z" />',
+                '<C:time-range start="20260105" end="20260106T000000Z" />',
+            ):
+                status, headers, content = self.free_busy(backend, time_range)
+                self.assertEqual(status, 400, (backend.__name__, time_range))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from tests import event
+
+from cal9.backends import filesystem, journal, multifilesystem
+
+import threading
+import unittest
+import sys
+
+def fill(collection_type, name, count=60):
+    """ Return the path of a new collection of ``count`` events """
+
+    path = 'user/{0}-{1}'.format(name, collection_type.__module__.split('.')[-1])
+    collection = collection_type(path)
+
+    for i in range(count):
+        collection.append('e{0}'.format(i), event('e{0}'.format(i)))
+
+    return path
+
+class IsolationTest(unittest.TestCase):
+    """
+        Readers share the calendars and indexes cached by the backends, a
+        writer must never change those in place.
+    """
+
+    def check(self, collection_type):
+        path = fill(collection_type, 'isolation')
+        self.addCleanup(lambda: collection_type(path).delete())
+
+        reader = collection_type(path)
+        ical, index = reader.ical, reader.index
+        components = list(ical.subcomponents)
+        positions = dict((name, index.positions(name)) for name in index.names())
+
+        collection_type(path).replace('e0', event('e0', extra='SEQUENCE:1\r\n'))
+        collection_type(path).remove('e1')
+        collection_type(path).append('e60', event('e60'))
+
+        # Replaying the journal, or using the cached calendar
+        self.assertIsNone(collection_type(path).get_item('e1'))
+
+        self.assertEqual(ical.subcomponents, components)
+        self.assertEqual(dict((name, index.positions(name)) for name in index.names()), positions)
+        self.assertEqual(str(reader.index.components('e1')[0]['UID']), 'e1')
+
+    def test_filesystem(self):
+        self.check(filesystem.Collection)
+
+    def test_journal(self):
+        self.check(journal.Collection)
+
+    def test_multifilesystem(self):
+        self.check(multifilesystem.Collection)
+
+class MetaIsolationTest(unittest.TestCase):
+    """
+        Readers share the metadata cached by the backends, their CTag and
+        ETags must not change under them.
+    """
+
+    def check(self, collection_type):
+        path = fill(collection_type, 'meta', count=2)
+        self.addCleanup(lambda: collection_type(path).delete())
+
+        reader = collection_type(path)
+        meta = reader.meta
+        etag, sync_token, etags = reader.etag, reader.sync_token, dict(meta['etags'])
+
+        collection_type(path).append('e2', event('e2'))
+        collection_type(path).remove('e0')
+
+        self.assertEqual(reader.etag, etag)
+        self.assertEqual(reader.sync_token, sync_token)
+        self.assertEqual(meta['etags'], etags)
+        self.assertEqual(meta['tombstones'], {})
+
+        # New readers find the changes
+        writer_meta = collection_type(path).meta
+        self.assertIsNot(writer_meta, meta)
+        self.assertEqual(writer_meta['generation'], meta['generation'] + 2)
+        self.assertEqual(sorted(writer_meta['etags']), ['e1', 'e2'])
+        self.assertEqual(list(writer_meta['tombstones']), ['e0'])
+
+    def test_filesystem(self):
+        self.check(filesystem.Collection)
+
+    def test_journal(self):
+        self.check(journal.Collection)
+
+    def test_multifilesystem(self):
+        self.check(multifilesystem.Collection)
+
+class ThreadsTest(unittest.TestCase):
+    """ Readers in threads find the items a writer does not change """
+
+    readers = 4
+    rounds = 10
+
+    def setUp(self):
+        # Switch threads often, for the races to show up
+        self.interval = sys.getcheckinterval()
+        sys.setcheckinterval(10)
+
+    def tearDown(self):
+        sys.setcheckinterval(self.interval)
+
+    def check(self, collection_type):
+        path = fill(collection_type, 'threads')
+        self.addCleanup(lambda: collection_type(path).delete())
+
+        stopped = threading.Event()
+        missing = []
+
+        def write():
+            try:
+                for n in range(self.rounds):
+                    for i in range(10):
+                        name = 'e{0}'.format(i)
+                        collection_type(path).replace(name, event(name, extra='SEQUENCE:{0}\r\n'.format(n)))
+            finally:
+                stopped.set()
+
+        def read(first):
+            while not stopped.is_set():
+                for i in range(first, 60, self.readers):
+                    name = 'e{0}'.format(i)
+                    item = collection_type(path).get_item(name)
+
+                    if item is None or 'UID:{0}\r\n'.format(name) not in item.to_ical():
+                        missing.append(name)
+
+        threads = [threading.Thread(target=write)] + [
+            threading.Thread(target=read, args=(10 + i,)) for i in range(self.readers)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(missing, [])
+
+    def test_filesystem(self):
+        self.check(filesystem.Collection)
+
+    def test_journal(self):
+        self.check(journal.Collection)
+
+    def test_multifilesystem(self):
+        self.check(multifilesystem.Collection)
+
+if __name__ == '__main__':
+    unittest.main()
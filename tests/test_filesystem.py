@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from tests import event
+
+from cal9 import ical
+from cal9.backends import filesystem
+
+import unittest
+
+class TimezoneBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = filesystem.Collection('user/timezones')
+        self.collection.append('first', event('first'))
+        self.collection.append('second', event('second', tzid='America/New_York'))
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def cold(self):
+        """ Return the collection as a new process would find it """
+
+        filesystem.CACHE.clear()
+        collection = filesystem.Collection(self.collection.path)
+        self.assertFalse(collection.parsed())
+
+        return collection
+
+    def test_all(self):
+        blocks = self.cold().timezone_blocks()
+
+        self.assertEqual(len(blocks), 2)
+        self.assertIn('TZID:America/New_York', blocks[0])
+        self.assertIn('TZID:Europe/Paris', blocks[1])
+
+    def test_some(self):
+        blocks = self.cold().timezone_blocks(['Europe/Paris'])
+
+        self.assertEqual(len(blocks), 1)
+        self.assertTrue(blocks[0].startswith('BEGIN:VTIMEZONE'))
+        self.assertIn('TZID:Europe/Paris', blocks[0])
+
+    def test_same_as_parsed(self):
+        cold = self.cold().timezone_blocks()
+
+        # Parse the calendar, blocks are then found from its index
+        collection = filesystem.Collection(self.collection.path)
+        collection.ical
+
+        self.assertTrue(collection.parsed())
+        self.assertEqual(collection.timezone_blocks(), cold)
+
+class GetItemTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = filesystem.Collection('user/get-item')
+        self.collection.append('first', event('first'))
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def test_without_parsing(self):
+        collection = filesystem.Collection(self.collection.path)
+        collection.ical
+
+        parse = ical.parse
+        parsed = []
+
+        ical.parse = lambda text: parsed.append(text) or parse(text)
+        self.addCleanup(setattr, ical, 'parse', parse)
+
+        item = collection.get_item('first')
+
+        self.assertEqual(parsed, [])
+        self.assertIsInstance(item, ical.Event)
+        self.assertEqual(item.etag, collection.item_etag('first'))
+
+    def test_copy(self):
+        collection = filesystem.Collection(self.collection.path)
+        item = collection.get_item('first')
+
+        copy = item.copy()
+        copy.ical.subcomponents[0]['SUMMARY'] = 'changed'
+
+        self.assertEqual(str(item.ical.subcomponents[0]['SUMMARY']), 'first')
+        self.assertEqual(str(collection.index.components('first')[0]['SUMMARY']), 'first')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from tests import event
+
+from cal9 import ical
+from cal9.backends import filesystem, journal
+
+import unittest
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = journal.Collection('user/journal')
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def reopen(self):
+        """ Return the collection replayed from its journal """
+
+        filesystem.CACHE.clear()
+        return journal.Collection(self.collection.path)
+
+    def test_calendar_without_properties(self):
+        # An empty Calendar is falsy, it must not be recorded as a removal
+        bare = ical.parse(
+            'BEGIN:VCALENDAR\r\n'
+            'BEGIN:VEVENT\r\nUID:bare\r\nDTSTART:20260105T100000Z\r\nEND:VEVENT\r\n'
+            'END:VCALENDAR\r\n'
+        )
+
+        self.collection.append('bare', bare)
+
+        collection = self.reopen()
+        item = collection.get_item('bare')
+
+        self.assertIsNotNone(item)
+        self.assertEqual(item.etag, collection.item_etag('bare'))
+
+    def test_replay(self):
+        for i in range(5):
+            self.collection.append('e{0}'.format(i), event('e{0}'.format(i)))
+
+        self.collection.remove('e1')
+        self.collection.replace('e2', event('e2', extra='SEQUENCE:1\r\n'))
+        self.collection.remove('e3')
+        self.collection.append('e3', event('e3', extra='SEQUENCE:2\r\n'))
+
+        collection = self.reopen()
+
+        self.assertEqual(sorted(collection.index.names()), ['Europe/Paris', 'e0', 'e2', 'e3', 'e4'])
+        self.assertIn('SEQUENCE:1', collection.get_item('e2').to_ical())
+        self.assertIn('SEQUENCE:2', collection.get_item('e3').to_ical())
+
+        # Each item's components are found where the index tells
+        for name in collection.index.names():
+            for component in collection.index.components(name):
+                self.assertEqual(ical.component_name(component), name)
+
+if __name__ == '__main__':
+    unittest.main()
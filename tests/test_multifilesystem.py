@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from tests import event
+
+from cal9 import config
+from cal9 import ical
+from cal9 import watcher
+from cal9.backends import filesystem, multifilesystem
+
+import unittest
+import time
+import os
+
+FREEBUSY = (
+    'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//tests//\r\n'
+    'BEGIN:VFREEBUSY\r\nUID:busy\r\nDTSTART:20260105T100000Z\r\n'
+    'DTEND:20260105T110000Z\r\nEND:VFREEBUSY\r\n'
+    'END:VCALENDAR\r\n'
+)
+
+class ExternalChangesTest(unittest.TestCase):
+    """ Items changed by other tools than 9cal are found """
+
+    def setUp(self):
+        self.collection = multifilesystem.Collection('user/external')
+        self.collection.append('e0', event('e0'))
+        self.collection.append('e1', event('e1'))
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def reopen(self):
+        return multifilesystem.Collection(self.collection.path)
+
+    def test_added_and_removed(self):
+        before = self.reopen()
+        signature, etag = before.signature, before.etag
+
+        with open(self.collection._item_path('e2'), 'w') as f:
+            f.write(event('e2').to_ical())
+
+        os.remove(self.collection._item_path('e0'))
+
+        after = self.reopen()
+        self.assertNotEqual(after.signature, signature)
+        self.assertNotEqual(after.etag, etag)
+        self.assertEqual(sorted(after.names), ['e1', 'e2'])
+        self.assertEqual(sorted(item.name for item in after.events), ['e1', 'e2'])
+
+    def test_write_keeps_other_items(self):
+        self.collection.append('busy', ical.parse(FREEBUSY))
+
+        collection = self.reopen()
+        collection.ical
+        collection.write()
+
+        self.assertEqual(sorted(self.reopen()._item_names()), ['busy', 'e0', 'e1'])
+
+    def test_removed_while_assembled(self):
+        collection = self.reopen()
+        read_item = collection._read_item
+
+        def removed_once_read(name):
+            item_ical = read_item(name)
+            os.remove(collection._item_path(name))
+            return item_ical
+
+        collection._read_item = removed_once_read
+        filesystem.CACHE.clear()
+
+        self.assertEqual(sorted(collection.index.names()), ['Europe/Paris', 'e0', 'e1'])
+
+class WatchedChangesTest(ExternalChangesTest):
+    """ Items modified in place are found through the watcher """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings = config.config.watch
+        config.config.watch = {'enabled': True, 'method': 'inotify'}
+        watcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        watcher.stop()
+        watcher._settings = None
+        config.config.watch = cls.settings
+
+    def test_modified_in_place(self):
+        before = self.reopen()
+        signature, etag = before.signature, before.item_etag('e0')
+
+        # Keep the file, with the same size
+        with open(self.collection._item_path('e0'), 'r+') as f:
+            text = f.read().replace('SUMMARY:e0', 'SUMMARY:E0')
+            f.seek(0)
+            f.write(text)
+
+        # Wait for the watcher to be told
+        for i in range(100):
+            if self.reopen().signature != signature:
+                break
+
+            time.sleep(0.01)
+
+        after = self.reopen()
+        self.assertNotEqual(after.signature, signature)
+        self.assertNotEqual(after.item_etag('e0'), etag)
+        self.assertIn('SUMMARY:E0', after.get_item('e0').to_ical())
+
+        # The assembled calendar is not used anymore
+        self.assertEqual(str(after.index.components('e0')[0]['SUMMARY']), 'E0')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from tests import event
+
+from cal9 import ical
+from cal9 import timerange
+from cal9.backends import sqlite
+
+import threading
+import unittest
+
+class RowsTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = sqlite.Collection('user/rows')
+        self.collection.append('first', event('first'))
+        self.collection.append('second', event('second'))
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def test_get_item(self):
+        item = self.collection.get_item('first')
+
+        self.assertIsInstance(item, ical.Event)
+        self.assertEqual(str(item.ical.subcomponents[0]['UID']), 'first')
+        self.assertEqual(item.etag, self.collection.item_etag('first'))
+        self.assertIsNone(self.collection.get_item('missing'))
+
+        # Timezones are stored in their own rows, not as items
+        self.assertIsNone(self.collection.get_item('Europe/Paris'))
+        self.assertEqual(self.collection.names, ['first', 'second'])
+        self.assertEqual(len(self.collection.timezone_blocks()), 1)
+
+    def test_generations(self):
+        etag = self.collection.etag
+        first = self.collection.item_etag('first')
+
+        self.collection.replace('first', event('first', extra='SEQUENCE:1\r\n'))
+
+        self.assertNotEqual(self.collection.etag, etag)
+        self.assertNotEqual(self.collection.item_etag('first'), first)
+        self.assertEqual(self.collection.item_etags(['first', 'second'])['second'], self.collection.item_etag('second'))
+
+    def test_write(self):
+        collection = sqlite.Collection(self.collection.path)
+        second = collection.item_etag('second')
+        token = collection.sync_token
+
+        collection.ical.subcomponents = [
+            component for component in collection.ical.subcomponents
+            if component.get('UID') != 'first'
+        ]
+        collection.write()
+
+        # Unchanged rows are kept, removed ones leave a tombstone
+        self.assertEqual(collection.names, ['second'])
+        self.assertEqual(collection.item_etag('second'), second)
+        self.assertEqual(collection.changes_since(token), ([], ['first']))
+
+    def test_removed_and_added(self):
+        token = self.collection.sync_token
+
+        self.collection.remove('first')
+        self.assertEqual(self.collection.changes_since(token), ([], ['first']))
+
+        self.collection.append('first', event('first'))
+        self.assertEqual(self.collection.changes_since(token), (['first'], []))
+
+        # Removing a missing item changes nothing but the generation
+        self.collection.remove('missing')
+        self.assertEqual(self.collection.changes_since(token), (['first'], []))
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = sqlite.Collection('user/query')
+        self.collection.append('once', event('once', start='20260105T100000'))
+        self.collection.append('weekly', event('weekly', start='20251229T100000', extra='RRULE:FREQ=WEEKLY\r\n'))
+        self.collection.append('counted', event('counted', start='20251229T100000', extra='RRULE:FREQ=DAILY;COUNT=2\r\n'))
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def query(self, start, end):
+        return sorted(self.collection.query(ical.Event.tag, timerange.parse_utc(start), timerange.parse_utc(end)))
+
+    def test_bounds(self):
+        self.assertEqual(self.query('20260105T000000Z', '20260106T000000Z'), ['once', 'weekly'])
+        self.assertEqual(self.query('20251230T000000Z', '20251231T000000Z'), ['counted'])
+
+        # Endless recurrences are stored with an open end
+        self.assertEqual(self.query('20300101T000000Z', '20300201T000000Z'), ['weekly'])
+        self.assertEqual(self.query('20250101T000000Z', '20250201T000000Z'), [])
+
+    def test_busy(self):
+        busy = self.collection.busy(timerange.parse_utc('20260105T000000Z'), timerange.parse_utc('20260106T000000Z'))
+
+        # Both events are at 9:00 UTC for an hour
+        self.assertEqual(busy['BUSY'], [(timerange.parse_utc('20260105T090000Z'), timerange.parse_utc('20260105T100000Z'))])
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = sqlite.Collection('user/transactions')
+        self.collection.append('first', event('first'))
+
+    def tearDown(self):
+        self.collection.delete()
+
+    def test_rollback(self):
+        etag = self.collection.etag
+
+        # Changes made under the lock are nested in its transaction
+        with self.assertRaises(KeyError):
+            with self.collection.lock(exclusive=True):
+                self.collection.remove('first')
+                self.collection.append('second', event('second'))
+                raise KeyError('second')
+
+        self.assertEqual(self.collection.names, ['first'])
+        self.assertEqual(self.collection.etag, etag)
+
+        # Later transactions are not nested anymore
+        self.collection.remove('first')
+        self.assertEqual(self.collection.names, [])
+
+    def test_other_thread(self):
+        results = []
+
+        def names():
+            results.append(sqlite.Collection(self.collection.path).names)
+            sqlite.connect().close()
+
+        # A new connection finds the schema created
+        thread = threading.Thread(target=names)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(results, [['first']])